@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+
+"""bench: jpic in-process benchmark."""
+
+import argparse
+import csv
+import math
+import numpy as np
+import sys
+import time
+import tracemalloc
+
+import dctlib
+import jpic
+import jpiclib
+import metrics
+import statslib
+import utils
+
+
+# columns of the main CSV output. The first ones are the same as the ones
+# in the `*.sh` scripts
+CSV_COLUMNS = ['qp', 'encode', 'decode', 'size', 'psnr', 'ssim', 'name',
+               'width', 'height', 'quantization', 'encode_mbps',
+               'decode_mbps', 'encode_mpixps', 'decode_mpixps']
+MEMORY_CSV_COLUMNS = ['encode_peak_mb', 'decode_peak_mb']
+STAGES_CSV_COLUMNS = ['name', 'width', 'height', 'quantization', 'function',
+                      'plane', 'stage', 'time', 'mbps', 'mpixps']
+# columns compared against the baseline
+BASELINE_COLUMNS = ['encode', 'decode', 'size']
+
+
+default_values = {
+    'debug': 0,
+    'width': 720,
+    'height': 480,
+    'framenum': 0,
+    'qtype': 'jpeg',
+    'qps': '1,2,4,8,16',
+    'transform': 'dct',
+    'encoding': 'dcpm',
+    'dct_engine': 'batched',
+    'jobs': 1,
+    'restart_interval': 0,
+    'precision': 'double',
+    'repeats': 3,
+    'memory': False,
+    'synthetic': [],
+    'stages_outfile': None,
+    'baseline': None,
+    'threshold': 0.1,
+    'infile': None,
+    'outfile': '-',
+}
+
+
+def get_synthetic_frame(width, height, seed=0):
+    # get a smooth (i.e. compressible) random 4:2:0 frame
+    rng = np.random.default_rng(seed)
+    frame_size = int(width * height * 1.5)
+    frame = np.cumsum(rng.integers(-3, 4, size=frame_size)) % 256
+    return frame.astype(np.uint8).tobytes()
+
+
+def get_peak_memory(func, *args, **kwargs):
+    # returns the peak memory use (bytes) of func
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run_benchmark(frame_data, width, height, quantization, repeats=1,
+                  memory=False, **kwargs):
+    # encode and decode a frame in-process `repeats` times, and keep the
+    # fastest run (and its per-stage stats)
+    # kwargs are encode_file() parameters
+    decode_kwargs = {key: kwargs[key] for key in
+                     ('dct_engine', 'jobs', 'precision') if key in kwargs}
+    best = {}
+    for _ in range(repeats):
+        encode_stats = statslib.Stats()
+        start = time.perf_counter()
+        out = jpic.encode_file(frame_data, width, height, quantization,
+                               stats=encode_stats, **kwargs)
+        encode_time = time.perf_counter() - start
+        decode_stats = statslib.Stats()
+        start = time.perf_counter()
+        y, u, v = jpic.decode_file(out, stats=decode_stats, **decode_kwargs)
+        decode_time = time.perf_counter() - start
+        if 'encode' not in best or encode_time < best['encode']:
+            best['encode'] = encode_time
+            best['encode_stats'] = encode_stats
+        if 'decode' not in best or decode_time < best['decode']:
+            best['decode'] = decode_time
+            best['decode_stats'] = decode_stats
+    best['size'] = len(out)
+    # luma metrics (same as ffmpeg's "PSNR y" and "SSIM Y")
+    y_ref = dctlib.get_420_planes(frame_data, width, height)[0]
+    best['psnr'] = metrics.get_psnr(y_ref, y)
+    best['ssim'] = metrics.get_ssim(y_ref, y)
+    if memory:
+        # tracemalloc slows down python code, so we use a separate run
+        best['encode_peak'] = get_peak_memory(
+            jpic.encode_file, frame_data, width, height, quantization,
+            **kwargs)
+        best['decode_peak'] = get_peak_memory(jpic.decode_file, out,
+                                              **decode_kwargs)
+    return best
+
+
+def get_row(name, width, height, quantization, qp, result):
+    frame_mb = width * height * 1.5 / 1e6
+    mpixels = width * height / 1e6
+    row = {
+        'qp': qp,
+        'encode': result['encode'],
+        'decode': result['decode'],
+        'size': result['size'],
+        'psnr': result['psnr'],
+        'ssim': result['ssim'],
+        'name': name,
+        'width': width,
+        'height': height,
+        'quantization': quantization,
+        'encode_mbps': frame_mb / result['encode'],
+        'decode_mbps': frame_mb / result['decode'],
+        'encode_mpixps': mpixels / result['encode'],
+        'decode_mpixps': mpixels / result['decode'],
+    }
+    if 'encode_peak' in result:
+        row['encode_peak_mb'] = result['encode_peak'] / 1e6
+        row['decode_peak_mb'] = result['decode_peak'] / 1e6
+    return row
+
+
+def get_stage_rows(name, width, height, quantization, result):
+    # returns a row per (function, plane, stage), plus the frame totals
+    # (plane "all") of each stage
+    # (plane size in bytes, plane size in pixels)
+    plane_sizes = {
+        'y': (width * height, width * height),
+        'u': (width * height / 4, width * height / 4),
+        'v': (width * height / 4, width * height / 4),
+        'all': (width * height * 1.5, width * height),
+    }
+    rows = []
+    for function in ('encode', 'decode'):
+        stats = result[function + '_stats']
+        times = [(stage_name.split('.'), value) for
+                 (stage_name, value) in stats.times.items() if
+                 '.' in stage_name]
+        times += [(('all', stage), value) for (stage, value) in
+                  stats.get_stage_times().items()]
+        for (plane, stage), value in times:
+            size, pixels = plane_sizes[plane]
+            rows.append({
+                'name': name,
+                'width': width,
+                'height': height,
+                'quantization': quantization,
+                'function': function,
+                'plane': plane,
+                'stage': stage,
+                'time': value,
+                'mbps': size / 1e6 / value if value else math.inf,
+                'mpixps': pixels / 1e6 / value if value else math.inf,
+            })
+    return rows
+
+
+def read_csv(infile):
+    # read a CSV file with a `#`-prefixed header
+    with open(infile) as fin:
+        header = fin.readline().lstrip('#').strip().split(',')
+        return list(csv.DictReader(fin, header))
+
+
+def get_row_key(row):
+    return (row['name'], int(row['width']), int(row['height']),
+            row['quantization'])
+
+
+def compare_baseline(rows, baseline_rows, threshold):
+    # returns a list of regression messages: times more than `threshold`
+    # (ratio) slower than the baseline, or larger files
+    baseline = {get_row_key(row): row for row in baseline_rows}
+    regressions = []
+    for row in rows:
+        key = get_row_key(row)
+        if key not in baseline:
+            continue
+        for column in BASELINE_COLUMNS:
+            old = float(baseline[key][column])
+            new = float(row[column])
+            limit = old if column == 'size' else old * (1 + threshold)
+            if new > limit:
+                regressions.append(
+                    'regression: %s %ix%i %s %s: %s -> %s (%+.1f%%)' % (
+                        key[0], key[1], key[2], key[3], column, old, new,
+                        100 * (new - old) / old))
+    return regressions
+
+
+def get_options(argv):
+    """Generic option parser.
+
+    Args:
+        argv: list containing arguments
+
+    Returns:
+        Namespace - An argparse.ArgumentParser-generated option object
+    """
+    # init parser
+    # usage = 'usage: %prog [options] arg1 arg2'
+    # parser = argparse.OptionParser(usage=usage)
+    # parser.print_help() to get argparse.usage (large help)
+    # parser.print_usage() to get argparse.usage (just usage line)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+            '-d', '--debug', action='count',
+            dest='debug', default=default_values['debug'],
+            help='Increase verbosity (use multiple times for more)',)
+    parser.add_argument(
+            '--quiet', action='store_const',
+            dest='debug', const=-1,
+            help='Zero verbosity',)
+    # 2-parameter setter using argparse.Action
+    parser.add_argument(
+            '--width', action='store', type=int,
+            dest='width', default=default_values['width'],
+            metavar='WIDTH',
+            help=('use WIDTH width (default: %i)' % default_values['width']),)
+    parser.add_argument(
+            '--height', action='store', type=int,
+            dest='height', default=default_values['height'],
+            metavar='HEIGHT',
+            help=('HEIGHT height (default: %i)' % default_values['height']),)
+
+    class VideoSizeAction(argparse.Action):
+        def __call__(self, parser, namespace, values, option_string=None):
+            namespace.width, namespace.height = [int(v) for v in
+                                                 values[0].split('x')]
+    parser.add_argument(
+            '--video-size', action=VideoSizeAction, nargs=1,
+            help='use <width>x<height>',)
+    parser.add_argument(
+            '--framenum', action='store', type=int,
+            dest='framenum', default=default_values['framenum'],
+            metavar='FRAMENUM',
+            help=('FRAMENUM (default: %i)' % default_values['framenum']),)
+    parser.add_argument(
+            '--qtype', action='store',
+            dest='qtype', type=str,
+            default=default_values['qtype'],
+            choices=jpic.QTYPE_CHOICES,
+            metavar='qtype',
+            help='quantization type (%r)' % jpic.QTYPE_CHOICES,)
+    parser.add_argument(
+            '--qps', action='store',
+            dest='qps', type=str,
+            default=default_values['qps'],
+            metavar='QPS',
+            help=('list of QP values, e.g. "1,2,4" or "1-31" '
+                  '(default: %s)' % default_values['qps']),)
+    parser.add_argument(
+            '--transform', action='store',
+            dest='transform', type=str,
+            default=default_values['transform'],
+            choices=jpic.TRANSFORM_CHOICES,
+            metavar='transform',
+            help='transform (%r)' % jpic.TRANSFORM_CHOICES,)
+    parser.add_argument(
+            '--encoding', action='store',
+            dest='encoding', type=str,
+            default=default_values['encoding'],
+            choices=jpic.ENCODING_CHOICES,
+            metavar='encoding',
+            help='encoding (%r)' % jpic.ENCODING_CHOICES,)
+    parser.add_argument(
+            '--dct-engine', action='store',
+            dest='dct_engine', type=str,
+            default=default_values['dct_engine'],
+            choices=dctlib.DCT_ENGINE_CHOICES,
+            metavar='dct_engine',
+            help='DCT engine (%r)' % dctlib.DCT_ENGINE_CHOICES,)
+    parser.add_argument(
+            '--precision', action='store',
+            dest='precision', type=str,
+            default=default_values['precision'],
+            choices=jpiclib.PRECISION_CHOICES,
+            metavar='precision',
+            help='precision (%r)' % jpiclib.PRECISION_CHOICES,)
+    parser.add_argument(
+            '-j', '--jobs', action='store', type=int,
+            dest='jobs', default=default_values['jobs'],
+            metavar='JOBS',
+            help=('run up to JOBS processes in parallel (default: %i)' %
+                  default_values['jobs']),)
+    parser.add_argument(
+            '--restart-interval', action='store', type=int,
+            dest='restart_interval',
+            default=default_values['restart_interval'],
+            metavar='ROWS',
+            help=('restart interval (default: %i)' %
+                  default_values['restart_interval']),)
+    parser.add_argument(
+            '--repeats', action='store', type=int,
+            dest='repeats', default=default_values['repeats'],
+            metavar='REPEATS',
+            help=('run each benchmark REPEATS times, and keep the fastest '
+                  'run (default: %i)' % default_values['repeats']),)
+    parser.add_argument(
+            '--memory', action='store_true',
+            dest='memory', default=default_values['memory'],
+            help='measure the peak memory use too (tracemalloc)',)
+    parser.add_argument(
+            '--synthetic', action='append',
+            dest='synthetic', default=list(default_values['synthetic']),
+            metavar='WIDTHxHEIGHT',
+            help='add a synthetic frame of size WIDTHxHEIGHT (repeatable)',)
+    parser.add_argument(
+            '--stages-outfile', action='store', type=str,
+            dest='stages_outfile', default=default_values['stages_outfile'],
+            metavar='STAGES_OUTFILE',
+            help='write the per-stage (and per-plane) results as CSV',)
+    parser.add_argument(
+            '--baseline', action='store', type=str,
+            dest='baseline', default=default_values['baseline'],
+            metavar='BASELINE',
+            help='compare the results against a baseline CSV file',)
+    parser.add_argument(
+            '--threshold', action='store', type=float,
+            dest='threshold', default=default_values['threshold'],
+            metavar='THRESHOLD',
+            help=('slow down (ratio) flagged as a regression '
+                  '(default: %s)' % default_values['threshold']),)
+    parser.add_argument(
+            '-o', '--outfile', action='store', type=str,
+            dest='outfile', default=default_values['outfile'],
+            metavar='output-file',
+            help='output CSV file (default: stdout)',)
+    parser.add_argument(
+            'infile', type=str, nargs='?',
+            default=default_values['infile'],
+            metavar='input-file',
+            help='input file (raw 4:2:0)',)
+    # do the parsing
+    options = parser.parse_args(argv[1:])
+    return options
+
+
+def main(argv):
+    # parse options
+    options = get_options(argv)
+    # get outfile
+    if options.outfile == '-':
+        options.outfile = '/dev/fd/1'
+    # print results
+    if options.debug > 0:
+        print(options)
+    # get the list of (name, frame_data, width, height) inputs
+    inputs = []
+    if options.infile is not None:
+        frame_data = dctlib.map_frame(options.infile, options.width,
+                                      options.height, options.framenum)
+        inputs.append((options.infile, frame_data, options.width,
+                       options.height))
+    for video_size in options.synthetic:
+        width, height = [int(v) for v in video_size.split('x')]
+        inputs.append(('synthetic', get_synthetic_frame(width, height),
+                       width, height))
+    qps = ([0] if options.qtype == 'lossless' else
+           jpic.parse_qps(options.qps))
+    codec_kwargs = {
+        'transform': options.transform,
+        'encoding': options.encoding,
+        'dct_engine': options.dct_engine,
+        'jobs': options.jobs,
+        'restart_interval': options.restart_interval,
+        'precision': options.precision,
+    }
+
+    # run the benchmarks
+    rows = []
+    stage_rows = []
+    for name, frame_data, width, height in inputs:
+        for qp in qps:
+            quantization = jpic.get_quantization(options.qtype, qp)
+            result = run_benchmark(frame_data, width, height, quantization,
+                                   options.repeats, options.memory,
+                                   **codec_kwargs)
+            rows.append(get_row(name, width, height, quantization, qp,
+                                result))
+            stage_rows += get_stage_rows(name, width, height, quantization,
+                                         result)
+
+    # write the results
+    columns = CSV_COLUMNS + (MEMORY_CSV_COLUMNS if options.memory else [])
+    with open(options.outfile, 'w') as fout:
+        utils.write_csv(rows, columns, fout)
+    if options.stages_outfile:
+        with open(options.stages_outfile, 'w') as fout:
+            utils.write_csv(stage_rows, STAGES_CSV_COLUMNS, fout)
+    if options.baseline:
+        regressions = compare_baseline(rows, read_csv(options.baseline),
+                                       options.threshold)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    # at least the CLI program name: (CLI) execution
+    main(sys.argv)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+"""bench."""
+
+
+import bench
+
+import unittest
+
+
+class MyTest(unittest.TestCase):
+
+    def testRunBenchmark(self):
+        """A test for the in-process benchmark."""
+        width, height = 64, 48
+        frame_data = bench.get_synthetic_frame(width, height)
+        result = bench.run_benchmark(frame_data, width, height, 'jpeg-4',
+                                     repeats=2, memory=True, encoding='dcpm')
+        row = bench.get_row('synthetic', width, height, 'jpeg-4', 4, result)
+        self.assertGreater(row['size'], 0)
+        self.assertGreater(row['encode_peak_mb'], 0)
+        stage_rows = bench.get_stage_rows('synthetic', width, height,
+                                          'jpeg-4', result)
+        stages = {(row['function'], row['plane'], row['stage']) for row in
+                  stage_rows}
+        self.assertIn(('encode', 'y', 'transform'), stages)
+        self.assertIn(('decode', 'v', 'entropy'), stages)
+        self.assertIn(('decode', 'all', 'container'), stages)
+        # per-stage times cannot add up to more than the full time
+        self.assertLessEqual(
+            sum(row['time'] for row in stage_rows if
+                row['function'] == 'encode' and row['plane'] != 'all'),
+            result['encode'])
+
+    def testCompareBaseline(self):
+        """A test for the baseline comparison."""
+        baseline = [{'name': 'a', 'width': '8', 'height': '8',
+                     'quantization': 'jpeg-1', 'encode': '1.0',
+                     'decode': '1.0', 'size': '100'}]
+        row = {'name': 'a', 'width': 8, 'height': 8,
+               'quantization': 'jpeg-1', 'encode': 1.05, 'decode': 1.5,
+               'size': 101}
+        regressions = bench.compare_baseline([row], baseline, 0.1)
+        self.assertEqual(len(regressions), 2)
+        self.assertIn('decode', regressions[0])
+        self.assertIn('size', regressions[1])
+        row['quantization'] = 'jpeg-2'
+        self.assertEqual(bench.compare_baseline([row], baseline, 0.1), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@
 import argparse
 import math
 import numpy as np
+import os
 import sys
 
 import utils
@@ -80,9 +81,118 @@ def get_block_idct(block):
     return idct
 
 
-def get_frame_dct(inp):
+# DCT engines (both produce the same results, within rounding errors)
+# * loop: per-block transform using the 1D DCT/IDCT functions above
+# * batched: whole-frame transform as 2 matrix products against DCT_MATRIX
+DCT_ENGINE_CHOICES = ['batched', 'loop']
+
+
+# DCT basis matrix: DCT_MATRIX[u, x] = Cu/2 cos((2x+1) \pi u / 16)
+# The 2D DCT of an 8x8 block is then `DCT_MATRIX @ block @ DCT_MATRIX.T`,
+# and the 2D IDCT is `DCT_MATRIX.T @ block @ DCT_MATRIX`.
+DCT_MATRIX = np.array([
+    [C[u] / 2 * math.cos((2*x+1) * math.pi * u / 16) for x in range(8)]
+    for u in range(8)])
+
+
+def frame_to_blocks(inp):
+    # convert a wxh matrix (where both w and h are multiples of 8) into
+    # a <numblocks>x8x8 tensor, with the blocks in raster order
+    height, width = inp.shape
+    assert width % 8 == 0, 'width must be a multiple of 8 (%i)' % width
+    assert height % 8 == 0, 'height must be a multiple of 8 (%i)' % height
+    blocks = inp.reshape(height // 8, 8, width // 8, 8).swapaxes(1, 2)
+    return blocks.reshape(-1, 8, 8)
+
+
+def blocks_to_frame(blocks, width, height):
+    # convert a <numblocks>x8x8 tensor (blocks in raster order) back into
+    # a wxh matrix
+    frame = blocks.reshape(height // 8, width // 8, 8, 8).swapaxes(1, 2)
+    return frame.reshape(height, width)
+
+
+# number of 8-pixel block rows transformed at once by the forward DCTs
+# The input plane can be of any numeric type (e.g. a uint8 view of a
+# memory-mapped raw file): the conversion to the working type is done one
+# strip at a time, so the only full-size array is the output.
+DCT_STRIP_BLOCK_ROWS = 8
+
+
+def get_strips(height):
+    # returns the (start, end) rows of each strip of DCT_STRIP_BLOCK_ROWS
+    strip_height = 8 * DCT_STRIP_BLOCK_ROWS
+    return [(row, min(row + strip_height, height)) for row in
+            range(0, height, strip_height)]
+
+
+def get_frame_dct_batched(inp, dtype='float64'):
+    height, width = inp.shape
+    dct_matrix = DCT_MATRIX.astype(dtype)
+    dct = np.empty((height, width), dtype=dtype)
+    for (start, end) in get_strips(height):
+        blocks = frame_to_blocks(inp[start:end].astype(dtype))
+        # perform the horizontal and vertical DCTs of all blocks at once
+        dct[start:end] = blocks_to_frame(dct_matrix @ blocks @ dct_matrix.T,
+                                         width, end - start)
+    return dct
+
+
+def get_frame_idct_batched(inp, dtype='float64'):
     height, width = inp.shape
-    dct = np.zeros((height, width))
+    dct_matrix = DCT_MATRIX.astype(dtype)
+    blocks = frame_to_blocks(inp)
+    # perform the horizontal and vertical IDCTs of all blocks at once
+    idct = dct_matrix.T @ blocks @ dct_matrix
+    idct = blocks_to_frame(idct, width, height)
+    # return integer matrix
+    return idct.round().clip(0, 255).astype('uint8')
+
+
+# fixed-point (integer) DCT/IDCT
+# We use the DCT basis matrix scaled by 2^CONST_BITS, and keep PASS1_BITS
+# extra bits of precision between the 1st and 2nd passes (same approach as
+# libjpeg's jfdctint.c/jidctint.c). All the operations are integer, so the
+# results are bit-exact in every machine. All intermediate values fit in
+# int32 for 8-bit input samples.
+CONST_BITS = 13
+PASS1_BITS = 2
+DCT_MATRIX_INT = np.around(DCT_MATRIX * (1 << CONST_BITS)).astype('int32')
+
+
+def descale(x, n):
+    # right shift by n bits, rounding to the nearest integer
+    return (x + (1 << (n - 1))) >> n
+
+
+def get_frame_dct_int(inp):
+    height, width = inp.shape
+    dct = np.empty((height, width), dtype='int32')
+    for (start, end) in get_strips(height):
+        blocks = frame_to_blocks(inp[start:end].astype('int32'))
+        # perform horizontal DCT
+        tmp = descale(blocks @ DCT_MATRIX_INT.T, CONST_BITS - PASS1_BITS)
+        # perform vertical DCT
+        tmp = descale(DCT_MATRIX_INT @ tmp, CONST_BITS + PASS1_BITS)
+        dct[start:end] = blocks_to_frame(tmp, width, end - start)
+    return dct
+
+
+def get_frame_idct_int(inp):
+    height, width = inp.shape
+    blocks = frame_to_blocks(inp.astype('int32'))
+    # perform vertical IDCT
+    tmp = descale(DCT_MATRIX_INT.T @ blocks, CONST_BITS - PASS1_BITS)
+    # perform horizontal IDCT
+    idct = descale(tmp @ DCT_MATRIX_INT, CONST_BITS + PASS1_BITS)
+    idct = blocks_to_frame(idct, width, height)
+    # return integer matrix
+    return idct.clip(0, 255).astype('uint8')
+
+
+def get_frame_dct_loop(inp, dtype='float64'):
+    height, width = inp.shape
+    dct = np.zeros((height, width), dtype=dtype)
     # break luma in 8x8 blocks
     for i in range(0, height, 8):
         for j in range(0, width, 8):
@@ -94,9 +204,9 @@ def get_frame_dct(inp):
     return dct
 
 
-def get_frame_idct(inp):
+def get_frame_idct_loop(inp, dtype='float64'):
     height, width = inp.shape
-    idct = np.zeros((height, width))
+    idct = np.zeros((height, width), dtype=dtype)
     # break luma in 8x8 blocks
     for i in range(0, height, 8):
         for j in range(0, width, 8):
@@ -106,7 +216,23 @@ def get_frame_idct(inp):
             outblock = get_block_idct(block)
             idct[i:i+8, j:j+8] = outblock
     # return integer matrix
-    return idct.round().astype('uint8')
+    return idct.round().clip(0, 255).astype('uint8')
+
+
+def get_frame_dct(inp, engine='batched', dtype='float64'):
+    if engine == 'batched':
+        return get_frame_dct_batched(inp, dtype)
+    elif engine == 'loop':
+        return get_frame_dct_loop(inp, dtype)
+    raise AssertionError('invalid DCT engine: %s' % engine)
+
+
+def get_frame_idct(inp, engine='batched', dtype='float64'):
+    if engine == 'batched':
+        return get_frame_idct_batched(inp, dtype)
+    elif engine == 'loop':
+        return get_frame_idct_loop(inp, dtype)
+    raise AssertionError('invalid DCT engine: %s' % engine)
 
 
 # returns an 8x8 matrix with the mean of all the values in a DCT matrix
@@ -152,37 +278,105 @@ def read_frame(infile, width, height, framenum=0):
     return frame_data
 
 
-def parse_420_buffer(frame_data, width, height):
+def map_file(infile, offset, size):
+    # memory-map `size` bytes of a file at `offset` (read-only), as a uint8
+    # array. Non-regular files (e.g. pipes) cannot be mapped, and are read
+    # instead
+    if not os.path.isfile(infile):
+        return np.frombuffer(utils.read_as_raw(infile, size, offset),
+                             dtype=np.uint8)
+    assert offset + size <= os.path.getsize(infile), (
+        'cannot read %s in [%i, %i]' % (infile, offset, offset + size))
+    return np.memmap(infile, dtype=np.uint8, mode='r', offset=offset,
+                     shape=(size,))
+
+
+def map_frame(infile, width, height, framenum=0):
+    # memory-map frame `framenum` of a raw 4:2:0 file (read-only)
+    # Nothing is read until the samples are accessed, and the planes
+    # returned by get_420_planes() are views into the mapping.
+    frame_size = int(width * height * 1.5)
+    return map_file(infile, framenum * frame_size, frame_size)
+
+
+def get_420_plane_sizes(width, height):
+    # returns the (width, height) of the luma and chromas of a 4:2:0 frame
+    # of any size (chromas are rounded up for odd sizes)
+    width_c = (width + 1) >> 1
+    height_c = (height + 1) >> 1
+    return (width, height), (width_c, height_c), (width_c, height_c)
+
+
+def map_420_planes(infile, width, height, framenum=0):
+    # memory-map the planes of frame `framenum` of a raw 4:2:0 file of any
+    # size (read-only). See map_frame()
+    sizes = get_420_plane_sizes(width, height)
+    frame_size = sum(plane_width * plane_height for
+                     (plane_width, plane_height) in sizes)
+    frame_data = map_file(infile, framenum * frame_size, frame_size)
+    planes = []
+    offset = 0
+    for plane_width, plane_height in sizes:
+        plane_size = plane_width * plane_height
+        planes.append(frame_data[offset:offset + plane_size].reshape(
+            plane_height, plane_width))
+        offset += plane_size
+    return planes
+
+
+def pad_plane(plane, width, height):
+    # pad a plane to `width`x`height` by replicating its last column and row
+    plane_height, plane_width = plane.shape
+    return np.pad(plane, ((0, height - plane_height),
+                          (0, width - plane_width)), mode='edge')
+
+
+def get_420_planes(frame_data, width, height):
+    # returns uint8 views (no copies) of the luma and chromas in a 4:2:0
+    # buffer (any object supporting the buffer protocol)
     # calculate 4:2:0 parameters
     width_y = width
     height_y = height
     width_c = width_y >> 1
     height_c = height_y >> 1
+    size_y = width_y * height_y
+    size_c = width_c * height_c
     # read luma and chromas
-    y = np.frombuffer(frame_data[:(width_y * height_y)], dtype=np.uint8)
+    y = np.frombuffer(frame_data, dtype=np.uint8, count=size_y)
     y.shape = (height_y, width_y)
-    y = y.astype('float64')
-    u = np.frombuffer(frame_data[(width_y * height_y):
-                                 int(width_y * height_y * 1.25)],
-                      dtype=np.uint8)
+    u = np.frombuffer(frame_data, dtype=np.uint8, count=size_c,
+                      offset=size_y)
     u.shape = (height_c, width_c)
-    u = u.astype('float64')
-    v = np.frombuffer(frame_data[int(width_y * height_y * 1.25):],
-                      dtype=np.uint8)
+    v = np.frombuffer(frame_data, dtype=np.uint8, count=size_c,
+                      offset=size_y + size_c)
     v.shape = (height_c, width_c)
-    v = v.astype('float64')
     return y, u, v
 
 
-def dump_420_buffer(y, u, v):
-    buf = b''
-    # dump luma and chromas
-    buf += y.tostring()
-    if u is not None:
-        buf += u.tostring()
-    if v is not None:
-        buf += v.tostring()
-    return buf
+def parse_420_buffer(frame_data, width, height, dtype='float64'):
+    y, u, v = get_420_planes(frame_data, width, height)
+    return y.astype(dtype), u.astype(dtype), v.astype(dtype)
+
+
+# BT.601 (limited range) YCbCr to RGB conversion matrix
+YUV_TO_RGB_MATRIX = np.array([
+    [255 / 219, 0, 255 / 112 * 0.701],
+    [255 / 219, -255 / 112 * 0.886 * 0.114 / 0.587,
+     -255 / 112 * 0.701 * 0.299 / 0.587],
+    [255 / 219, 255 / 112 * 0.886, 0],
+])
+
+
+def get_rgb_from_420(y, u, v):
+    # convert a 4:2:0 frame into a heightxwidthx3 uint8 (rgb) matrix
+    # upsample the chromas (nearest neighbour), cropping them for odd sizes
+    height, width = y.shape
+    u = u.repeat(2, axis=0).repeat(2, axis=1)[:height, :width]
+    v = v.repeat(2, axis=0).repeat(2, axis=1)[:height, :width]
+    yuv = np.stack((y, u, v), axis=-1).astype('float32')
+    yuv -= np.array([16, 128, 128], dtype='float32')
+    rgb = yuv @ YUV_TO_RGB_MATRIX.T.astype('float32')
+    return np.around(rgb).clip(0, 255).astype(np.uint8)
 
 
 def process_file(options):
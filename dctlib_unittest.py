@@ -4,8 +4,12 @@
 
 
 import numpy as np
+import os
+import tempfile
+import threading
 
 import dctlib
+import utils
 
 import unittest
 
@@ -43,6 +47,93 @@ class MyTest(unittest.TestCase):
         out = dctlib.get_block_dct(inp)
         self.assertTrue(compare_array(expected_out, out, 1.))
 
+    def testFrameDctBatched(self):
+        """A test comparing the batched and loop frame DCT engines."""
+        rng = np.random.default_rng(0)
+        inp = rng.integers(0, 256, size=(32, 48)).astype('float64')
+        dct_loop = dctlib.get_frame_dct(inp, 'loop')
+        dct_batched = dctlib.get_frame_dct(inp, 'batched')
+        self.assertTrue(compare_array(dct_loop, dct_batched, 1.))
+        # the batched engine must not mix up blocks
+        self.assertTrue(compare_array(
+            dct_batched[8:16, 40:48],
+            dctlib.get_block_dct(inp[8:16, 40:48]), 1.))
+        idct_loop = dctlib.get_frame_idct(dct_loop, 'loop')
+        idct_batched = dctlib.get_frame_idct(dct_batched, 'batched')
+        self.assertTrue(compare_array(idct_loop.astype('int'),
+                                      idct_batched.astype('int'), 2))
+        self.assertTrue(compare_array(inp, idct_batched.astype('float64'),
+                                      1.))
+
+    def testFrameIdctSaturation(self):
+        """A test for the saturation of the (float) IDCT output."""
+        # blocks whose IDCT overshoots 255 and undershoots 0
+        inp = np.hstack((np.full((8, 8), 300.), np.full((8, 8), -40.),
+                         np.add.outer(np.arange(8), np.arange(8)) * 50. - 100))
+        expected = inp.round().clip(0, 255)
+        for engine in ('loop', 'batched'):
+            out = dctlib.get_frame_idct(dctlib.get_frame_dct(inp, engine),
+                                        engine)
+            self.assertEqual(out.dtype, np.uint8)
+            self.assertTrue(compare_array(out.astype('float64'), expected,
+                                          1.))
+            self.assertEqual(out[0, 0], 255)
+            self.assertEqual(out[0, 8], 0)
+
+    def testFrameDctInt(self):
+        """A test comparing the fixed-point and float frame DCTs."""
+        rng = np.random.default_rng(0)
+        inp = rng.integers(0, 256, size=(32, 48)).astype('int16')
+        dct_float = dctlib.get_frame_dct(inp.astype('float64'))
+        dct_int = dctlib.get_frame_dct_int(inp)
+        self.assertTrue(np.issubdtype(dct_int.dtype, np.integer))
+        self.assertTrue(compare_array(dct_float, dct_int, 1.))
+        idct_int = dctlib.get_frame_idct_int(dct_int)
+        self.assertEqual(idct_int.dtype, np.uint8)
+        self.assertTrue(compare_array(inp, idct_int.astype('int16'), 2))
+        # the IDCT must clip its output to the 8-bit range
+        dct_int[0, 0] += 4000
+        idct_int = dctlib.get_frame_idct_int(dct_int)
+        self.assertEqual(idct_int[:8, :8].min(), 255)
+
+    def testFrameDctStrips(self):
+        """A test for the strip-based conversion of uint8 planes."""
+        rng = np.random.default_rng(0)
+        # use several strips, including a partial one
+        height = 8 * (2 * dctlib.DCT_STRIP_BLOCK_ROWS + 3)
+        inp = rng.integers(0, 256, size=(height, 48)).astype('uint8')
+        self.assertTrue((dctlib.get_frame_dct(inp) ==
+                         dctlib.get_frame_dct(inp.astype('float64'))).all())
+        self.assertTrue((dctlib.get_frame_dct_int(inp) ==
+                         dctlib.get_frame_dct_int(inp.astype('int16'))).all())
+
+    def testMapFrame(self):
+        """A test for the memory-mapped raw input."""
+        width, height = 16, 8
+        frame_size = width * height * 3 // 2
+        data = np.arange(3 * frame_size, dtype='uint32').astype('uint8')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            infile = os.path.join(tmpdir, 'in.yuv')
+            data.tofile(infile)
+            frame = dctlib.map_frame(infile, width, height, 2)
+            y, u, v = dctlib.get_420_planes(frame, width, height)
+            self.assertEqual(y.shape, (height, width))
+            self.assertEqual(v.shape, (height // 2, width // 2))
+            self.assertTrue((v.ravel() ==
+                             data[3 * frame_size - v.size:]).all())
+            del frame, y, u, v
+            with self.assertRaises(AssertionError):
+                dctlib.map_frame(infile, width, height, 3)
+            # pipes are read instead of mapped
+            fifo = os.path.join(tmpdir, 'in.fifo')
+            os.mkfifo(fifo)
+            writer = threading.Thread(target=utils.write_as_raw, args=(
+                data[:frame_size].tobytes(), fifo))
+            writer.start()
+            frame = dctlib.map_frame(fifo, width, height)
+            writer.join()
+            self.assertTrue((frame == data[:frame_size]).all())
+
 
 def compare_array(a1, a2, max_error):
     assert a1.shape == a2.shape
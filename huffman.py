@@ -4,6 +4,7 @@
 
 
 import argparse
+import heapq
 import sys
 
 
@@ -46,71 +47,117 @@ def get_options(argv):
     return options
 
 
-# adapted from
-# https://www.section.io/engineering-education/huffman-coding-python/
 class HuffmanCode:
-    def __init__(self, prob_distribution):
+    """Canonical Huffman code for a probability distribution.
+
+    Code lengths are computed using a heap (O(n log n)), and optionally
+    limited to `max_length` bits. Codes are then assigned canonically:
+    symbols are sorted by (code length, position in the distribution),
+    and each one gets the next binary value of its length. This means that
+    the code lengths and the sorted symbol order (`canonical_symbols`)
+    fully describe the table.
+    """
+
+    def __init__(self, prob_distribution, max_length=None):
         self.symbols = [symbol for (symbol, _) in prob_distribution]
         self.probability = [prob for (_, prob) in prob_distribution]
+        self.max_length = max_length
+        self.lengths = self.compute_lengths()
         self.table = self.compute_table()
 
-    def position(self, value, index):
-        for j in range(len(self.probability)):
-            if (value >= self.probability[j]):
-                return j
-        return index - 1
+    def compute_lengths(self):
+        num = len(self.probability)
+        if num == 1:
+            # a single symbol still needs a (1-bit) code
+            return [1]
+        # merge the 2 least probable nodes until there is only one left.
+        # Heap entries are (probability, node) tuples: Leaf nodes are the
+        # symbol indices, and internal nodes get consecutive numbers after
+        # them. Using the node number to break ties makes the result
+        # deterministic.
+        heap = [(prob, i) for (i, prob) in enumerate(self.probability)]
+        heapq.heapify(heap)
+        parent = [0] * (2 * num - 1)
+        node = num
+        while len(heap) > 1:
+            prob1, node1 = heapq.heappop(heap)
+            prob2, node2 = heap[0]
+            parent[node1] = parent[node2] = node
+            heapq.heapreplace(heap, (prob1 + prob2, node))
+            node += 1
+        # parents always have larger numbers than their children, so we can
+        # get the depth of every node by walking them backwards from the
+        # root (the last node)
+        depth = [0] * node
+        for i in range(node - 2, -1, -1):
+            depth[i] = depth[parent[i]] + 1
+        # give the shortest codes to the most probable symbols (when
+        # several symbols have the same probability, the heap order is
+        # arbitrary)
+        lengths = [0] * num
+        order = sorted(range(num), key=lambda i: (-self.probability[i], i))
+        for i, length in zip(order, sorted(depth[:num])):
+            lengths[i] = length
+        if self.max_length is not None and max(lengths) > self.max_length:
+            lengths = limit_lengths(lengths, self.max_length)
+        return lengths
 
     def compute_table(self):
         num = len(self.probability)
-        hcode = [''] * num
-        for i in range(num - 2):
-            val = self.probability[num - i - 1] + self.probability[num - i - 2]
-            if (hcode[num - i - 1] != '' and hcode[num - i - 2] != ''):
-                hcode[-1] = ['1' + symbol for symbol in hcode[-1]]
-                hcode[-2] = ['0' + symbol for symbol in hcode[-2]]
-            elif (hcode[num - i - 1] != ''):
-                hcode[num - i - 2] = '0'
-                hcode[-1] = ['1' + symbol for symbol in hcode[-1]]
-            elif (hcode[num - i - 2] != ''):
-                hcode[num - i - 1] = '1'
-                hcode[-2] = ['0' + symbol for symbol in hcode[-2]]
-            else:
-                hcode[num - i - 1] = '1'
-                hcode[num - i - 2] = '0'
-            position = self.position(val, i)
-            probability = self.probability[0:(len(self.probability) - 2)]
-            probability.insert(position, val)
-            if (isinstance(hcode[num - i - 2], list) and
-                    isinstance(hcode[num - i - 1], list)):
-                complete_code = (hcode[num - i - 1] + hcode[num - i - 2])
-            elif (isinstance(hcode[num - i - 2], list)):
-                complete_code = (hcode[num - i - 2] + [hcode[num - i - 1]])
-            elif (isinstance(hcode[num - i - 1], list)):
-                complete_code = (hcode[num - i - 1] + [hcode[num - i - 2]])
-            else:
-                complete_code = [hcode[num - i - 2], hcode[num - i - 1]]
-            hcode = hcode[0:(len(hcode) - 2)]
-            hcode.insert(position, complete_code)
-        hcode[0] = ['0' + symbol for symbol in hcode[0]]
-        hcode[1] = ['1' + symbol for symbol in hcode[1]]
-        if (len(hcode[0]) == 0):
-            hcode[0] = '0'
-        if (len(hcode[1]) == 0):
-            hcode[1] = '1'
-        # xxx
-        final_code = [''] * num
-        count = 0
-        for i in range(2):
-            for j in range(len(hcode[i])):
-                final_code[count] = hcode[i][j]
-                count += 1
-        final_code = sorted(final_code, key=len)
+        # sort symbols by (code length, position in the distribution)
+        order = sorted(range(num), key=lambda i: (self.lengths[i], i))
+        self.canonical_symbols = [self.symbols[i] for i in order]
+        # assign consecutive codes, appending zeroes when the length grows
+        codes = [''] * num
+        code = 0
+        prev_length = self.lengths[order[0]]
+        for i in order:
+            length = self.lengths[i]
+            code <<= (length - prev_length)
+            codes[i] = format(code, '0%ib' % length)
+            code += 1
+            prev_length = length
         # create table
         table = {symbol: code for (symbol, code) in
-                 zip(self.symbols, final_code)}
+                 zip(self.symbols, codes)}
         return table
 
 
+def limit_lengths(lengths, max_length):
+    # limit the code lengths to max_length, using the algorithm in the JPEG
+    # spec (ITU T.81, Annex K.3, Figure K.3, "Adjust_BITS")
+    num = len(lengths)
+    assert (1 << max_length) >= num, (
+        'cannot fit %i symbols in %i bits' % (num, max_length))
+    # get the number of codes of each length
+    bits = [0] * (max(lengths) + 1)
+    for length in lengths:
+        bits[length] += 1
+    for i in range(len(bits) - 1, max_length, -1):
+        while bits[i] > 0:
+            # move 2 codes of length i: one goes to i - 1 (its sibling
+            # becomes its parent), the other is the sibling of a code made
+            # 1 bit longer (from length j to j + 1)
+            j = i - 2
+            while bits[j] == 0:
+                j -= 1
+            bits[i] -= 2
+            bits[i - 1] += 1
+            bits[j + 1] += 2
+            bits[j] -= 1
+    # assign the new lengths, shortest codes to the (originally) shortest
+    # codes
+    order = sorted(range(num), key=lambda i: (lengths[i], i))
+    new_lengths = [0] * num
+    length = 1
+    for i in order:
+        while bits[length] == 0:
+            length += 1
+        new_lengths[i] = length
+        bits[length] -= 1
+    return new_lengths
+
+
 def do_something(options):
     string = options.string
 
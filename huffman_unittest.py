@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""huffman."""
+
+
+import numpy as np
+
+import huffman
+
+import unittest
+
+
+class MyTest(unittest.TestCase):
+
+    def testHuffmanCode(self):
+        """A test for the canonical huffman code."""
+        prob_distribution = [('a', 0.4), ('b', 0.3), ('c', 0.2),
+                             ('d', 0.05), ('e', 0.05)]
+        huffman_code = huffman.HuffmanCode(prob_distribution)
+        self.assertEqual(huffman_code.lengths, [1, 2, 3, 4, 4])
+        self.assertEqual(huffman_code.table, {
+            'a': '0', 'b': '10', 'c': '110', 'd': '1110', 'e': '1111'})
+        self.assertEqual(huffman_code.canonical_symbols,
+                         ['a', 'b', 'c', 'd', 'e'])
+
+    def testHuffmanCodeSingleSymbol(self):
+        """A test for a single-symbol huffman code."""
+        huffman_code = huffman.HuffmanCode([('a', 1.0)])
+        self.assertEqual(huffman_code.table, {'a': '0'})
+
+    def testHuffmanCodeMaxLength(self):
+        """A test for the length-limited huffman code."""
+        # a fibonacci distribution produces the longest possible codes
+        fib = [1, 1]
+        while len(fib) < 20:
+            fib.append(fib[-1] + fib[-2])
+        prob_distribution = [(i, f) for (i, f) in enumerate(reversed(fib))]
+        huffman_code = huffman.HuffmanCode(prob_distribution)
+        self.assertEqual(max(huffman_code.lengths), 19)
+        huffman_code = huffman.HuffmanCode(prob_distribution, max_length=8)
+        self.assertEqual(max(huffman_code.lengths), 8)
+        check_prefix_code(self, huffman_code.table)
+
+    def testHuffmanCodeLarge(self):
+        """A test for a large huffman code."""
+        rng = np.random.default_rng(0)
+        freqs = rng.zipf(1.5, size=100000)
+        prob_distribution = list(enumerate(freqs.tolist()))
+        huffman_code = huffman.HuffmanCode(prob_distribution, max_length=24)
+        self.assertLessEqual(max(huffman_code.lengths), 24)
+        check_prefix_code(self, huffman_code.table)
+
+
+def check_prefix_code(test, table):
+    # a complete prefix code must fulfill the Kraft equality
+    test.assertEqual(sum(2 ** -len(code) for code in table.values()), 1)
+    # and no code is a prefix of the next one in sorted order
+    codes = sorted(table.values())
+    for code1, code2 in zip(codes[:-1], codes[1:]):
+        test.assertFalse(code2.startswith(code1))
+
+
+if __name__ == '__main__':
+    unittest.main()
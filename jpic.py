@@ -3,21 +3,48 @@
 """dctlib."""
 
 import argparse
-import bitstring
-import math
+import concurrent.futures
+import io
+from multiprocessing import shared_memory
+import numpy as np
+import os
 import struct
 import sys
+import tempfile
+import time
 
 
 import dctlib
 import jpiclib
+import metrics
+import statslib
+import tableslib
+import tlvlib
 import utils
 
 
-FUNCTION_CHOICES = ['encode', 'decode', 'parse']
+FUNCTION_CHOICES = ['encode', 'decode', 'parse', 'compare', 'sweep',
+                    'estimate', 'train-tables']
+# dct: floating-point DCT/IDCT
+# idct-int: fixed-point DCT/IDCT (bit-exact decoding)
+TRANSFORM_CHOICES = ['dct', 'idct-int']
+# basic: DC coded as int16, AC coded using RLE and huffman coding
+# dcpm: DC coded as the (huffman-coded) delta from the previous block
+ENCODING_CHOICES = ['basic', 'dcpm']
 QUANTIZATION_CHOICES = (['lossless', ] +
                         ['jpeg-%i' % i for i in range(32)] +
                         ['uniform-%i' % i for i in range(32)])
+QTYPE_CHOICES = ['jpeg', 'uniform', 'lossless']
+# columns of the sweep CSV output (the same ones as in the `*.sh` scripts)
+SWEEP_CSV_COLUMNS = ['qp', 'encode', 'decode', 'size', 'psnr', 'ssim']
+
+# chunk tags of the encoding table and bits of each plane
+PLANE_NAMES = ('y', 'u', 'v')
+TABLE_TAGS = (b'ytbl', b'utbl', b'vtbl')
+PLANE_TAGS = (b'plny', b'plnu', b'plnv')
+# columns of the estimate CSV output (sizes in bytes)
+ESTIMATE_CSV_COLUMNS = (['qp', 'quantization', 'size', 'jpic', 'desc'] +
+                        [tag.decode() for tag in TABLE_TAGS + PLANE_TAGS])
 
 
 default_values = {
@@ -25,319 +52,1031 @@ default_values = {
     'width': 720,
     'height': 480,
     'framenum': 0,
+    'num_frames': 1,
     'dump_input': None,
     'dump_pgm': None,
+    'dump_ppm': None,
     'quantization': 'lossless',
+    'transform': 'dct',
+    'encoding': 'basic',
+    'dct_engine': 'batched',
+    'jobs': 1,
+    'restart_interval': 0,
+    'precision': 'double',
+    'stats': None,
+    'stats_memory': False,
+    'qtype': 'jpeg',
+    'qps': '1-31',
+    'target_size': None,
+    'target_bpp': None,
+    'table_id': 0,
+    'strips': False,
     'function': 'encode',
     'infile': None,
     'outfile': None,
 }
 
 
-def encode_file(frame_data, width, height, quantization):
-    # convert into numpy arrays
-    y, u, v = dctlib.parse_420_buffer(frame_data, width, height)
+def transform_plane(plane, transform, dct_engine, dtype='float64'):
+    if transform == 'dct':
+        return dctlib.get_frame_dct(plane, dct_engine, dtype)
+    elif transform == 'idct-int':
+        return dctlib.get_frame_dct_int(plane)
+    raise AssertionError('invalid transform: %s' % transform)
 
-    description = ''
-    description += 'color: yuv\n'
-    description += 'width: %i\n' % width
-    description += 'height: %i\n' % height
 
+def transform_plane_rev(plane, transform, dct_engine, dtype='float64'):
+    if transform == 'dct':
+        return dctlib.get_frame_idct(plane, dct_engine, dtype)
+    elif transform == 'idct-int':
+        return dctlib.get_frame_idct_int(plane)
+    raise AssertionError('invalid transform: %s' % transform)
+
+
+def encode_plane(plane, quantization, luma, transform, encoding,
+                 dct_engine, restart_interval=0,
+                 precision=default_values['precision'],
+                 table_id=default_values['table_id'],
+                 stats=statslib.NULL_STATS):
+    float_dtype, _ = jpiclib.get_precision_dtypes(precision)
     # 1. DCT transform
-    y_dct = dctlib.get_frame_dct(y)
-    u_dct = dctlib.get_frame_dct(u)
-    v_dct = dctlib.get_frame_dct(v)
-    description += 'transform: dct\n'
+    with stats.stage('transform'):
+        plane_dct = transform_plane(plane, transform, dct_engine,
+                                    float_dtype)
+    return encode_plane_dct(plane_dct, quantization, luma, encoding,
+                            restart_interval, precision, table_id, stats)
 
-    # 2. quantization
-    y_dct_q = jpiclib.quantization(y_dct, quantization, luma=True)
-    u_dct_q = jpiclib.quantization(u_dct, quantization, luma=False)
-    v_dct_q = jpiclib.quantization(v_dct, quantization, luma=False)
-    description += 'quantization: %s\n' % quantization
 
+def quantize_plane(plane_dct, quantization, luma,
+                   precision=default_values['precision'],
+                   stats=statslib.NULL_STATS):
+    _, coeff_dtype = jpiclib.get_precision_dtypes(precision)
+    # 2. quantization
+    with stats.stage('quantization'):
+        plane_dct_q = jpiclib.quantization(plane_dct, quantization,
+                                           coeff_dtype, luma=luma)
     # 3. zig-zag scan
-    y_dct_q_z = jpiclib.zigzag_scan(y_dct_q)
-    u_dct_q_z = jpiclib.zigzag_scan(u_dct_q)
-    v_dct_q_z = jpiclib.zigzag_scan(v_dct_q)
-    description += 'zigzag: basic\n'
+    with stats.stage('zigzag'):
+        return jpiclib.zigzag_scan(plane_dct_q)
 
+
+def get_slice_blocks(plane, restart_interval):
+    # returns the number of blocks of each slice (0 for no slices)
+    _, width = plane.shape
+    return restart_interval * (width // 8)
+
+
+def encode_plane_dct(plane_dct, quantization, luma, encoding,
+                     restart_interval=0,
+                     precision=default_values['precision'],
+                     table_id=default_values['table_id'],
+                     stats=statslib.NULL_STATS):
+    # encode an already-transformed plane (the input is not modified, so
+    # it can be reused for several quantizations)
+    # returns the serialized encoding table (None when using static
+    # tables), and the encoded plane and its length in bits
+    # 2-3. quantization and zig-zag scan
+    plane_dct_q_z = quantize_plane(plane_dct, quantization, luma, precision,
+                                   stats)
     # 4. huffman coding and RLE
-    # jpiclib.dc00_as_delta(y_dct_q_z)
-    y_enc_table = jpiclib.get_encoding_table(y_dct_q_z)
-    y_enc_bits = jpiclib.encode(y_dct_q_z, y_enc_table)
-    u_enc_table = jpiclib.get_encoding_table(u_dct_q_z)
-    u_enc_bits = jpiclib.encode(u_dct_q_z, u_enc_table)
-    v_enc_table = jpiclib.get_encoding_table(v_dct_q_z)
-    v_enc_bits = jpiclib.encode(v_dct_q_z, v_enc_table)
-    description += 'encoding: basic\n'
+    slice_blocks = get_slice_blocks(plane_dct, restart_interval)
+    with stats.stage('table'):
+        if table_id:
+            # static tables need no histogram or table construction
+            enc_table = tableslib.get_encoding_table(table_id, luma)
+        else:
+            enc_table = jpiclib.get_encoding_table(plane_dct_q_z, encoding,
+                                                   slice_blocks)
+    if restart_interval:
+        # encode each slice (`restart_interval` block rows) independently
+        with stats.stage('entropy'):
+            numblocks, _ = plane_dct_q_z.shape
+            slices = [jpiclib.encode(plane_dct_q_z[i:i + slice_blocks],
+                                     enc_table, encoding) for i in
+                      range(0, numblocks, slice_blocks)]
+            enc_bin = jpiclib.serialize_slices(slices)
+            enc_bitlen = len(enc_bin) * 8
+        bits = sum(slice_bitlen for (_, slice_bitlen) in slices)
+    else:
+        with stats.stage('entropy'):
+            enc_bin, enc_bitlen = jpiclib.encode(plane_dct_q_z, enc_table,
+                                                 encoding)
+        bits = enc_bitlen
+    enc_table_bin = None
+    if not table_id:
+        with stats.stage('table'):
+            enc_table_bin = jpiclib.serialize_encoding_table(enc_table)
+    if stats.enabled:
+        count_plane_stats(stats, plane_dct_q_z, enc_table, encoding,
+                          slice_blocks, bits,
+                          len(enc_table_bin or b'') * 8)
+    return enc_table_bin, enc_bin, enc_bitlen
+
+
+def count_plane_stats(stats, plane_dct_q_z, enc_table, encoding,
+                      restart_blocks, bits, table_bits):
+    code_stats = jpiclib.get_code_stats(plane_dct_q_z, enc_table, encoding,
+                                        restart_blocks)
+    for name, value in code_stats.items():
+        stats.count(name, value)
+    stats.count('bits', bits)
+    stats.count('table_bits', table_bits)
+
+
+def encode_plane_shm(shm_name, width, height, index, *args, stats):
+    # encode plane `index` of the 4:2:0 frame in shared memory `shm_name`
+    # returns the encode_plane() results, and the (updated) stats
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        # copy the (uint8) plane out of the shared memory
+        plane = np.array(dctlib.get_420_planes(shm.buf, width, height)[index])
+    finally:
+        shm.close()
+    return encode_plane(plane, *args, stats=stats), stats
+
+
+def decode_plane(enc_table_bin, enc_bin, enc_bitlen, width, height,
+                 quantization, luma, transform, encoding, dct_engine,
+                 precision=default_values['precision'],
+                 table_id=default_values['table_id'],
+                 stats=statslib.NULL_STATS):
+    # enc_table_bin is ignored when using static tables (table_id)
+    float_dtype, coeff_dtype = jpiclib.get_precision_dtypes(precision)
+    # 1. huffman coding and RLE
+    with stats.stage('table'):
+        if table_id:
+            dec_table = tableslib.get_decoding_table(table_id, luma)
+        else:
+            dec_table = jpiclib.unserialize_decoding_table(enc_table_bin)
+    with stats.stage('entropy'):
+        plane_dct_q_z = jpiclib.decode(enc_bin, enc_bitlen, width, height,
+                                       dec_table, encoding, coeff_dtype)
+    if stats.enabled and table_id:
+        count_plane_stats(
+            stats, plane_dct_q_z,
+            tableslib.get_encoding_table(table_id, luma), encoding, 0,
+            enc_bitlen, 0)
+    elif stats.enabled:
+        count_plane_stats(
+            stats, plane_dct_q_z,
+            jpiclib.unserialize_encoding_table(enc_table_bin), encoding, 0,
+            enc_bitlen, len(enc_table_bin) * 8)
+    # 2. un-zig-zag scan
+    with stats.stage('zigzag'):
+        plane_dct_q = jpiclib.zigzag_unscan(plane_dct_q_z, width, height)
+    # 3. reverse quantization
+    with stats.stage('quantization'):
+        plane_dct = jpiclib.quantization_rev(plane_dct_q, quantization,
+                                             coeff_dtype, luma=luma)
+    # 4. IDCT transform
+    with stats.stage('transform'):
+        return transform_plane_rev(plane_dct, transform, dct_engine,
+                                   float_dtype)
+
+
+def decode_slice(*args, stats=statslib.NULL_STATS):
+    # decode a slice, replacing it with a gray one if it is corrupt, or
+    # unusable (None data, see jpiclib.unserialize_slices()), so that the
+    # rest of the frame can still be decoded
+    width, height = args[3], args[4]
+    if args[1] is None:
+        error = 'invalid slice index'
+    else:
+        try:
+            return decode_plane(*args, stats=stats)
+        except (AssertionError, IndexError, ValueError, OverflowError,
+                struct.error) as e:
+            error = e
+    print('error: corrupt slice (%s)' % error, file=sys.stderr)
+    return np.full((height, width), 128, dtype=np.uint8)
+
+
+def decode_plane_shm(shm_name, frame_width, frame_height, index, row,
+                     func, *args, stats):
+    # decode a plane (or slice) using func, and write it into plane `index`
+    # of the 4:2:0 frame in shared memory `shm_name`, starting at `row`
+    # returns the (updated) stats
+    plane = func(*args, stats=stats)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        height, _ = plane.shape
+        dctlib.get_420_planes(shm.buf, frame_width, frame_height)[
+            index][row:row + height] = plane
+    finally:
+        shm.close()
+    return stats
+
+
+def run_plane_jobs(func, args_list, jobs, stats_list):
+    # run func(*args, stats=stats) for each of the planes in a process pool
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(jobs, len(args_list))) as executor:
+        futures = [executor.submit(func, *args, stats=stats) for
+                   (args, stats) in zip(args_list, stats_list)]
+        return [future.result() for future in futures]
+
+
+def encode_file(frame_data, width, height, quantization, *args,
+                **kwargs):
+    # returns the jpic file as a bytes object (see encode_stream())
+    fout = io.BytesIO()
+    encode_stream(fout, frame_data, width, height, quantization, *args,
+                  **kwargs)
+    return fout.getvalue()
+
+
+def encode_stream(fout, frame_data, width, height, quantization,
+                  transform=default_values['transform'],
+                  encoding=default_values['encoding'],
+                  dct_engine=default_values['dct_engine'],
+                  jobs=default_values['jobs'],
+                  restart_interval=default_values['restart_interval'],
+                  precision=default_values['precision'],
+                  table_id=default_values['table_id'],
+                  stats=statslib.NULL_STATS):
+    # 1-4. encode each plane (luma and chromas are independent)
+    plane_args = [(quantization, luma, transform, encoding, dct_engine,
+                   restart_interval, precision, table_id)
+                  for luma in (True, False, False)]
+    plane_stats = [stats.new() for _ in PLANE_NAMES]
+    if jobs > 1:
+        # pass the frame to the workers using shared memory
+        frame_size = int(width * height * 1.5)
+        shm = shared_memory.SharedMemory(create=True, size=frame_size)
+        try:
+            shm.buf[:frame_size] = frame_data[:frame_size]
+            results = run_plane_jobs(
+                encode_plane_shm,
+                [(shm.name, width, height, index) + args for (index, args) in
+                 enumerate(plane_args)],
+                jobs, plane_stats)
+        finally:
+            shm.close()
+            shm.unlink()
+        results, plane_stats = zip(*results)
+    else:
+        # the transforms take the uint8 planes (no copies), and convert
+        # them one strip at a time
+        planes = dctlib.get_420_planes(frame_data, width, height)
+        results = [encode_plane(plane, *args, stats=pstats) for
+                   (plane, args, pstats) in
+                   zip(planes, plane_args, plane_stats)]
+    for name, pstats in zip(PLANE_NAMES, plane_stats):
+        stats.merge(pstats, name + '.')
 
     # 5. put everything together using a TLV approach (L in bits)
-    out = b''
+    with stats.stage('container'):
+        description = get_description(width, height, quantization,
+                                      transform, encoding, restart_interval,
+                                      table_id)
+        write_container(fout, description, results)
+
+
+def get_description(width, height, quantization, transform, encoding,
+                    restart_interval, table_id=default_values['table_id']):
+    description = ''
+    description += 'color: yuv\n'
+    description += 'width: %i\n' % width
+    description += 'height: %i\n' % height
+    description += 'transform: %s\n' % transform
+    description += 'quantization: %s\n' % quantization
+    description += 'zigzag: basic\n'
+    description += 'encoding: %s\n' % encoding
+    if restart_interval:
+        description += 'restart: %i\n' % restart_interval
+    if table_id:
+        description += 'tables: %i\n' % table_id
+    return description
+
+
+def write_container(fout, description, results):
+    # results is the list of encode_plane() results of each plane
     # 5.1. header
-    out += b'jpic'
+    tlvlib.write_magic(fout, b'jpic')
     # 5.2. description
-    out += b'desc'
-    description_bitlen = len(description) * 8
-    out += struct.pack('=l', description_bitlen)
-    out += str.encode(description)
-
-    # 5.3. encoding table
-    # serialize encoding table(s)
-    # y
-    out += b'ytbl'
-    y_enc_table_bin = jpiclib.serialize_encoding_table(y_enc_table)
-    y_enc_table_bitlen = len(y_enc_table_bin) * 8
-    out += struct.pack('=l', y_enc_table_bitlen)
-    out += y_enc_table_bin
-    # u
-    out += b'utbl'
-    u_enc_table_bin = jpiclib.serialize_encoding_table(u_enc_table)
-    u_enc_table_bitlen = len(u_enc_table_bin) * 8
-    out += struct.pack('=l', u_enc_table_bitlen)
-    out += u_enc_table_bin
-    # v
-    out += b'vtbl'
-    v_enc_table_bin = jpiclib.serialize_encoding_table(v_enc_table)
-    v_enc_table_bitlen = len(v_enc_table_bin) * 8
-    out += struct.pack('=l', v_enc_table_bitlen)
-    out += v_enc_table_bin
-
-    # 5.4. encoding luma
-    # BitArray's return their length already in bits
-    out += b'plny'
-    y_enc_bitlen = len(y_enc_bits)
-    out += struct.pack('=l', y_enc_bitlen)
-    out += y_enc_bits.tobytes()
-    out += b'plnu'
-    u_enc_bitlen = len(u_enc_bits)
-    out += struct.pack('=l', u_enc_bitlen)
-    out += u_enc_bits.tobytes()
-    out += b'plnv'
-    v_enc_bitlen = len(v_enc_bits)
-    out += struct.pack('=l', v_enc_bitlen)
-    out += v_enc_bits.tobytes()
+    tlvlib.write_chunk(fout, b'desc', str.encode(description))
+    # 5.3. encoding tables (not when using static tables)
+    for tag, (enc_table_bin, _, _) in zip(TABLE_TAGS, results):
+        if enc_table_bin is not None:
+            tlvlib.write_chunk(fout, tag, enc_table_bin)
+    # 5.4. encoding bits
+    for tag, (_, enc_bin, enc_bitlen) in zip(PLANE_TAGS, results):
+        tlvlib.write_chunk(fout, tag, enc_bin, enc_bitlen)
 
-    return out
 
+def estimate_plane_dct(plane_dct, quantization, luma, encoding,
+                       restart_interval=0,
+                       precision=default_values['precision'],
+                       table_id=default_values['table_id']):
+    # returns the exact (table, plane) chunk sizes (in bits) of an
+    # already-transformed plane, without encoding it (the table size is
+    # None when using static tables)
+    plane_dct_q_z = quantize_plane(plane_dct, quantization, luma, precision)
+    enc_table = (tableslib.get_encoding_table(table_id, luma) if table_id
+                 else None)
+    return jpiclib.get_encoded_bitlens(
+        plane_dct_q_z, encoding,
+        get_slice_blocks(plane_dct, restart_interval), enc_table)
 
-def decode_file(bstring):
-    # 1. parse the jpic file (TLV approach, with L in bits)
-    i = 0
-    # 1.1. header
-    header = bstring[i:i + 4]
-    i += 4
-    assert header == b'jpic', 'non-jpic file: no jpic'
-
-    # 1.2. description
-    tag = bstring[i:i + 4]
-    i += 4
-    assert tag == b'desc', 'invalid jpic file: no desc'
-    description_bitlen = struct.unpack('=l', bstring[i:i + 4])[0]
-    i += 4
-    description_len = description_bitlen >> 3
-    description_bits = bstring[i:i + description_len]
-    i += description_len
-
-    # 1.3. encoding table
-    # y
-    tag = bstring[i:i + 4]
-    i += 4
-    assert tag == b'ytbl', 'invalid jpic file: no ytbl'
-    y_enc_table_bitlen = struct.unpack('=l', bstring[i:i + 4])[0]
-    i += 4
-    y_enc_table_len = y_enc_table_bitlen >> 3
-    y_enc_table_bin = bstring[i:i + y_enc_table_len]
-    i += y_enc_table_len
-    y_enc_table = jpiclib.unserialize_encoding_table(y_enc_table_bin)
-    # u
-    tag = bstring[i:i + 4]
-    i += 4
-    assert tag == b'utbl', 'invalid jpic file: no utbl'
-    u_enc_table_bitlen = struct.unpack('=l', bstring[i:i + 4])[0]
-    i += 4
-    u_enc_table_len = u_enc_table_bitlen >> 3
-    u_enc_table_bin = bstring[i:i + u_enc_table_len]
-    i += u_enc_table_len
-    u_enc_table = jpiclib.unserialize_encoding_table(u_enc_table_bin)
-    # v
-    tag = bstring[i:i + 4]
-    i += 4
-    assert tag == b'vtbl', 'invalid jpic file: no vtbl'
-    v_enc_table_bitlen = struct.unpack('=l', bstring[i:i + 4])[0]
-    i += 4
-    v_enc_table_len = v_enc_table_bitlen >> 3
-    v_enc_table_bin = bstring[i:i + v_enc_table_len]
-    i += v_enc_table_len
-    v_enc_table = jpiclib.unserialize_encoding_table(v_enc_table_bin)
-
-    # 1.4. encoding bits
-    # y
-    tag = bstring[i:i + 4]
-    i += 4
-    assert tag == b'plny', 'invalid jpic file: no plny'
-    y_enc_bitlen = struct.unpack('=l', bstring[i:i + 4])[0]
-    i += 4
-    y_enc_len = int(math.ceil(y_enc_bitlen / 8))
-    y_enc_binary = bstring[i:i + y_enc_len]
-    i += y_enc_len
-    y_enc_bits = bitstring.BitArray(y_enc_binary)
-    # adjust the length of luma to the bit
-    del y_enc_bits[y_enc_bitlen:]
-    # u
-    tag = bstring[i:i + 4]
-    i += 4
-    assert tag == b'plnu', 'invalid jpic file: no plnu'
-    u_enc_bitlen = struct.unpack('=l', bstring[i:i + 4])[0]
-    i += 4
-    u_enc_len = int(math.ceil(u_enc_bitlen / 8))
-    u_enc_binary = bstring[i:i + u_enc_len]
-    i += u_enc_len
-    u_enc_bits = bitstring.BitArray(u_enc_binary)
-    # adjust the length of luma to the bit
-    del u_enc_bits[u_enc_bitlen:]
-    # v
-    tag = bstring[i:i + 4]
-    i += 4
-    assert tag == b'plnv', 'invalid jpic file: no plnv'
-    v_enc_bitlen = struct.unpack('=l', bstring[i:i + 4])[0]
-    i += 4
-    v_enc_len = int(math.ceil(v_enc_bitlen / 8))
-    v_enc_binary = bstring[i:i + v_enc_len]
-    i += v_enc_len
-    v_enc_bits = bitstring.BitArray(v_enc_binary)
-    # adjust the length of luma to the bit
-    del v_enc_bits[v_enc_bitlen:]
-
-    # 1.5. parse description
-    description = description_bits.decode('ascii')
+
+def get_chunk_sizes(description, table_bitlens, plane_bitlens):
+    # returns the size (in bytes) of each part of a jpic file (same format
+    # as parse_stream()), from the description and the sizes (in bits) of
+    # its tables (None for no table chunk) and planes
+    size = [['jpic', 4]]
+    for tag, bitlen in zip(
+            (b'desc', ) + TABLE_TAGS + PLANE_TAGS,
+            (len(description) * 8, ) + table_bitlens + plane_bitlens):
+        if bitlen is None:
+            continue
+        size.append([tag.decode(), tlvlib.TLV_HEADER_SIZE +
+                     tlvlib.get_value_size(bitlen)])
+    return size
+
+
+def estimate_chunk_sizes(plane_dcts, width, height, quantization,
+                         transform, encoding, restart_interval=0,
+                         precision=default_values['precision'],
+                         table_id=default_values['table_id']):
+    # returns the exact size of each part of the jpic file of the
+    # (already-transformed) planes, without encoding them
+    table_bitlens, plane_bitlens = zip(*[
+        estimate_plane_dct(plane_dct, quantization, luma, encoding,
+                           restart_interval, precision, table_id) for
+        (plane_dct, luma) in zip(plane_dcts, (True, False, False))])
+    description = get_description(width, height, quantization, transform,
+                                  encoding, restart_interval, table_id)
+    return get_chunk_sizes(description, table_bitlens, plane_bitlens)
+
+
+def estimate_file_size(*args, **kwargs):
+    # args/kwargs are estimate_chunk_sizes() parameters
+    return sum(size for (_, size) in estimate_chunk_sizes(*args, **kwargs))
+
+
+def estimate_file(frame_data, width, height, quantizations,
+                  transform=default_values['transform'],
+                  encoding=default_values['encoding'],
+                  dct_engine=default_values['dct_engine'],
+                  restart_interval=default_values['restart_interval'],
+                  precision=default_values['precision'],
+                  table_id=default_values['table_id'],
+                  stats=statslib.NULL_STATS):
+    # returns the size of each part of the jpic file of the frame (same
+    # format as parse_file()) for each of the quantizations, without
+    # encoding it. The planes are transformed only once
+    float_dtype, _ = jpiclib.get_precision_dtypes(precision)
+    with stats.stage('transform'):
+        plane_dcts = [transform_plane(plane, transform, dct_engine,
+                                      float_dtype) for
+                      plane in dctlib.get_420_planes(frame_data, width,
+                                                     height)]
+    with stats.stage('estimate'):
+        return [estimate_chunk_sizes(plane_dcts, width, height,
+                                     quantization, transform, encoding,
+                                     restart_interval, precision, table_id)
+                for quantization in quantizations]
+
+
+def get_target_quantizations(qtype):
+    # returns the quantizations of a type, sorted by increasing file size
+    # (i.e. increasing quality)
+    if qtype == 'jpeg':
+        return ['jpeg-%i' % qp for qp in range(1, 32)]
+    elif qtype == 'uniform':
+        return ['uniform-%i' % qp for qp in range(31, 0, -1)]
+    elif qtype == 'lossless':
+        # a single candidate
+        return ['lossless']
+    raise AssertionError('invalid target quantization type: %s' % qtype)
+
+
+def get_target_quantization(plane_dcts, width, height, target_size, qtype,
+                            *args, **kwargs):
+    # returns the best quantization (and its file size) that fits in
+    # `target_size` bytes, or the one with the smallest file if none does.
+    # Uses bisection (file sizes are monotonic in the QP), and only
+    # estimates the file sizes
+    # args/kwargs are estimate_file_size() parameters
+    quantizations = get_target_quantizations(qtype)
+    sizes = {}
+
+    def get_size(i):
+        if i not in sizes:
+            sizes[i] = estimate_file_size(plane_dcts, width, height,
+                                          quantizations[i], *args, **kwargs)
+        return sizes[i]
+
+    # the best quantization that fits is in [lo, hi]
+    lo = 0
+    hi = len(quantizations) - 1
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if get_size(mid) <= target_size:
+            lo = mid
+        else:
+            hi = mid - 1
+    return quantizations[lo], get_size(lo)
+
+
+def encode_stream_target(fout, frame_data, width, height, target_size,
+                         qtype=default_values['qtype'],
+                         transform=default_values['transform'],
+                         encoding=default_values['encoding'],
+                         dct_engine=default_values['dct_engine'],
+                         restart_interval=default_values['restart_interval'],
+                         precision=default_values['precision'],
+                         table_id=default_values['table_id'],
+                         stats=statslib.NULL_STATS):
+    # encode the frame using the best `qtype` quantization that fits in
+    # `target_size` bytes. The planes are transformed once, and only the
+    # chosen quantization is entropy-coded
+    # returns the chosen quantization, and the (exact) file size
+    float_dtype, _ = jpiclib.get_precision_dtypes(precision)
+    planes = dctlib.get_420_planes(frame_data, width, height)
+    plane_stats = [stats.new() for _ in PLANE_NAMES]
+    plane_dcts = []
+    for plane, pstats in zip(planes, plane_stats):
+        with pstats.stage('transform'):
+            plane_dcts.append(transform_plane(plane, transform, dct_engine,
+                                              float_dtype))
+    with stats.stage('rate_control'):
+        quantization, size = get_target_quantization(
+            plane_dcts, width, height, target_size, qtype, transform,
+            encoding, restart_interval, precision, table_id)
+    results = [encode_plane_dct(plane_dct, quantization, luma, encoding,
+                                restart_interval, precision, table_id,
+                                stats=pstats)
+               for (plane_dct, luma, pstats) in
+               zip(plane_dcts, (True, False, False), plane_stats)]
+    for name, pstats in zip(PLANE_NAMES, plane_stats):
+        stats.merge(pstats, name + '.')
+    with stats.stage('container'):
+        description = get_description(width, height, quantization,
+                                      transform, encoding, restart_interval,
+                                      table_id)
+        write_container(fout, description, results)
+    return quantization, size
+
+
+def parse_description(description_bin):
+    description = bytes(description_bin).decode('ascii')
     info = {}
     for line in description.split('\n'):
         if not line:
             continue
         key, value = line.split(': ')
         info[key] = value
+    return info
+
+
+def get_chunks(bstring):
+    # returns a dictionary with the (bitlen, value) tuple of each chunk in
+    # the jpic file (values are zero-copy memoryviews into bstring)
+    chunks = {tag: (bitlen, value) for (tag, bitlen, value) in
+              tlvlib.read_chunks(bstring, b'jpic')}
+    # the tables are optional (see get_plane_tables())
+    for tag in (b'desc', ) + PLANE_TAGS:
+        assert tag in chunks, 'invalid jpic file: no %s' % tag.decode()
+    return chunks
+
+
+def get_plane_tables(chunks, table_id):
+    # returns the encoding table of each plane (None when using static
+    # tables)
+    if table_id:
+        return (None, ) * len(TABLE_TAGS)
+    for tag in TABLE_TAGS:
+        assert tag in chunks, 'invalid jpic file: no %s' % tag.decode()
+    # the tables are small, and are used as cache keys
+    return tuple(bytes(chunks[tag][1]) for tag in TABLE_TAGS)
+
+
+def decode_file(bstring, dct_engine=default_values['dct_engine'],
+                jobs=default_values['jobs'],
+                precision=default_values['precision'],
+                stats=statslib.NULL_STATS):
+    # 1. parse the jpic file (TLV approach, with L in bits)
+    with stats.stage('container'):
+        chunks = get_chunks(bstring)
+        _, description_bin = chunks[b'desc']
+        info = parse_description(description_bin)
     width = int(info['width'])
     height = int(info['height'])
     width_c = width >> 1
     height_c = height >> 1
     quantization = info['quantization']
+    transform = info.get('transform', 'dct')
+    encoding = info.get('encoding', 'basic')
+    restart_interval = int(info.get('restart', 0))
+    table_id = int(info.get('tables', 0))
 
-    # 2. huffman coding and RLE
-    # jpiclib.dc00_as_delta(y_dct_q_z)
-    y_dct_q_z = jpiclib.decode(y_enc_bits, width, height, y_enc_table)
-    u_dct_q_z = jpiclib.decode(u_enc_bits, width_c, height_c, u_enc_table)
-    v_dct_q_z = jpiclib.decode(v_enc_bits, width_c, height_c, v_enc_table)
-
-    # 3. un-zig-zag scan
-    y_dct_q = jpiclib.zigzag_unscan(y_dct_q_z, width, height)
-    u_dct_q = jpiclib.zigzag_unscan(u_dct_q_z, width_c, height_c)
-    v_dct_q = jpiclib.zigzag_unscan(v_dct_q_z, width_c, height_c)
-
-    # 4. reverse quantization
-    y_dct = jpiclib.quantization_rev(y_dct_q, quantization)
-    u_dct = jpiclib.quantization_rev(u_dct_q, quantization)
-    v_dct = jpiclib.quantization_rev(v_dct_q, quantization)
+    # 2-5. decode each plane (luma and chromas are independent)
+    plane_args = []
+    for enc_table_bin, plane_tag, (plane_width, plane_height), luma in zip(
+            get_plane_tables(chunks, table_id), PLANE_TAGS,
+            ((width, height), (width_c, height_c), (width_c, height_c)),
+            (True, False, False)):
+        enc_bitlen, enc_binary = chunks[plane_tag]
+        plane_args.append((enc_table_bin, enc_binary, enc_bitlen,
+                           plane_width, plane_height, quantization, luma,
+                           transform, encoding, dct_engine, precision,
+                           table_id))
+    # get the list of (plane index, first row, function, args) jobs
+    job_list = []
+    if restart_interval:
+        # slices (`restart_interval` block rows) are independent too
+        slice_height = restart_interval * 8
+        for index, args in enumerate(plane_args):
+            (enc_table_bin, enc_binary, _, plane_width, plane_height,
+             *rest) = args
+            rows = range(0, plane_height, slice_height)
+            slices = jpiclib.unserialize_slices(enc_binary, len(rows))
+            for row, slice_data in zip(rows, slices):
+                # unusable slices are decoded as gray (see decode_slice())
+                slice_bin, slice_bitlen = slice_data or (None, 0)
+                slice_args = (enc_table_bin, slice_bin, slice_bitlen,
+                              plane_width,
+                              min(slice_height, plane_height - row), *rest)
+                job_list.append((index, row, decode_slice, slice_args))
+    else:
+        for index, args in enumerate(plane_args):
+            job_list.append((index, 0, decode_plane, args))
 
-    # 5. IDCT transform
-    # process luma
-    y = dctlib.get_frame_idct(y_dct)
-    u = dctlib.get_frame_idct(u_dct)
-    v = dctlib.get_frame_idct(v_dct)
+    job_stats = [stats.new() for _ in job_list]
+    frame_size = int(width * height * 1.5)
+    if jobs > 1:
+        # get the decoded planes from the workers using shared memory
+        shm = shared_memory.SharedMemory(create=True, size=frame_size)
+        try:
+            # memoryviews cannot be sent to the workers
+            job_stats = run_plane_jobs(
+                decode_plane_shm,
+                [(shm.name, width, height, index, row, func) +
+                 tuple(bytes(arg) if isinstance(arg, memoryview) else arg
+                       for arg in args) for
+                 (index, row, func, args) in job_list],
+                jobs, job_stats)
+            y, u, v = [plane.copy() for plane in
+                       dctlib.get_420_planes(shm.buf, width, height)]
+        finally:
+            shm.close()
+            shm.unlink()
+    else:
+        y, u, v = dctlib.get_420_planes(bytearray(frame_size), width, height)
+        for (index, row, func, args), jstats in zip(job_list, job_stats):
+            plane = func(*args, stats=jstats)
+            plane_height, _ = plane.shape
+            (y, u, v)[index][row:row + plane_height] = plane
+    for (index, _, _, _), jstats in zip(job_list, job_stats):
+        stats.merge(jstats, PLANE_NAMES[index] + '.')
 
     return y, u, v
 
 
 def parse_file(bstring):
-    size = []
-    # 1. parse the jpic file (TLV approach, with L in bits)
-    i = 0
-    # 1.1. header
-    header = bstring[i:i + 4]
-    i += 4
-    assert header == b'jpic', 'non-jpic file: no jpic'
-    size.append(['jpic', 4])
-
-    # 1.2. description
-    tag = bstring[i:i + 4]
-    i += 4
-    assert tag == b'desc', 'invalid jpic file: no desc'
-    description_bitlen = struct.unpack('=l', bstring[i:i + 4])[0]
-    i += 4
-    description_len = description_bitlen >> 3
-    description_bits = bstring[i:i + description_len]
-    i += description_len
-    size.append(['desc', 4 + 4 + description_len])
-
-    # 1.3. encoding table
-    # y
-    tag = bstring[i:i + 4]
-    i += 4
-    assert tag == b'ytbl', 'invalid jpic file: no ytbl'
-    y_enc_table_bitlen = struct.unpack('=l', bstring[i:i + 4])[0]
-    i += 4
-    y_enc_table_len = y_enc_table_bitlen >> 3
-    i += y_enc_table_len
-    size.append(['ytbl', 4 + 4 + y_enc_table_len])
-    # u
-    tag = bstring[i:i + 4]
-    i += 4
-    assert tag == b'utbl', 'invalid jpic file: no utbl'
-    u_enc_table_bitlen = struct.unpack('=l', bstring[i:i + 4])[0]
-    i += 4
-    u_enc_table_len = u_enc_table_bitlen >> 3
-    i += u_enc_table_len
-    size.append(['utbl', 4 + 4 + u_enc_table_len])
-    # v
-    tag = bstring[i:i + 4]
-    i += 4
-    assert tag == b'vtbl', 'invalid jpic file: no vtbl'
-    v_enc_table_bitlen = struct.unpack('=l', bstring[i:i + 4])[0]
-    i += 4
-    v_enc_table_len = v_enc_table_bitlen >> 3
-    i += v_enc_table_len
-    size.append(['vtbl', 4 + 4 + v_enc_table_len])
-
-    # 1.4. encoding bits
-    # y
-    tag = bstring[i:i + 4]
-    i += 4
-    assert tag == b'plny', 'invalid jpic file: no plny'
-    y_enc_bitlen = struct.unpack('=l', bstring[i:i + 4])[0]
-    i += 4
-    y_enc_len = int(math.ceil(y_enc_bitlen / 8))
-    i += y_enc_len
-    size.append(['plny', 4 + 4 + y_enc_len])
-    # u
-    tag = bstring[i:i + 4]
-    i += 4
-    assert tag == b'plnu', 'invalid jpic file: no plnu'
-    u_enc_bitlen = struct.unpack('=l', bstring[i:i + 4])[0]
-    i += 4
-    u_enc_len = int(math.ceil(u_enc_bitlen / 8))
-    i += u_enc_len
-    size.append(['plnu', 4 + 4 + u_enc_len])
-    # v
-    tag = bstring[i:i + 4]
-    i += 4
-    assert tag == b'plnv', 'invalid jpic file: no plnv'
-    v_enc_bitlen = struct.unpack('=l', bstring[i:i + 4])[0]
-    i += 4
-    v_enc_len = int(math.ceil(v_enc_bitlen / 8))
-    i += v_enc_len
-    size.append(['plnv', 4 + 4 + v_enc_len])
-
-    # 1.5. parse description
-    description = description_bits.decode('ascii')
-    info = {}
-    for line in description.split('\n'):
-        if not line:
-            continue
-        key, value = line.split(': ')
-        info[key] = value
+    return parse_stream(io.BytesIO(bstring))
 
+
+def parse_stream(fin, start=0, end=None, magic=b'jpic',
+                 length_format=tlvlib.TLV_LENGTH_FORMAT):
+    # parse the jpic (or jpis) file in an open file (between `start` and
+    # `end`), reading only the chunk headers and the description
+    size = [[magic.decode(), 4]]
+    info = {}
+    chunk_headers = tlvlib.read_chunk_headers(fin, magic, start, end,
+                                              length_format)
+    for tag, bitlen, offset in chunk_headers:
+        size.append([tag.decode(), tlvlib.get_header_size(length_format) +
+                     tlvlib.get_value_size(bitlen)])
+        if tag == b'desc':
+            info = parse_description(
+                tlvlib.read_chunk_value(fin, offset, bitlen))
     return info, size
 
 
+# multi-frame container
+# * magic word ('jpim')
+# * one 'fram' chunk per frame (TLV, with L in bits), containing a full
+#   single-frame jpic file
+# * a 'fidx' chunk (TLV, with L in bits), containing the number of frames
+#   (uint32) and the file offset of each 'fram' chunk (uint64 each)
+# * the file offset of the 'fidx' chunk (uint64)
+# All the index values are little-endian. The trailing index allows
+# seeking straight to any frame.
+MULTIFRAME_MAGIC = b'jpim'
+
+
+def get_num_frames(infile, width, height):
+    # assume 4:2:0 subsampling
+    frame_size = int(width * height * 1.5)
+    return os.path.getsize(infile) // frame_size
+
+
+def encode_multiframe_file(infile, outfile, width, height, framenum,
+                           num_frames, *args, **kwargs):
+    # encode `num_frames` frames (0 for all of them) starting at `framenum`
+    if num_frames == 0:
+        num_frames = get_num_frames(infile, width, height) - framenum
+    offsets = []
+    with open(outfile, 'wb') as fout:
+        tlvlib.write_magic(fout, MULTIFRAME_MAGIC)
+        for i in range(framenum, framenum + num_frames):
+            frame_data = dctlib.map_frame(infile, width, height, i)
+            with tlvlib.write_chunk_stream(fout, b'fram') as offset:
+                encode_stream(fout, frame_data, width, height, *args,
+                              **kwargs)
+            offsets.append(offset)
+        # add the frame index
+        index = struct.pack('<I', len(offsets))
+        index += struct.pack('<%iQ' % len(offsets), *offsets)
+        index_offset = fout.tell()
+        tlvlib.write_chunk(fout, b'fidx', index)
+        fout.write(struct.pack('<Q', index_offset))
+    return num_frames
+
+
+def read_multiframe_index(fin):
+    # returns the file offset of each frame
+    fin.seek(-8, os.SEEK_END)
+    index_offset, = struct.unpack('<Q', fin.read(8))
+    fin.seek(index_offset)
+    tag, index_bitlen = tlvlib.read_chunk_header(fin)
+    assert tag == b'fidx', 'invalid jpim file: no fidx'
+    index = tlvlib.read_chunk_value(fin, fin.tell(), index_bitlen)
+    num_frames, = struct.unpack('<I', index[:4])
+    return list(struct.unpack('<%iQ' % num_frames, index[4:]))
+
+
+def get_multiframe_frame(fin, offsets, framenum):
+    # returns the (value offset, bitlen) of the frame `framenum` chunk
+    assert 0 <= framenum < len(offsets), (
+        'invalid frame number: %i (file has %i frames)' % (
+            framenum, len(offsets)))
+    fin.seek(offsets[framenum])
+    tag, frame_bitlen = tlvlib.read_chunk_header(fin)
+    assert tag == b'fram', 'invalid jpim file: no fram'
+    return fin.tell(), frame_bitlen
+
+
+def read_multiframe_frame(fin, offsets, framenum):
+    # returns the single-frame jpic file of frame `framenum`
+    offset, frame_bitlen = get_multiframe_frame(fin, offsets, framenum)
+    return tlvlib.read_chunk_value(fin, offset, frame_bitlen)
+
+
+# streaming (strip-based) container, for images too large to fit in memory
+# * magic word ('jpis')
+# * a 'desc' chunk (as in jpic files, plus the strip height)
+# * the 'ytbl', 'utbl', and 'vtbl' encoding tables (not when using static
+#   tables)
+# * one 'stry', 'stru', and 'strv' chunk per strip, with the encoding bits
+#   of the strip of each plane
+# All the chunks use TLV with 64-bit L (in bits). A strip is 16 luma rows
+# (one block row of the chromas). Any width and height are supported:
+# chromas are rounded up, and each strip is padded to a multiple of 8
+# columns (and its full height) by replicating its last column (and row).
+# The DC prediction restarts at each strip.
+STREAM_MAGIC = b'jpis'
+STRIP_TAGS = (b'stry', b'stru', b'strv')
+STRIP_HEIGHT = 16
+
+
+def get_strip_sizes(width, height):
+    # returns the (padded) (width, height) of the strips of each plane
+    return tuple((((plane_width + 7) >> 3) << 3, STRIP_HEIGHT >> (not luma))
+                 for ((plane_width, _), luma) in
+                 zip(dctlib.get_420_plane_sizes(width, height),
+                     (True, False, False)))
+
+
+def get_strips(planes, width, height):
+    # yields the (padded) strips of the 3 planes, one strip row at a time.
+    # Only the rows of the strip are read from the planes (e.g. memmaps)
+    strip_sizes = get_strip_sizes(width, height)
+    for row in range(0, height, STRIP_HEIGHT):
+        strips = []
+        for plane, (strip_width, strip_height) in zip(planes, strip_sizes):
+            plane_row = row * strip_height // STRIP_HEIGHT
+            strips.append(dctlib.pad_plane(
+                plane[plane_row:plane_row + strip_height], strip_width,
+                strip_height))
+        yield strips
+
+
+def quantize_strip(strip, quantization, luma, transform, dct_engine,
+                   precision, stats):
+    float_dtype, _ = jpiclib.get_precision_dtypes(precision)
+    with stats.stage('transform'):
+        strip_dct = transform_plane(strip, transform, dct_engine,
+                                    float_dtype)
+    return quantize_plane(strip_dct, quantization, luma, precision, stats)
+
+
+def encode_stream_strips(fout, planes, width, height, quantization,
+                         transform=default_values['transform'],
+                         encoding=default_values['encoding'],
+                         dct_engine=default_values['dct_engine'],
+                         precision=default_values['precision'],
+                         table_id=default_values['table_id'],
+                         stats=statslib.NULL_STATS):
+    # encode a frame one strip at a time, so that the memory use depends
+    # only on the width. planes are the (e.g. memory-mapped) uint8 planes
+    # (see dctlib.map_420_planes())
+    plane_stats = [stats.new() for _ in PLANE_NAMES]
+    lumas = (True, False, False)
+    # 1. encoding tables
+    if table_id:
+        enc_tables = [tableslib.get_encoding_table(table_id, luma) for
+                      luma in lumas]
+    else:
+        # per-plane tables need the histogram of the full plane, so the
+        # strips are transformed and quantized twice (static tables avoid
+        # this first pass)
+        symbol_counts = [[] for _ in PLANE_NAMES]
+        for strips in get_strips(planes, width, height):
+            for strip, luma, counts, pstats in zip(
+                    strips, lumas, symbol_counts, plane_stats):
+                strip_dct_q_z = quantize_strip(
+                    strip, quantization, luma, transform, dct_engine,
+                    precision, pstats)
+                with pstats.stage('table'):
+                    # keep the histogram small
+                    counts[:] = [jpiclib.merge_symbol_counts(
+                        *counts, jpiclib.get_symbol_counts(strip_dct_q_z,
+                                                           encoding))]
+        enc_tables = []
+        for counts, pstats in zip(symbol_counts, plane_stats):
+            with pstats.stage('table'):
+                enc_tables.append(jpiclib.get_huffman_table(
+                    jpiclib.get_distribution(*counts[0])))
+    # 2. header, description, and encoding tables
+    with stats.stage('container'):
+        description = get_description(width, height, quantization,
+                                      transform, encoding, 0, table_id)
+        description += 'strip: %i\n' % STRIP_HEIGHT
+        tlvlib.write_magic(fout, STREAM_MAGIC)
+        tlvlib.write_chunk(fout, b'desc', str.encode(description),
+                           length_format=tlvlib.TLV64_LENGTH_FORMAT)
+        if not table_id:
+            for tag, enc_table in zip(TABLE_TAGS, enc_tables):
+                tlvlib.write_chunk(
+                    fout, tag, jpiclib.serialize_encoding_table(enc_table),
+                    length_format=tlvlib.TLV64_LENGTH_FORMAT)
+    # 3. encoding bits of each strip
+    table_arrays = [jpiclib.get_encoding_arrays(enc_table) for
+                    enc_table in enc_tables]
+    for strips in get_strips(planes, width, height):
+        for tag, strip, luma, enc_table, arrays, pstats in zip(
+                STRIP_TAGS, strips, lumas, enc_tables, table_arrays,
+                plane_stats):
+            strip_dct_q_z = quantize_strip(
+                strip, quantization, luma, transform, dct_engine, precision,
+                pstats)
+            with pstats.stage('entropy'):
+                enc_bin, enc_bitlen = jpiclib.encode(
+                    strip_dct_q_z, enc_table, encoding, arrays)
+            if pstats.enabled:
+                count_plane_stats(pstats, strip_dct_q_z, enc_table,
+                                  encoding, 0, enc_bitlen, 0)
+            with stats.stage('container'):
+                tlvlib.write_chunk(fout, tag, enc_bin, enc_bitlen,
+                                   length_format=tlvlib.TLV64_LENGTH_FORMAT)
+    for name, pstats in zip(PLANE_NAMES, plane_stats):
+        stats.merge(pstats, name + '.')
+
+
+def encode_stream_strips_file(infile, outfile, width, height, framenum,
+                              *args, **kwargs):
+    # args/kwargs are encode_stream_strips() parameters
+    planes = dctlib.map_420_planes(infile, width, height, framenum)
+    with open(outfile, 'wb') as fout:
+        encode_stream_strips(fout, planes, width, height, *args, **kwargs)
+
+
+def decode_stream_strips(fin, fout, dct_engine=default_values['dct_engine'],
+                         precision=default_values['precision'],
+                         stats=statslib.NULL_STATS):
+    # decode a streaming file one strip at a time, writing the rows of each
+    # strip into their place in fout (a seekable raw 4:2:0 output file)
+    # returns the frame (width, height)
+    assert fout.seekable(), 'invalid output: jpis files need a seekable file'
+    chunk_headers = tlvlib.read_chunk_headers(
+        fin, STREAM_MAGIC, length_format=tlvlib.TLV64_LENGTH_FORMAT)
+    # 1. description and encoding tables
+    with stats.stage('container'):
+        tag, bitlen, offset = next(chunk_headers)
+        assert tag == b'desc', 'invalid jpis file: no desc'
+        info = parse_description(tlvlib.read_chunk_value(fin, offset,
+                                                         bitlen))
+        width = int(info['width'])
+        height = int(info['height'])
+        quantization = info['quantization']
+        transform = info.get('transform', 'dct')
+        encoding = info.get('encoding', 'basic')
+        table_id = int(info.get('tables', 0))
+        assert int(info['strip']) == STRIP_HEIGHT, (
+            'invalid jpis file: strip %s' % info['strip'])
+        enc_table_bins = (None, ) * len(TABLE_TAGS)
+        if not table_id:
+            enc_table_bins = []
+            for expected_tag in TABLE_TAGS:
+                tag, bitlen, offset = next(chunk_headers, (None, 0, 0))
+                assert tag == expected_tag, (
+                    'invalid jpis file: no %s' % expected_tag.decode())
+                enc_table_bins.append(tlvlib.read_chunk_value(fin, offset,
+                                                              bitlen))
+    # 2. decode each strip, and write its (cropped) rows
+    plane_sizes = dctlib.get_420_plane_sizes(width, height)
+    strip_sizes = get_strip_sizes(width, height)
+    plane_offsets = [0]
+    for plane_width, plane_height in plane_sizes:
+        plane_offsets.append(plane_offsets[-1] + plane_width * plane_height)
+    fout.truncate(plane_offsets[-1])
+    plane_rows = [0] * len(PLANE_NAMES)
+    plane_stats = [stats.new() for _ in PLANE_NAMES]
+    for tag, bitlen, offset in chunk_headers:
+        assert tag in STRIP_TAGS, 'invalid jpis file: %s' % tag.decode()
+        index = STRIP_TAGS.index(tag)
+        (plane_width, plane_height) = plane_sizes[index]
+        (strip_width, strip_height) = strip_sizes[index]
+        row = plane_rows[index]
+        assert row < plane_height, 'invalid jpis file: too many strips'
+        with stats.stage('container'):
+            enc_bin = tlvlib.read_chunk_value(fin, offset, bitlen)
+        strip = decode_plane(enc_table_bins[index], enc_bin, bitlen,
+                             strip_width, strip_height, quantization,
+                             index == 0, transform, encoding, dct_engine,
+                             precision, table_id, stats=plane_stats[index])
+        rows = min(strip_height, plane_height - row)
+        with stats.stage('container'):
+            fout.seek(plane_offsets[index] + row * plane_width)
+            fout.write(np.ascontiguousarray(
+                strip[:rows, :plane_width]).tobytes())
+        plane_rows[index] += rows
+    for (_, plane_height), row in zip(plane_sizes, plane_rows):
+        assert row == plane_height, 'invalid jpis file: missing strips'
+    for name, pstats in zip(PLANE_NAMES, plane_stats):
+        stats.merge(pstats, name + '.')
+    return width, height
+
+
+def decode_stream_frame(fin, dct_engine=default_values['dct_engine'],
+                        jobs=default_values['jobs'],
+                        precision=default_values['precision'],
+                        stats=statslib.NULL_STATS):
+    # returns the (y, u, v) planes of a streaming file. Strips are decoded
+    # into a temporary raw file (jobs is ignored, as in
+    # decode_stream_strips()), and the planes are copied out of it
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rawfile = os.path.join(tmpdir, 'frame.yuv')
+        with open(rawfile, 'wb') as fout:
+            width, height = decode_stream_strips(fin, fout, dct_engine,
+                                                 precision, stats)
+        return [np.array(plane) for plane in
+                dctlib.map_420_planes(rawfile, width, height)]
+
+
+def read_frame(infile, width, height, framenum, *args, **kwargs):
+    # returns the (y, u, v) planes of a raw 4:2:0 file frame, or of a
+    # decoded jpic/jpim/jpis file frame (framenum is ignored for jpic and
+    # jpis files)
+    # args/kwargs are decode_file() parameters
+    with open(infile, 'rb') as fin:
+        magic = fin.read(4)
+        if magic == MULTIFRAME_MAGIC:
+            offsets = read_multiframe_index(fin)
+            return decode_file(read_multiframe_frame(fin, offsets, framenum),
+                               *args, **kwargs)
+        elif magic == b'jpic':
+            fin.seek(0)
+            return decode_file(fin.read(), *args, **kwargs)
+        elif magic == STREAM_MAGIC:
+            return decode_stream_frame(fin, *args, **kwargs)
+    # raw frames can have any size (as jpis files)
+    return dctlib.map_420_planes(infile, width, height, framenum)
+
+
+def compare_files(ref_file, dist_file, width, height, framenum, *args,
+                  **kwargs):
+    # returns the PSNR and SSIM of each plane (and of the full frame) of
+    # dist_file, using ref_file as reference
+    # args/kwargs are decode_file() parameters
+    ref_planes = read_frame(ref_file, width, height, framenum, *args,
+                            **kwargs)
+    dist_planes = read_frame(dist_file, width, height, framenum, *args,
+                             **kwargs)
+    return metrics.get_metrics(ref_planes, dist_planes)
+
+
+def parse_qps(qps):
+    # parse a list of QPs (e.g. "1,2,4" or "1-31")
+    out = []
+    for item in qps.split(','):
+        if '-' in item:
+            first, last = item.split('-')
+            out += list(range(int(first), int(last) + 1))
+        else:
+            out.append(int(item))
+    return out
+
+
+def get_quantization(qtype, qp):
+    return 'lossless' if qtype == 'lossless' else '%s-%i' % (qtype, qp)
+
+
+def sweep_frame(frame_data, width, height, quantizations,
+                transform=default_values['transform'],
+                encoding=default_values['encoding'],
+                dct_engine=default_values['dct_engine'],
+                jobs=default_values['jobs'],
+                restart_interval=default_values['restart_interval'],
+                precision=default_values['precision'],
+                table_id=default_values['table_id']):
+    # encode, decode, and measure the frame using each of the quantizations.
+    # The planes are transformed only once, and the coefficients reused
+    # (encode_plane_dct() does not modify them)
+    # returns a dictionary per quantization with its encode and decode
+    # times, file size, and luma PSNR and SSIM
+    float_dtype, _ = jpiclib.get_precision_dtypes(precision)
+    ref_planes = dctlib.get_420_planes(frame_data, width, height)
+    start = time.perf_counter()
+    plane_dcts = [transform_plane(plane, transform, dct_engine, float_dtype)
+                  for plane in ref_planes]
+    transform_time = time.perf_counter() - start
+    args = (plane_dcts, ref_planes, width, height, transform, encoding,
+            dct_engine, restart_interval, precision, table_id)
+    if jobs > 1:
+        # parallelize across quantizations (each one is independent)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(jobs, len(quantizations))) as executor:
+            futures = [executor.submit(sweep_quantization, quantization,
+                                       *args) for
+                       quantization in quantizations]
+            results = [future.result() for future in futures]
+    else:
+        results = [sweep_quantization(quantization, *args) for
+                   quantization in quantizations]
+    for result in results:
+        # report the time of an equivalent (full) encode
+        result['encode'] += transform_time
+    return results
+
+
+def sweep_quantization(quantization, plane_dcts, ref_planes, width, height,
+                       transform, encoding, dct_engine, restart_interval,
+                       precision, table_id=default_values['table_id']):
+    # encode and decode a frame from its (transformed) planes
+    start = time.perf_counter()
+    results = [encode_plane_dct(plane_dct, quantization, luma, encoding,
+                                restart_interval, precision, table_id) for
+               (plane_dct, luma) in zip(plane_dcts, (True, False, False))]
+    fout = io.BytesIO()
+    write_container(fout, get_description(width, height, quantization,
+                                          transform, encoding,
+                                          restart_interval, table_id),
+                    results)
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    y, _, _ = decode_file(fout.getbuffer(), dct_engine, 1, precision)
+    decode_time = time.perf_counter() - start
+    return {
+        'quantization': quantization,
+        'encode': encode_time,
+        'decode': decode_time,
+        'size': fout.tell(),
+        'psnr': metrics.get_psnr(ref_planes[0], y),
+        'ssim': metrics.get_ssim(ref_planes[0], y),
+    }
+
+
+def train_tables(frames, width, height, quantizations,
+                 transform=default_values['transform'],
+                 dct_engine=default_values['dct_engine'],
+                 precision=default_values['precision']):
+    # returns the (serialized) static luma and chroma tables, trained using
+    # the symbol counts of all the frames and quantizations. The tables
+    # include the DC delta symbols, so they work with both encodings
+    float_dtype, _ = jpiclib.get_precision_dtypes(precision)
+    # symbol counts of the luma and the chroma planes
+    symbol_counts = ([], [])
+    for frame_data in frames:
+        for plane, luma in zip(dctlib.get_420_planes(frame_data, width,
+                                                     height),
+                               (True, False, False)):
+            plane_dct = transform_plane(plane, transform, dct_engine,
+                                        float_dtype)
+            for quantization in quantizations:
+                plane_dct_q_z = quantize_plane(plane_dct, quantization, luma,
+                                               precision)
+                symbol_counts[0 if luma else 1].append(
+                    jpiclib.get_symbol_counts(plane_dct_q_z, 'dcpm'))
+    return tuple(jpiclib.serialize_encoding_table(
+        jpiclib.get_static_encoding_table(
+            *jpiclib.merge_symbol_counts(*plane_symbol_counts))) for
+        plane_symbol_counts in symbol_counts)
+
+
 def get_options(argv):
     """Generic option parser.
 
@@ -386,6 +1125,13 @@ def get_options(argv):
             metavar='FRAMENUM',
             help=('FRAMENUM (default: %i)' % default_values['framenum']),)
 
+    parser.add_argument(
+            '--num-frames', action='store', type=int,
+            dest='num_frames', default=default_values['num_frames'],
+            metavar='NUM_FRAMES',
+            help=('number of frames, starting at FRAMENUM (0 for all of '
+                  'them). Encoding more than 1 frame produces a multi-frame '
+                  'file (default: %i)' % default_values['num_frames']),)
     parser.add_argument(
             '-Q', '--quantization', action='store',
             dest='quantization', type=str,
@@ -393,6 +1139,102 @@ def get_options(argv):
             choices=QUANTIZATION_CHOICES,
             metavar='quantization',
             help='quantization (%r)' % QUANTIZATION_CHOICES,)
+    parser.add_argument(
+            '--transform', action='store',
+            dest='transform', type=str,
+            default=default_values['transform'],
+            choices=TRANSFORM_CHOICES,
+            metavar='transform',
+            help='transform (%r)' % TRANSFORM_CHOICES,)
+    parser.add_argument(
+            '--encoding', action='store',
+            dest='encoding', type=str,
+            default=default_values['encoding'],
+            choices=ENCODING_CHOICES,
+            metavar='encoding',
+            help='encoding (%r)' % ENCODING_CHOICES,)
+    parser.add_argument(
+            '--dct-engine', action='store',
+            dest='dct_engine', type=str,
+            default=default_values['dct_engine'],
+            choices=dctlib.DCT_ENGINE_CHOICES,
+            metavar='dct_engine',
+            help='DCT engine (%r)' % dctlib.DCT_ENGINE_CHOICES,)
+    parser.add_argument(
+            '--precision', action='store',
+            dest='precision', type=str,
+            default=default_values['precision'],
+            choices=jpiclib.PRECISION_CHOICES,
+            metavar='precision',
+            help=('transform and coefficient precision (%r). "single" uses '
+                  'float32 transforms and int16 coefficients' %
+                  jpiclib.PRECISION_CHOICES),)
+    parser.add_argument(
+            '--stats', action='store', type=str,
+            dest='stats', default=default_values['stats'],
+            metavar='STATS_FILE',
+            help=('write the codec stats (per-stage times, and counters) '
+                  'as JSON into STATS_FILE ("-" for stdout)'),)
+    parser.add_argument(
+            '--stats-memory', action='store_true',
+            dest='stats_memory', default=default_values['stats_memory'],
+            help=('add the per-stage peak memory use to the stats '
+                  '(tracemalloc, slows down the codec)'),)
+    parser.add_argument(
+            '-j', '--jobs', action='store', type=int,
+            dest='jobs', default=default_values['jobs'],
+            metavar='JOBS',
+            help=('run up to JOBS processes in parallel (default: %i)' %
+                  default_values['jobs']),)
+    parser.add_argument(
+            '--restart-interval', action='store', type=int,
+            dest='restart_interval',
+            default=default_values['restart_interval'],
+            metavar='ROWS',
+            help=('split planes in independently-decodable slices of ROWS '
+                  'block rows (default: %i, no slices)' %
+                  default_values['restart_interval']),)
+    parser.add_argument(
+            '--qtype', action='store',
+            dest='qtype', type=str,
+            default=default_values['qtype'],
+            choices=QTYPE_CHOICES,
+            metavar='qtype',
+            help=('quantization type for sweep and --target-size (%r)' %
+                  QTYPE_CHOICES),)
+    parser.add_argument(
+            '--tables', action='store', type=int,
+            dest='table_id', default=default_values['table_id'],
+            metavar='ID',
+            help=('encode (or sweep/estimate) using the built-in static '
+                  'Huffman tables ID, or train-tables ID (default: %i, '
+                  'per-plane tables)' %
+                  default_values['table_id']),)
+    parser.add_argument(
+            '--strips', action='store_true',
+            dest='strips', default=default_values['strips'],
+            help=('encode one strip (16 rows) at a time into a streaming '
+                  '(jpis) file, for images of any size that do not fit in '
+                  'memory'),)
+    parser.add_argument(
+            '--target-size', action='store', type=int,
+            dest='target_size', default=default_values['target_size'],
+            metavar='BYTES',
+            help=('encode using the best --qtype quantization that fits in '
+                  'BYTES bytes'),)
+    parser.add_argument(
+            '--target-bpp', action='store', type=float,
+            dest='target_bpp', default=default_values['target_bpp'],
+            metavar='BPP',
+            help=('encode using the best --qtype quantization that fits in '
+                  'BPP bits per (luma) pixel'),)
+    parser.add_argument(
+            '--qps', action='store',
+            dest='qps', type=str,
+            default=default_values['qps'],
+            metavar='QPS',
+            help=('list of QP values for sweep, e.g. "1,2,4" or "1-31" '
+                  '(default: %s)' % default_values['qps']),)
     parser.add_argument(
             'function', type=str,
             default=default_values['function'],
@@ -421,6 +1263,11 @@ def get_options(argv):
             default=default_values['dump_pgm'],
             metavar='dump_pgm',
             help='dump_pgm',)
+    parser.add_argument(
+            '--dump-ppm', type=str,
+            default=default_values['dump_ppm'],
+            metavar='dump_ppm',
+            help='dump_ppm',)
     parser.add_argument(
             'infile', type=str,
             default=default_values['infile'],
@@ -436,6 +1283,14 @@ def get_options(argv):
     return options
 
 
+def dump_decoded_frame(y, u, v, options):
+    if options.dump_pgm:
+        utils.write_as_pgm(y, options.dump_pgm)
+    if options.dump_ppm:
+        utils.write_as_ppm(dctlib.get_rgb_from_420(y, u, v),
+                           options.dump_ppm)
+
+
 def main(argv):
     # parse options
     options = get_options(argv)
@@ -447,26 +1302,213 @@ def main(argv):
     # print results
     if options.debug > 0:
         print(options)
-    if options.function == 'encode':
-        frame_data = dctlib.read_frame(options.infile, options.width,
-                                       options.height, options.framenum)
+    stats = (statslib.Stats(options.stats_memory) if options.stats else
+             statslib.NULL_STATS)
+    with stats.stage('total'):
+        run_function(options, stats)
+    if options.stats:
+        out = stats.to_json(function=options.function, infile=options.infile,
+                            outfile=options.outfile)
+        if options.stats == '-':
+            print(out)
+        else:
+            utils.write_as_raw(str.encode(out + '\n'), options.stats)
+
+
+def write_csv(rows, columns, outfile):
+    # write to stdout if there is no outfile
+    if outfile is None:
+        utils.write_csv(rows, columns, sys.stdout)
+    else:
+        with open(outfile, 'w') as fout:
+            utils.write_csv(rows, columns, fout)
+
+
+def get_target_size(options):
+    # returns the target file size (in bytes), or None
+    if options.target_bpp is not None:
+        return int(options.target_bpp * options.width * options.height / 8)
+    return options.target_size
+
+
+def run_function(options, stats):
+    if options.function == 'encode' and options.num_frames != 1:
+        assert get_target_size(options) is None, (
+            'invalid --target-size/--target-bpp: only for single frames')
+        assert not options.strips, 'invalid --strips: only for single frames'
+        encode_multiframe_file(
+            options.infile, options.outfile, options.width, options.height,
+            options.framenum, options.num_frames, options.quantization,
+            options.transform, options.encoding, options.dct_engine,
+            options.jobs, options.restart_interval, options.precision,
+            options.table_id, stats=stats)
+
+    elif options.function == 'encode' and options.strips:
+        assert get_target_size(options) is None, (
+            'invalid --target-size/--target-bpp: not for --strips')
+        assert options.restart_interval == 0, (
+            'invalid --restart-interval: not for --strips')
+        encode_stream_strips_file(
+            options.infile, options.outfile, options.width, options.height,
+            options.framenum, options.quantization, options.transform,
+            options.encoding, options.dct_engine, options.precision,
+            options.table_id, stats=stats)
+
+    elif (options.function == 'encode' and
+            get_target_size(options) is not None):
+        target_size = get_target_size(options)
+        frame_data = dctlib.map_frame(options.infile, options.width,
+                                      options.height, options.framenum)
+        with open(options.outfile, 'wb') as fout:
+            quantization, size = encode_stream_target(
+                fout, frame_data, options.width, options.height,
+                target_size, options.qtype, options.transform,
+                options.encoding, options.dct_engine,
+                options.restart_interval, options.precision,
+                options.table_id, stats)
+        if options.debug > 0:
+            print('quantization: %s size: %i' % (quantization, size))
+        if size > target_size:
+            print('warning: cannot fit in %i bytes (%s uses %i bytes)' % (
+                target_size, quantization, size), file=sys.stderr)
+
+    elif options.function == 'encode':
+        frame_data = dctlib.map_frame(options.infile, options.width,
+                                      options.height, options.framenum)
         if options.dump_input:
             utils.write_as_raw(frame_data, options.dump_input)
-        out = encode_file(frame_data, options.width, options.height,
-                          options.quantization)
-        utils.write_as_raw(out, options.outfile)
+        with open(options.outfile, 'wb') as fout:
+            encode_stream(fout, frame_data, options.width, options.height,
+                          options.quantization, options.transform,
+                          options.encoding, options.dct_engine,
+                          options.jobs, options.restart_interval,
+                          options.precision, options.table_id, stats)
+
+    elif options.function in ('decode', 'parse'):
+        # open the input only once (it can be a pipe), and use its magic
+        # word to get the file type
+        with utils.open_input(options.infile) as fin:
+            run_input_function(options, fin, tlvlib.peek_magic(fin), stats)
+
+    elif options.function == 'compare':
+        print(compare_files(options.infile, options.outfile, options.width,
+                            options.height, options.framenum,
+                            options.dct_engine, options.jobs,
+                            options.precision, stats))
+
+    elif options.function == 'sweep':
+        frame_data = dctlib.map_frame(options.infile, options.width,
+                                      options.height, options.framenum)
+        qps = ([0] if options.qtype == 'lossless' else
+               parse_qps(options.qps))
+        results = sweep_frame(
+            frame_data, options.width, options.height,
+            [get_quantization(options.qtype, qp) for qp in qps],
+            options.transform, options.encoding, options.dct_engine,
+            options.jobs, options.restart_interval, options.precision,
+            options.table_id)
+        write_csv([dict(result, qp=qp) for (qp, result) in
+                   zip(qps, results)], SWEEP_CSV_COLUMNS, options.outfile)
+
+    elif options.function == 'estimate':
+        frame_data = dctlib.map_frame(options.infile, options.width,
+                                      options.height, options.framenum)
+        qps = ([0] if options.qtype == 'lossless' else
+               parse_qps(options.qps))
+        quantizations = [get_quantization(options.qtype, qp) for qp in qps]
+        sizes = estimate_file(
+            frame_data, options.width, options.height, quantizations,
+            options.transform, options.encoding, options.dct_engine,
+            options.restart_interval, options.precision, options.table_id,
+            stats)
+        rows = []
+        for qp, quantization, size in zip(qps, quantizations, sizes):
+            row = dict(size, qp=qp, quantization=quantization)
+            row['size'] = sum(value for (_, value) in size)
+            rows.append(row)
+        write_csv(rows, ESTIMATE_CSV_COLUMNS, options.outfile)
+
+    elif options.function == 'train-tables':
+        num_frames = options.num_frames
+        if num_frames == 0:
+            num_frames = (get_num_frames(options.infile, options.width,
+                                         options.height) - options.framenum)
+        frames = [dctlib.map_frame(options.infile, options.width,
+                                   options.height, framenum) for framenum in
+                  range(options.framenum, options.framenum + num_frames)]
+        qps = ([0] if options.qtype == 'lossless' else
+               parse_qps(options.qps))
+        quantizations = [get_quantization(options.qtype, qp) for qp in qps]
+        luma_table_bin, chroma_table_bin = train_tables(
+            frames, options.width, options.height, quantizations,
+            options.transform, options.dct_engine, options.precision)
+        description = ''
+        description += 'frames: %i\n' % num_frames
+        description += 'transform: %s\n' % options.transform
+        description += 'quantization: %s\n' % ','.join(quantizations)
+        outfile = options.outfile
+        if outfile is None:
+            assert options.table_id > 0, 'invalid table ID: %i' % (
+                options.table_id)
+            outfile = tableslib.get_tables_path(options.table_id)
+        tableslib.write_tables(outfile, luma_table_bin, chroma_table_bin,
+                               description)
+
+
+def run_input_function(options, fin, magic, stats):
+    # decode/parse the (open) input file, of type `magic`
+    if options.function == 'decode' and magic == MULTIFRAME_MAGIC:
+        with utils.input_buffer(fin) as buf, \
+                open(options.outfile, 'wb') as fout:
+            offsets = read_multiframe_index(fin)
+            num_frames = options.num_frames
+            if num_frames == 0:
+                num_frames = len(offsets) - options.framenum
+            for i in range(options.framenum, options.framenum + num_frames):
+                offset, frame_bitlen = get_multiframe_frame(fin, offsets, i)
+                end = offset + tlvlib.get_value_size(frame_bitlen)
+                y, u, v = decode_file(memoryview(buf)[offset:end],
+                                      options.dct_engine, options.jobs,
+                                      options.precision, stats)
+                if i == options.framenum:
+                    dump_decoded_frame(y, u, v, options)
+                utils.write_planes((y, u, v), fout)
+
+    elif options.function == 'decode' and magic == STREAM_MAGIC:
+        with open(options.outfile, 'wb') as fout:
+            width, height = decode_stream_strips(
+                fin, fout, options.dct_engine, options.precision, stats)
+        if options.dump_pgm or options.dump_ppm:
+            # the decoded frame is only in the output file
+            dump_decoded_frame(*dctlib.map_420_planes(
+                options.outfile, width, height), options)
 
     elif options.function == 'decode':
-        bstring = utils.read_as_raw(options.infile)
-        y, u, v = decode_file(bstring)
-        if options.dump_pgm:
-            utils.write_as_pgm(y, options.dump_pgm)
-        out = dctlib.dump_420_buffer(y, u, v)
-        utils.write_as_raw(out, options.outfile)
+        with utils.input_buffer(fin) as buf:
+            y, u, v = decode_file(buf, options.dct_engine, options.jobs,
+                                  options.precision, stats)
+        dump_decoded_frame(y, u, v, options)
+        utils.write_as_yuv((y, u, v), options.outfile)
+
+    elif options.function == 'parse' and magic == MULTIFRAME_MAGIC:
+        offsets = read_multiframe_index(fin)
+        offset, frame_bitlen = get_multiframe_frame(fin, offsets,
+                                                    options.framenum)
+        info, size = parse_stream(
+            fin, offset, offset + tlvlib.get_value_size(frame_bitlen))
+        print({'frames': len(offsets), 'framenum': options.framenum})
+        print(info)
+        print(size)
+
+    elif options.function == 'parse' and magic == STREAM_MAGIC:
+        info, size = parse_stream(
+            fin, magic=STREAM_MAGIC,
+            length_format=tlvlib.TLV64_LENGTH_FORMAT)
+        print(info)
+        print(size)
 
     elif options.function == 'parse':
-        bstring = utils.read_as_raw(options.infile)
-        info, size = parse_file(bstring)
+        info, size = parse_stream(fin)
         print(info)
         print(size)
 
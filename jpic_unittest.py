@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+
+"""jpic."""
+
+
+import contextlib
+import io
+import numpy as np
+import os
+import tempfile
+
+import jpic
+import metrics
+import statslib
+
+import unittest
+
+
+def get_frame_data(width, height, seed=0):
+    # get a smooth (i.e. compressible) random 4:2:0 frame
+    rng = np.random.default_rng(seed)
+    frame_size = int(width * height * 1.5)
+    frame = np.cumsum(rng.integers(-3, 4, size=frame_size)) % 256
+    return frame.astype(np.uint8).tobytes()
+
+
+class MyTest(unittest.TestCase):
+
+    def testEncodeDecode(self):
+        """A test for a lossless encode/decode round trip."""
+        width, height = 64, 48
+        frame_data = get_frame_data(width, height)
+        for transform in jpic.TRANSFORM_CHOICES:
+            for encoding in jpic.ENCODING_CHOICES:
+                out = jpic.encode_file(frame_data, width, height, 'lossless',
+                                       transform, encoding)
+                y, u, v = jpic.decode_file(out)
+                decoded = y.tobytes() + u.tobytes() + v.tobytes()
+                error = np.abs(
+                    np.frombuffer(decoded, dtype=np.uint8).astype(int) -
+                    np.frombuffer(frame_data, dtype=np.uint8).astype(int))
+                self.assertLessEqual(error.max(), 2)
+
+    def testPipes(self):
+        """A test for encoding into, and decoding from, pipes."""
+        width, height = 64, 48
+        frame_data = get_frame_data(width, height)
+        expected = jpic.encode_file(frame_data, width, height, 'jpeg-4')
+        rfd, wfd = os.pipe()
+        with open(rfd, 'rb') as fin:
+            with open(wfd, 'wb') as fout:
+                jpic.encode_stream(fout, frame_data, width, height, 'jpeg-4')
+            self.assertEqual(fin.read(), expected)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = os.path.join(tmpdir, 'out.yuv')
+            for function in ('decode', 'parse'):
+                rfd, wfd = os.pipe()
+                with open(wfd, 'wb') as fout:
+                    fout.write(expected)
+                with contextlib.redirect_stdout(io.StringIO()) as out:
+                    jpic.main(['jpic.py', function, '/dev/fd/%i' % rfd,
+                               outfile])
+                os.close(rfd)
+            self.assertIn("'quantization': 'jpeg-4'", out.getvalue())
+            with open(outfile, 'rb') as fin:
+                self.assertEqual(fin.read(), b''.join(
+                    plane.tobytes() for plane in jpic.decode_file(expected)))
+
+    def testCorruptFile(self):
+        """A test for the errors of truncated and empty files."""
+        width, height = 64, 48
+        out = jpic.encode_file(get_frame_data(width, height), width, height,
+                               'jpeg-4')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            infile = os.path.join(tmpdir, 'in.jpic')
+            outfile = os.path.join(tmpdir, 'out.yuv')
+            for data, error in ((out[:200], 'truncated'),
+                                (b'', 'non-jpic file')):
+                with open(infile, 'wb') as fout:
+                    fout.write(data)
+                # the original error (not a BufferError from the mmap)
+                with self.assertRaisesRegex(AssertionError, error):
+                    jpic.main(['jpic.py', 'decode', infile, outfile])
+
+    def testEncodeDecodeJobs(self):
+        """A test comparing the serial and plane-parallel paths."""
+        width, height = 64, 48
+        frame_data = get_frame_data(width, height)
+        for transform in jpic.TRANSFORM_CHOICES:
+            out = jpic.encode_file(frame_data, width, height, 'jpeg-4',
+                                   transform, 'dcpm')
+            out_jobs = jpic.encode_file(frame_data, width, height, 'jpeg-4',
+                                        transform, 'dcpm', jobs=3)
+            self.assertEqual(out, out_jobs)
+            planes = jpic.decode_file(out)
+            planes_jobs = jpic.decode_file(out, jobs=3)
+            for plane, plane_jobs in zip(planes, planes_jobs):
+                self.assertTrue((plane == plane_jobs).all())
+
+    def testPrecision(self):
+        """A test for the single-precision pipeline."""
+        width, height = 64, 48
+        frame_data = get_frame_data(width, height)
+        for transform in jpic.TRANSFORM_CHOICES:
+            out = jpic.encode_file(frame_data, width, height, 'jpeg-4',
+                                   transform, 'dcpm')
+            out_single = jpic.encode_file(frame_data, width, height,
+                                          'jpeg-4', transform, 'dcpm',
+                                          precision='single')
+            planes = jpic.decode_file(out)
+            planes_single = jpic.decode_file(out_single, precision='single')
+            for plane, plane_single in zip(planes, planes_single):
+                error = np.abs(plane.astype(int) - plane_single.astype(int))
+                self.assertLessEqual(error.max(), 1)
+
+    def testRestartInterval(self):
+        """A test for the restart interval slices."""
+        width, height = 64, 48
+        frame_data = get_frame_data(width, height)
+        out = jpic.encode_file(frame_data, width, height, 'jpeg-4', 'dct',
+                               'dcpm')
+        planes = jpic.decode_file(out)
+        for restart_interval in (1, 2, 4):
+            out_restart = jpic.encode_file(
+                frame_data, width, height, 'jpeg-4', 'dct', 'dcpm',
+                restart_interval=restart_interval)
+            for jobs in (1, 3):
+                planes_restart = jpic.decode_file(out_restart, jobs=jobs)
+                for plane, plane_restart in zip(planes, planes_restart):
+                    self.assertTrue((plane == plane_restart).all())
+        # a corrupt slice must not stop the rest of the frame from decoding
+        out_restart = bytearray(out_restart)
+        info, size = jpic.parse_file(bytes(out_restart))
+        plny_start = sum(chunk_size for (tag, chunk_size) in size
+                         if tag not in ('plny', 'plnu', 'plnv'))
+        # skip the plny header (4+4 bytes) and slice index (4+2*4 bytes)
+        slice_start = plny_start + 8 + 4 + 2 * 4
+        out_restart[slice_start:slice_start + 4] = b'\xff' * 4
+        y, u, v = jpic.decode_file(bytes(out_restart))
+        self.assertTrue((y[:32] == 128).all())
+        self.assertTrue((y[32:] == planes[0][32:]).all())
+        self.assertTrue((u == planes[1]).all())
+        # a corrupt slice index must not stop the other planes either
+        out_restart = bytearray(out_restart)
+        # a huge bit length for the first slice (truncated to the plane)
+        index_start = plny_start + 8 + 4
+        out_restart[index_start:index_start + 4] = b'\xff' * 4
+        y, u, v = jpic.decode_file(bytes(out_restart))
+        self.assertTrue((u == planes[1]).all())
+        # a wrong number of slices (all the slices are unusable)
+        out_restart[index_start - 4:index_start] = b'\xff' * 4
+        y, u, v = jpic.decode_file(bytes(out_restart))
+        self.assertTrue((y == 128).all())
+        self.assertTrue((u == planes[1]).all())
+
+    def testStats(self):
+        """A test for the codec stats."""
+        width, height = 64, 48
+        frame_data = get_frame_data(width, height)
+        for restart_interval in (0, 2):
+            stats = statslib.Stats()
+            out = jpic.encode_file(frame_data, width, height, 'jpeg-4',
+                                   'dct', 'dcpm',
+                                   restart_interval=restart_interval,
+                                   stats=stats)
+            decode_stats = statslib.Stats()
+            jpic.decode_file(out, jobs=2, stats=decode_stats)
+            encode_counters = stats.get_counters()
+            self.assertEqual(encode_counters, decode_stats.get_counters())
+            info, size = jpic.parse_file(out)
+            for name, tag in zip(jpic.PLANE_NAMES, jpic.TABLE_TAGS):
+                self.assertEqual(encode_counters[name + '.table_bits'],
+                                 (dict(size)[tag.decode()] - 8) * 8)
+            self.assertIn('y.entropy', decode_stats.times)
+
+    def testMultiframe(self):
+        """A test for the multi-frame container."""
+        width, height = 64, 48
+        frames = [get_frame_data(width, height, seed) for seed in range(3)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            infile = os.path.join(tmpdir, 'in.yuv')
+            outfile = os.path.join(tmpdir, 'out.jpim')
+            with open(infile, 'wb') as fout:
+                fout.write(b''.join(frames))
+            num_frames = jpic.encode_multiframe_file(
+                infile, outfile, width, height, 1, 0, 'jpeg-4', 'dct',
+                'dcpm')
+            self.assertEqual(num_frames, 2)
+            with open(outfile, 'rb') as fin:
+                self.assertEqual(jpic.tlvlib.peek_magic(fin),
+                                 jpic.MULTIFRAME_MAGIC)
+                offsets = jpic.read_multiframe_index(fin)
+                self.assertEqual(len(offsets), 2)
+                # read the frames in reverse order (random access)
+                for i in (1, 0):
+                    bstring = jpic.read_multiframe_frame(fin, offsets, i)
+                    expected = jpic.encode_file(frames[i + 1], width, height,
+                                                'jpeg-4', 'dct', 'dcpm')
+                    self.assertEqual(bstring, expected)
+                with self.assertRaises(AssertionError):
+                    jpic.read_multiframe_frame(fin, offsets, 2)
+
+    def testCompare(self):
+        """A test for the raw vs. jpic file comparison."""
+        width, height = 64, 48
+        frame_data = get_frame_data(width, height, 0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            infile = os.path.join(tmpdir, 'in.yuv')
+            outfile = os.path.join(tmpdir, 'out.jpic')
+            with open(infile, 'wb') as fout:
+                fout.write(frame_data)
+            out = jpic.compare_files(infile, infile, width, height, 0)
+            self.assertEqual(out['psnr']['all'], float('inf'))
+            self.assertEqual(out['ssim']['all'], 1.0)
+            with open(outfile, 'wb') as fout:
+                fout.write(jpic.encode_file(frame_data, width, height,
+                                            'jpeg-8', 'dct', 'dcpm'))
+            out = jpic.compare_files(infile, outfile, width, height, 0)
+            self.assertLess(out['psnr']['y'], float('inf'))
+            self.assertLess(out['ssim']['all'], 1.0)
+
+    def testParseQps(self):
+        """A test for the QP list parser."""
+        self.assertEqual(jpic.parse_qps('1,2,4'), [1, 2, 4])
+        self.assertEqual(jpic.parse_qps('1-3,8'), [1, 2, 3, 8])
+
+    def testSweep(self):
+        """A test for the QP sweep (single transform)."""
+        width, height = 64, 48
+        frame_data = get_frame_data(width, height, 0)
+        quantizations = ['jpeg-2', 'uniform-4', 'lossless']
+        for jobs in (1, 2):
+            results = jpic.sweep_frame(frame_data, width, height,
+                                       quantizations, 'dct', 'dcpm',
+                                       jobs=jobs)
+            for quantization, result in zip(quantizations, results):
+                # same output as a full encode
+                out = jpic.encode_file(frame_data, width, height,
+                                       quantization, 'dct', 'dcpm')
+                self.assertEqual(result['size'], len(out))
+                y, _, _ = jpic.decode_file(out)
+                self.assertEqual(result['psnr'], metrics.get_psnr(
+                    np.frombuffer(frame_data, np.uint8,
+                                  width * height).reshape(height, width), y))
+        # static tables
+        results = jpic.sweep_frame(frame_data, width, height, quantizations,
+                                   'dct', 'dcpm', table_id=1)
+        for quantization, result in zip(quantizations, results):
+            out = jpic.encode_file(frame_data, width, height, quantization,
+                                   'dct', 'dcpm', table_id=1)
+            self.assertEqual(result['size'], len(out))
+
+    def testTargetSize(self):
+        """A test for the target-size rate control."""
+        width, height = 64, 48
+        frame_data = get_frame_data(width, height, 0)
+        for qtype, table_id in (('jpeg', 0), ('uniform', 0), ('jpeg', 1)):
+            sizes = {quantization: len(jpic.encode_file(
+                frame_data, width, height, quantization, 'dct', 'dcpm',
+                restart_interval=2, table_id=table_id)) for quantization in
+                jpic.get_target_quantizations(qtype)}
+            # a budget between 2 quantizations
+            ordered = sorted(sizes.items(), key=lambda item: item[1])
+            (expected, size), (_, next_size) = ordered[10:12]
+            for target_size in (size, next_size - 1):
+                fout = io.BytesIO()
+                quantization, out_size = jpic.encode_stream_target(
+                    fout, frame_data, width, height, target_size, qtype,
+                    'dct', 'dcpm', restart_interval=2, table_id=table_id)
+                self.assertEqual(quantization, expected)
+                self.assertEqual(len(fout.getvalue()), size)
+                self.assertEqual(out_size, size)
+            # too small a budget uses the smallest file
+            quantization, _ = jpic.encode_stream_target(
+                io.BytesIO(), frame_data, width, height, 1, qtype, 'dct',
+                'dcpm', restart_interval=2, table_id=table_id)
+            self.assertEqual(quantization, ordered[0][0])
+        # lossless is a single candidate (whatever the budget)
+        for target_size in (1, 1 << 20):
+            quantization, _ = jpic.encode_stream_target(
+                io.BytesIO(), frame_data, width, height, target_size,
+                'lossless', 'dct', 'dcpm')
+            self.assertEqual(quantization, 'lossless')
+
+    def testEstimate(self):
+        """A test for the (exact) size estimation."""
+        width, height = 64, 48
+        frame_data = get_frame_data(width, height, 0)
+        quantizations = ['lossless', 'jpeg-1', 'jpeg-12', 'uniform-3']
+        for encoding in jpic.ENCODING_CHOICES:
+            for restart_interval in (0, 1, 4):
+                for precision in ('double', 'single'):
+                    sizes = jpic.estimate_file(
+                        frame_data, width, height, quantizations, 'dct',
+                        encoding, restart_interval=restart_interval,
+                        precision=precision)
+                    for quantization, size in zip(quantizations, sizes):
+                        out = jpic.encode_file(
+                            frame_data, width, height, quantization, 'dct',
+                            encoding, restart_interval=restart_interval,
+                            precision=precision)
+                        _, expected = jpic.parse_file(out)
+                        self.assertEqual(size, expected)
+        # static tables (no table chunks, escaped missing symbols)
+        for encoding in jpic.ENCODING_CHOICES:
+            for restart_interval in (0, 2):
+                sizes = jpic.estimate_file(
+                    frame_data, width, height, quantizations, 'dct',
+                    encoding, restart_interval=restart_interval, table_id=1)
+                for quantization, size in zip(quantizations, sizes):
+                    out = jpic.encode_file(
+                        frame_data, width, height, quantization, 'dct',
+                        encoding, restart_interval=restart_interval,
+                        table_id=1)
+                    _, expected = jpic.parse_file(out)
+                    self.assertEqual(size, expected)
+
+    def testStaticTables(self):
+        """A test for the built-in static tables."""
+        width, height = 64, 48
+        frame_data = get_frame_data(width, height, 0)
+        for encoding in jpic.ENCODING_CHOICES:
+            for restart_interval, jobs in ((0, 1), (2, 2)):
+                out = jpic.encode_file(frame_data, width, height, 'jpeg-4',
+                                       'dct', encoding,
+                                       restart_interval=restart_interval,
+                                       table_id=1)
+                info, size = jpic.parse_file(out)
+                self.assertEqual(info['tables'], '1')
+                self.assertEqual([tag for (tag, _) in size],
+                                 ['jpic', 'desc', 'plny', 'plnu', 'plnv'])
+                # same output as with per-plane tables
+                expected = jpic.decode_file(jpic.encode_file(
+                    frame_data, width, height, 'jpeg-4', 'dct', encoding))
+                for plane, expected_plane in zip(
+                        jpic.decode_file(out, jobs=jobs), expected):
+                    self.assertTrue((plane == expected_plane).all())
+
+    def encodeDecodeStrips(self, tmpdir, frame_data, width, height, *args,
+                           stats=statslib.NULL_STATS, **kwargs):
+        # returns the decoded raw frame of a streaming encode/decode
+        # args/kwargs are encode_stream_strips() parameters
+        infile = os.path.join(tmpdir, 'in.yuv')
+        outfile = os.path.join(tmpdir, 'out.jpis')
+        with open(infile, 'wb') as fout:
+            fout.write(frame_data)
+        decoded_file = os.path.join(tmpdir, 'out.yuv')
+        with stats.stage('total'):
+            jpic.encode_stream_strips_file(infile, outfile, width, height,
+                                           0, *args, stats=stats, **kwargs)
+            with open(outfile, 'rb') as fin, \
+                    open(decoded_file, 'wb') as fout:
+                self.assertEqual(
+                    jpic.decode_stream_strips(fin, fout, stats=stats),
+                    (width, height))
+        with open(outfile, 'rb') as fin:
+            self.assertEqual(jpic.tlvlib.peek_magic(fin), jpic.STREAM_MAGIC)
+        with open(decoded_file, 'rb') as fin:
+            return fin.read()
+
+    def testStrips(self):
+        """A test for the streaming (strip-based) encode/decode."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # any width and height (chromas are rounded up)
+            for width, height in ((37, 29), (8, 1), (64, 48)):
+                frame_size = width * height + 2 * (
+                    ((width + 1) >> 1) * ((height + 1) >> 1))
+                frame_data = get_frame_data(width, height)[:frame_size]
+                frame_data += bytes(frame_size - len(frame_data))
+                for table_id in (0, 1):
+                    out = self.encodeDecodeStrips(
+                        tmpdir, frame_data, width, height, 'lossless',
+                        'idct-int', 'dcpm', table_id=table_id)
+                    self.assertEqual(len(out), frame_size)
+                    error = np.abs(
+                        np.frombuffer(out, dtype=np.uint8).astype(int) -
+                        np.frombuffer(frame_data, dtype=np.uint8).astype(int))
+                    self.assertLessEqual(error.max(), 2)
+            # lossy: same output as the (full-frame) jpic encode/decode
+            width, height = 64, 48
+            frame_data = get_frame_data(width, height)
+            expected = b''.join(plane.tobytes() for plane in jpic.decode_file(
+                jpic.encode_file(frame_data, width, height, 'jpeg-8')))
+            out = self.encodeDecodeStrips(tmpdir, frame_data, width, height,
+                                          'jpeg-8')
+            self.assertEqual(out, expected)
+
+    def testStripsRead(self):
+        """A test for reading (compare and dump) streaming files."""
+        width, height = 37, 29
+        frame_size = width * height + 2 * (
+            ((width + 1) >> 1) * ((height + 1) >> 1))
+        frame_data = get_frame_data(width, height)[:frame_size]
+        frame_data += bytes(frame_size - len(frame_data))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.encodeDecodeStrips(tmpdir, frame_data, width, height,
+                                    'jpeg-8')
+            infile = os.path.join(tmpdir, 'in.yuv')
+            outfile = os.path.join(tmpdir, 'out.jpis')
+            decoded_file = os.path.join(tmpdir, 'out.yuv')
+            # a jpis file compares as its decoded frame
+            out = jpic.compare_files(infile, outfile, width, height, 0)
+            expected = jpic.compare_files(infile, decoded_file, width,
+                                          height, 0)
+            self.assertEqual(out, expected)
+            self.assertLess(out['psnr']['y'], float('inf'))
+            # decode dumps the decoded frame
+            pgm_file = os.path.join(tmpdir, 'out.pgm')
+            ppm_file = os.path.join(tmpdir, 'out.ppm')
+            jpic.main(['jpic.py', 'decode', '--dump-pgm', pgm_file,
+                       '--dump-ppm', ppm_file, outfile, decoded_file])
+            with open(decoded_file, 'rb') as fin:
+                decoded = fin.read()
+            with open(pgm_file, 'rb') as fin:
+                self.assertEqual(fin.read(), b'P5\n37 29\n255\n' +
+                                 decoded[:width * height])
+            with open(ppm_file, 'rb') as fin:
+                self.assertEqual(len(fin.read()),
+                                 len(b'P6\n37 29\n255\n') +
+                                 width * height * 3)
+
+    def testStripsMemory(self):
+        """A test for the bounded memory use of the streaming mode."""
+        width = 64
+        # a frame made of copies of the same strip (the code lengths, and
+        # therefore the entropy coding buffers, depend on the contents)
+        y, u, v = jpic.dctlib.get_420_planes(get_frame_data(width, 16),
+                                             width, 16)
+        # load the static tables before measuring
+        jpic.tableslib.get_encoding_tables(1)
+        jpic.tableslib.get_decoding_tables(1)
+        peaks = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for num_strips in (4, 64):
+                frame_data = b''.join(np.tile(plane, (num_strips, 1)).tobytes()
+                                      for plane in (y, u, v))
+                stats = statslib.Stats(memory=True)
+                self.encodeDecodeStrips(
+                    tmpdir, frame_data, width, 16 * num_strips, 'jpeg-4',
+                    table_id=1, stats=stats)
+                peaks.append(stats.peaks['total'])
+        # the encode/decode memory use does not grow with the height (16x)
+        self.assertLess(peaks[1], 1.25 * peaks[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,46 +3,38 @@
 """jpiclib."""
 
 import bitstring
+import functools
 import numpy as np
-import pickle
+import struct
 
 import huffman
 
 
-def quantization(m, qtype, **kwargs):
-    if qtype == 'lossless':
-        return quantization_lossless(m)
-    elif qtype.split('-')[0] == 'jpeg':
-        is_luma = kwargs.get('luma')
-        val = int(qtype.split('-')[1])
-        return quantization_jpeg(m, is_luma, val)
-    elif qtype.split('-')[0] == 'uniform':
-        val = int(qtype.split('-')[1])
-        return quantization_uniform(m, val)
-    raise AssertionError('invalid quantization type: %s' % qtype)
+# precision policies: (transform type, coefficient type)
+# * double: float64 transforms, and int64 coefficients
+# * single: float32 transforms, and int16 coefficients (8-bit samples
+#   produce coefficients in the [-2048, 2047] range)
+PRECISION_DTYPES = {
+    'double': ('float64', 'int64'),
+    'single': ('float32', 'int16'),
+}
+PRECISION_CHOICES = list(PRECISION_DTYPES.keys())
 
 
-def quantization_rev(m, qtype, **kwargs):
-    if qtype == 'lossless':
-        return quantization_lossless_rev(m)
-    elif qtype.split('-')[0] == 'jpeg':
-        is_luma = kwargs.get('luma')
-        val = int(qtype.split('-')[1])
-        return quantization_jpeg_rev(m, is_luma, val)
-    elif qtype.split('-')[0] == 'uniform':
-        val = int(qtype.split('-')[1])
-        return quantization_uniform_rev(m, val)
-    raise AssertionError('invalid quantization type: %s' % qtype)
+def get_precision_dtypes(precision):
+    if precision not in PRECISION_DTYPES:
+        raise AssertionError('invalid precision: %s' % precision)
+    return PRECISION_DTYPES[precision]
 
 
-def quantization_lossless(m):
-    # just convert matrix to int
-    return np.around(m).astype('int')
+def quantization(m, qtype, dtype='int', **kwargs):
+    plan = get_quantization_plan(qtype, bool(kwargs.get('luma')))
+    return plan.quantize(m, dtype)
 
 
-def quantization_lossless_rev(m):
-    # just convert matrix to float
-    return np.around(m).astype('float')
+def quantization_rev(m, qtype, dtype='int', **kwargs):
+    plan = get_quantization_plan(qtype, bool(kwargs.get('luma')))
+    return plan.dequantize(m, dtype)
 
 
 # https://www.sciencedirect.com/topics/engineering/quantization-table
@@ -70,22 +62,6 @@ QUANT_JPEG_C = np.array([
 ])
 
 
-def quantization_jpeg(m, is_luma, val):
-    qm = np.copy(QUANT_JPEG_Y if is_luma else QUANT_JPEG_C)
-    qm = qm / val
-    # make sure we do not use values smaller than 1
-    qm[qm < 1.0] = 1.0
-    return quantization_matrix(m, qm)
-
-
-def quantization_jpeg_rev(m, is_luma, val):
-    qm = np.copy(QUANT_JPEG_Y if is_luma else QUANT_JPEG_C)
-    qm = qm / val
-    # make sure we do not use values smaller than 1
-    qm[qm < 1.0] = 1.0
-    return quantization_matrix_rev(m, qm)
-
-
 QUANT_UNIFORM = np.array([
     [1, 1, 1, 1, 1, 1, 1, 1],
     [1, 1, 1, 1, 1, 1, 1, 1],
@@ -98,32 +74,70 @@ QUANT_UNIFORM = np.array([
 ])
 
 
-def quantization_uniform(m, val):
-    qm = np.copy(QUANT_UNIFORM * val)
-    return quantization_matrix(m, qm)
+def get_quantization_matrix(qtype, is_luma):
+    if qtype == 'lossless':
+        # unit matrix (just convert matrix to int)
+        return QUANT_UNIFORM.astype('float64')
+    elif qtype.split('-')[0] == 'jpeg':
+        val = int(qtype.split('-')[1])
+        qm = np.copy(QUANT_JPEG_Y if is_luma else QUANT_JPEG_C)
+        qm = qm / val
+        # make sure we do not use values smaller than 1
+        qm[qm < 1.0] = 1.0
+        return qm
+    elif qtype.split('-')[0] == 'uniform':
+        val = int(qtype.split('-')[1])
+        return (QUANT_UNIFORM * val).astype('float64')
+    raise AssertionError('invalid quantization type: %s' % qtype)
+
+
+class QuantizationPlan:
+    """Precomputed quantization matrices for a (qtype, luma) pair."""
+
+    def __init__(self, qtype, is_luma):
+        self.qtype = qtype
+        self.is_luma = is_luma
+        self.qm = get_quantization_matrix(qtype, is_luma)
+        # quantization multiplies by the reciprocal matrix
+        self.rqm = 1.0 / self.qm
+
+    def quantize(self, m, dtype='int'):
+        return quantization_matrix(m, self.qm, self.rqm, dtype)
+
+    def dequantize(self, m, dtype='int'):
+        return quantization_matrix_rev(m, self.qm, dtype)
 
 
-def quantization_uniform_rev(m, val):
-    qm = np.copy(QUANT_UNIFORM * val)
-    return quantization_matrix_rev(m, qm)
+@functools.lru_cache(maxsize=None)
+def get_quantization_plan(qtype, is_luma):
+    return QuantizationPlan(qtype, is_luma)
 
 
-def quantization_matrix(m, qm):
+def get_work_dtype(m):
+    # smallest float type that represents all the values of m exactly
+    return np.result_type(m.dtype, np.float32)
+
+
+def quantization_matrix(m, qm, rqm=None, dtype='int'):
+    # quantize all the 8x8 blocks at once, by broadcasting the (reciprocal)
+    # quantization matrix over a block-shaped view of the input. Note that
+    # the input matrix is not modified.
+    if rqm is None:
+        rqm = 1.0 / qm
+    rqm = rqm.astype(get_work_dtype(m))
     height, width = m.shape
-    for i in range(0, height, 8):
-        for j in range(0, width, 8):
-            # get block using numpy subset view
-            m[i:i+8, j:j+8] = m[i:i+8, j:j+8] / qm
-    return np.around(m).astype('int')
+    blocks = m.reshape(height // 8, 8, width // 8, 8)
+    out = np.around(blocks * rqm[:, np.newaxis, :])
+    return out.astype(dtype).reshape(height, width)
 
 
-def quantization_matrix_rev(m, qm):
+def quantization_matrix_rev(m, qm, dtype='int'):
+    # dequantize all the 8x8 blocks at once (see quantization_matrix())
+    qm = qm.astype(get_work_dtype(m))
     height, width = m.shape
-    for i in range(0, height, 8):
-        for j in range(0, width, 8):
-            # get block using numpy subset view
-            m[i:i+8, j:j+8] = m[i:i+8, j:j+8] * qm
-    return np.around(m).astype('int')
+    blocks = m.reshape(height // 8, 8, width // 8, 8)
+    out = np.around(blocks * qm[:, np.newaxis, :])
+    return out.astype(dtype).reshape(height, width)
 
 
 ZIGZAG_ORDER = np.array([
@@ -138,8 +152,13 @@ ZIGZAG_ORDER = np.array([
 ])
 
 
+# ZIGZAG_SCAN[k] is the (raster) position in the 8x8 block of the k-th
+# zig-zagged coefficient (i.e. the inverse of ZIGZAG_ORDER)
+ZIGZAG_SCAN = np.argsort(ZIGZAG_ORDER, axis=None)
+
+
 def zigzag_block(block, order=ZIGZAG_ORDER):
-    zigzag = np.zeros(64, dtype=np.int)
+    zigzag = np.zeros(64, dtype=int)
     # map 8x8 vector to 1x64 vector
     for i in range(8):
         for j in range(8):
@@ -149,25 +168,35 @@ def zigzag_block(block, order=ZIGZAG_ORDER):
     return zigzag
 
 
+@functools.lru_cache(maxsize=None)
+def get_zigzag_index(width, height):
+    # get a <numblocks>x64 matrix with the position (in the flattened wxh
+    # plane) of each of the zig-zagged coefficients. This allows zig-zag
+    # scanning a full plane using a single gather (and unscanning it using
+    # a single scatter)
+    assert width % 8 == 0, 'width must be a multiple of 8 (%i)' % width
+    assert height % 8 == 0, 'height must be a multiple of 8 (%i)' % height
+    # position of the top-left pixel of each block (in raster order)
+    block_start = (np.arange(0, height, 8)[:, np.newaxis] * width +
+                   np.arange(0, width, 8)[np.newaxis, :])
+    # position of each coefficient relative to its block top-left pixel
+    block_offset = (ZIGZAG_SCAN // 8) * width + (ZIGZAG_SCAN % 8)
+    index = block_start.reshape(-1, 1) + block_offset[np.newaxis, :]
+    # the index is cached, so make sure nobody modifies it
+    index.flags.writeable = False
+    return index
+
+
 def zigzag_scan(inp):
     # convert a wxh matrix (where both w and h are multiples of 8) into
     # a 64x(w*h/64) matrix with the coefficients zig-zagged
     height, width = inp.shape
-    assert width % 8 == 0, 'width must be a multiple of 8 (%i)' % width
-    assert height % 8 == 0, 'height must be a multiple of 8 (%i)' % height
-    zigzag = np.zeros((int((width * height) / 64), 64), dtype=np.int)
-    bid = 0
-    for i in range(0, height, 8):
-        for j in range(0, width, 8):
-            # get block using numpy subset view
-            block = inp[i:i+8, j:j+8]
-            zigzag[bid] = zigzag_block(block)
-            bid += 1
-    return zigzag
+    index = get_zigzag_index(width, height)
+    return inp.reshape(-1)[index]
 
 
 def zigzag_unblock(zigzag, order=ZIGZAG_ORDER):
-    block = np.zeros((8, 8), dtype=np.int)
+    block = np.zeros((8, 8), dtype=int)
     # map 1x64 vector to 8x8 vector
     for i in range(8):
         for j in range(8):
@@ -182,148 +211,702 @@ def zigzag_unscan(inp, width, height):
     # matrix with the coefficients zig-zagged into a <width>x<height> matrix
     numblocks, sixtyfour = inp.shape
     assert sixtyfour == 64, 'zigzagged block must have 64 elements'
-    assert width % 8 == 0, 'width must be a multiple of 8 (%i)' % width
-    assert height % 8 == 0, 'height must be a multiple of 8 (%i)' % height
     assert numblocks * sixtyfour == width * height
-
-    unzigzag = np.zeros((height, width), dtype=np.int)
-    bid = 0
-    for i in range(0, height, 8):
-        for j in range(0, width, 8):
-            block = zigzag_unblock(inp[bid])
-            # set block using numpy subset view
-            unzigzag[i:i+8, j:j+8] = block
-            bid += 1
-
-    return unzigzag
-
-
-def dc00_as_delta(inp):
-    # basic approach: just get the delta from the previous value
-    out = np.copy(inp)
-    numblocks, _ = inp.shape
-    for i in range(1, numblocks):
-        out[i][0] = inp[i][0] - inp[i - 1][0]
-    dc000 = out[0][0]
-    out[0][0] = 0
-    return dc000, out
-
-
-def get_symbol_distribution(inp):
-    symbol_distribution = {'EOB': 0}
-    # calculate all the symbols
-    numblocks, _ = inp.shape
-    zerocnt = 0
-    for i in range(0, numblocks):
-        for j in range(1, 64):
-            if inp[i][j] == 0:
-                zerocnt += 1
-                continue
-            # new symbol
-            symbol = '%i,%i' % (zerocnt, inp[i][j])
-            if symbol not in symbol_distribution:
-                symbol_distribution[symbol] = 0
-            symbol_distribution[symbol] += 1
-            zerocnt = 0
-        if zerocnt != 0:
-            symbol_distribution['EOB'] += 1
-        zerocnt = 0
+    index = get_zigzag_index(width, height)
+    unzigzag = np.zeros(height * width, dtype=inp.dtype)
+    unzigzag[index] = inp
+    return unzigzag.reshape(height, width)
+
+
+# AC coefficients are run-length encoded as (run, value) symbols, where run
+# is the number of zero coefficients before a non-zero value, plus an
+# end-of-block (EOB) symbol when the last coefficients of the block are
+# zero. Each symbol is represented by a single integer, `value * 64 + run`,
+# so that EOB (the only symbol with value 0) is 0.
+# In "dcpm" encoding, the DC coefficients are coded as the difference from
+# the DC of the previous block. Each difference is coded using its size
+# category (number of bits of its absolute value) as a symbol with run 63
+# (which is not a valid AC run), followed by the category extra bits.
+SYMBOL_EOB = 0
+SYMBOL_DC_RUN = 63
+# static (predefined) tables cannot include all the possible symbols. The
+# ones they miss are coded using an escape symbol (run 62 with value 0,
+# which is not a valid AC symbol), followed by the symbol run (6 bits) and
+# value (int16)
+SYMBOL_ESCAPE_RUN = 62
+ESCAPE_RUN_BITS = 6
+ESCAPE_VALUE_BITS = 16
+ESCAPE_BITS = ESCAPE_RUN_BITS + ESCAPE_VALUE_BITS
+# maximum code length of the static tables (so that an escaped DC
+# category code plus its extra bits always fits in 64 bits)
+STATIC_TABLE_MAX_LENGTH = 24
+
+
+def get_symbol(run, value):
+    return value * 64 + run
+
+
+SYMBOL_ESCAPE = get_symbol(SYMBOL_ESCAPE_RUN, 0)
+
+
+def parse_symbol(symbol):
+    # convert an encoding table symbol into a (run, value) tuple (or None
+    # for EOB)
+    if symbol == SYMBOL_EOB:
+        return None
+    return symbol & 63, symbol >> 6
+
+
+def get_tokens(inp):
+    # convert the AC coefficients of a <numblocks>x64 zig-zagged matrix
+    # into a (block, run, value) token stream (3 integer arrays). Tokens
+    # are sorted by block, and EOB tokens have run and value 0.
+    block, run, value, eob_block = get_unsorted_tokens(inp)
+    # merge the EOB tokens after the AC tokens of the same block
+    block = np.concatenate((block, eob_block))
+    order = np.argsort(block, kind='stable')
+    block = block[order]
+    run = np.concatenate((run, np.zeros(len(eob_block), dtype=run.dtype)))
+    run = run[order]
+    value = np.concatenate((value, np.zeros(len(eob_block),
+                                            dtype=value.dtype)))
+    value = value[order]
+    return block, run, value
+
+
+def get_unsorted_tokens(inp):
+    # returns the (block, run, value) non-EOB tokens, and the blocks of the
+    # EOB tokens (separately, so that callers that do not need the tokens
+    # in order can skip merging them)
+    ac = inp[:, 1:]
+    block, pos = np.nonzero(ac)
+    value = ac[block, pos]
+    # the run is the distance to the previous non-zero coefficient in the
+    # same block (or to the block start)
+    prev_pos = np.empty_like(pos)
+    prev_pos[0:1] = -1
+    prev_pos[1:] = pos[:-1]
+    first_in_block = np.ones(len(block), dtype=bool)
+    first_in_block[1:] = block[1:] != block[:-1]
+    prev_pos[first_in_block] = -1
+    run = pos - prev_pos - 1
+    # blocks need an EOB unless their last coefficient is non-zero
+    last_nonzero = ac[:, -1] != 0
+    eob_block = np.flatnonzero(~last_nonzero)
+    return block, run, value, eob_block
+
+
+def get_dc_tokens(inp, restart_blocks=0):
+    # get the DC differences of a <numblocks>x64 zig-zagged matrix, as
+    # (category, extra bits) arrays. The first block uses a 0 predictor
+    # (and so does every `restart_blocks` blocks, if set).
+    dc = inp[:, 0].astype('int64')
+    delta = np.diff(dc, prepend=0)
+    if restart_blocks:
+        delta[::restart_blocks] = dc[::restart_blocks]
+    absdelta = np.abs(delta)
+    # category is the number of bits needed to represent abs(delta)
+    category = np.zeros(len(delta), dtype='int64')
+    nonzero = absdelta > 0
+    category[nonzero] = np.floor(np.log2(absdelta[nonzero])).astype(
+        'int64') + 1
+    # extra bits are the delta itself for positive values, and its 1's
+    # complement (i.e. `delta - 1`, in `category` bits) for negative ones
+    extra = np.where(delta < 0, delta + (1 << category) - 1, delta)
+    return category, extra
+
+
+def get_dc_from_deltas(delta):
+    return np.cumsum(delta)
+
+
+def get_token_symbols(run, value):
+    return get_symbol(run.astype('int64'), value.astype('int64'))
+
+
+def get_symbol_counts(inp, encoding='basic', restart_blocks=0):
+    # returns the (huffman-coded) symbols of a <numblocks>x64 zig-zagged
+    # matrix, and the number of occurrences of each one (sorted by symbol)
+    # calculate all the symbols (in any order)
+    _, run, value, eob_block = get_unsorted_tokens(inp)
+    symbols = np.concatenate((get_token_symbols(run, value),
+                              np.full(len(eob_block), SYMBOL_EOB)))
+    if encoding == 'dcpm':
+        category, _ = get_dc_tokens(inp, restart_blocks)
+        symbols = np.concatenate((symbols, get_symbol(SYMBOL_DC_RUN,
+                                                      category)))
+    return np.unique(symbols, return_counts=True)
+
+
+def merge_symbol_counts(*symbol_counts):
+    # merge several (symbols, counts) tuples (see get_symbol_counts())
+    symbols, inverse = np.unique(
+        np.concatenate([symbols for (symbols, _) in symbol_counts]),
+        return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate(
+        [counts for (_, counts) in symbol_counts]))
+    return symbols, counts.astype('int64')
+
+
+def get_code_stats(inp, encoding_table, encoding='basic', restart_blocks=0):
+    # returns the number of (huffman-coded) symbols and EOBs of a
+    # <numblocks>x64 zig-zagged matrix, the number of bits used to code
+    # them, and the size of the alphabet (encoding table)
+    symbols, counts = get_symbol_counts(inp, encoding, restart_blocks)
+    _, lengths = lookup_codes(*get_encoding_arrays(encoding_table), symbols)
+    return {
+        'symbols': int(counts.sum()),
+        'eobs': int(counts[symbols == SYMBOL_EOB].sum()),
+        'code_bits': int((counts * lengths).sum()),
+        'alphabet': len(encoding_table),
+    }
+
+
+def get_symbol_distribution(inp, encoding='basic', restart_blocks=0):
+    symbols, counts = get_symbol_counts(inp, encoding, restart_blocks)
+    return get_distribution(symbols, counts)
+
+
+def get_distribution(symbols, counts):
+    # sort symbols by occurrences (ties by symbol)
+    order = np.lexsort((symbols, -counts))
+    symbols = symbols[order]
     # normalize frequencies to probabilities
-    num_symbols = sum(symbol_distribution.values())
-    for symbol in symbol_distribution:
-        symbol_distribution[symbol] /= num_symbols
-    # convert symbol distribution to listed sorted by occurrences
-    symbol_distribution = sorted(symbol_distribution.items(),
-                                 key=lambda x: x[1], reverse=True)
+    probs = counts[order] / counts.sum()
+    symbol_distribution = list(zip(symbols.tolist(), probs.tolist()))
     return symbol_distribution
 
 
-def get_encoding_table(inp):
-    symbol_distribution = get_symbol_distribution(inp)
-    huffman_code = huffman.HuffmanCode(symbol_distribution)
+def get_code_lengths(symbols, counts):
+    # returns the huffman code length of each symbol (the same ones that
+    # get_encoding_table() uses), without building the codes
+    order = np.lexsort((symbols, -counts))
+    probs = counts[order] / counts.sum()
+    huffman_code = huffman.HuffmanCode(list(zip(symbols[order].tolist(),
+                                                probs.tolist())))
+    lengths = np.empty(len(symbols), dtype='int64')
+    lengths[order] = huffman_code.lengths
+    return lengths
+
+
+def get_encoded_bitlens(inp, encoding='basic', restart_blocks=0,
+                        encoding_table=None):
+    # returns the exact size (in bits) of the serialized encoding table and
+    # of the encoded plane (including the slice index and padding, if
+    # `restart_blocks` is set), without encoding it
+    # When using a (static) `encoding_table`, its code lengths (plus the
+    # escape bits of the missing symbols) are used, and there is no
+    # serialized table (its size is None)
+    numblocks, _ = inp.shape
+    # token order does not matter here
+    block, run, value, eob_block = get_unsorted_tokens(inp)
+    block = np.concatenate((block, eob_block))
+    symbols = np.concatenate((get_token_symbols(run, value),
+                              np.full(len(eob_block), SYMBOL_EOB)))
+    if encoding == 'dcpm':
+        category, _ = get_dc_tokens(inp, restart_blocks)
+        symbols = np.concatenate((symbols, get_symbol(SYMBOL_DC_RUN,
+                                                      category)))
+    elif encoding != 'basic':
+        raise AssertionError('invalid encoding: %s' % encoding)
+    if encoding_table is not None:
+        _, lengths = lookup_codes(*get_encoding_arrays(encoding_table),
+                                  symbols)
+    else:
+        table_symbols, inverse, counts = np.unique(
+            symbols, return_inverse=True, return_counts=True)
+        table_lengths = get_code_lengths(table_symbols, counts)
+        lengths = table_lengths[inverse]
+    # add the bits of each block
+    numtokens = len(block)
+    block_bits = np.bincount(block, weights=lengths[:numtokens],
+                             minlength=numblocks).astype('int64')
+    if encoding == 'basic':
+        # DC components are coded using int16
+        block_bits += 16
+    else:
+        # DC delta category code followed by the extra bits
+        block_bits += lengths[numtokens:] + category
+    if restart_blocks:
+        # slices are padded to a byte boundary, and go after the index
+        slice_bits = np.add.reduceat(block_bits,
+                                     np.arange(0, numblocks, restart_blocks))
+        numslices = len(slice_bits)
+        plane_bitlen = 8 * (4 + 4 * numslices +
+                            int(((slice_bits + 7) >> 3).sum()))
+    else:
+        plane_bitlen = int(block_bits.sum())
+    if encoding_table is not None:
+        return None, plane_bitlen
+    table_bitlen = 8 * get_encoding_table_size(table_symbols, table_lengths)
+    return table_bitlen, plane_bitlen
+
+
+def get_encoding_table(inp, encoding='basic', restart_blocks=0):
+    symbol_distribution = get_symbol_distribution(inp, encoding,
+                                                  restart_blocks)
+    return get_huffman_table(symbol_distribution)
+
+
+def get_static_encoding_table(symbols, counts):
+    # get a static table from the symbol counts of a training set. It
+    # always includes EOB and the escape symbol (for the missing symbols)
+    for symbol in (SYMBOL_EOB, SYMBOL_ESCAPE):
+        if symbol not in symbols:
+            symbols = np.append(symbols, symbol)
+            counts = np.append(counts, 1)
+    return get_huffman_table(get_distribution(symbols, counts),
+                             STATIC_TABLE_MAX_LENGTH)
+
+
+def get_huffman_table(symbol_distribution, max_length=None):
+    huffman_code = huffman.HuffmanCode(symbol_distribution, max_length)
     for symbol in huffman_code.table:
         huffman_code.table[symbol] = bitstring.BitArray(
                 '0b%s' % huffman_code.table[symbol])
     return huffman_code.table
 
 
-def encode(inp, encoding_table):
-    # create the output bitstring
-    bits = bitstring.BitArray()
-    # dc000, dinp = dc00_as_delta(inp)
+# number of codes packed at once by pack_bits()
+PACK_BITS_CHUNK = 1 << 16
+
+
+def pack_bits(codes, lengths):
+    # pack a sequence of variable-length codes (MSB first) into a bytes
+    # object. The last byte is padded with zeroes. Returns the packed bytes
+    # and their length in bits.
+    codes = np.asarray(codes, dtype='uint64')
+    lengths = np.asarray(lengths, dtype='int64')
+    bitlen = int(lengths.sum())
+    out = np.zeros((bitlen + 7) >> 3, dtype='uint8')
+    # bits of the last (incomplete) byte of the previous chunk
+    carry = np.zeros(0, dtype='uint8')
+    outpos = 0
+    for start in range(0, len(codes), PACK_BITS_CHUNK):
+        chunk_codes = codes[start:start + PACK_BITS_CHUNK, np.newaxis]
+        chunk_lengths = lengths[start:start + PACK_BITS_CHUNK, np.newaxis]
+        max_length = int(chunk_lengths.max(initial=0))
+        # get a <numcodes>x<max_length> matrix with the bits of each code
+        # (MSB first), and a mask with the valid ones
+        bitpos = np.arange(max_length)[np.newaxis, :]
+        mask = bitpos < chunk_lengths
+        shift = np.maximum(chunk_lengths - 1 - bitpos, 0).astype('uint64')
+        bits = ((chunk_codes >> shift) & np.uint64(1)).astype('uint8')
+        # selecting the valid bits in row-major order concatenates the codes
+        bits = np.concatenate((carry, bits[mask]))
+        numbytes = len(bits) >> 3
+        out[outpos:outpos + numbytes] = np.packbits(bits[:numbytes << 3])
+        outpos += numbytes
+        carry = bits[numbytes << 3:]
+    if len(carry):
+        out[outpos] = np.packbits(carry)[0]
+    return out.tobytes(), bitlen
+
+
+def get_encoding_arrays(encoding_table):
+    # convert an encoding table into 3 arrays (sorted symbols, codes, and
+    # code lengths), which allow looking up many symbols at once
+    symbols = np.array(sorted(encoding_table), dtype='int64')
+    codes = np.array([encoding_table[symbol].uint for symbol in
+                      symbols.tolist()], dtype='uint64')
+    lengths = np.array([len(encoding_table[symbol]) for symbol in
+                        symbols.tolist()], dtype='int64')
+    return symbols, codes, lengths
+
+
+def lookup_codes(table_symbols, table_codes, table_lengths, symbols):
+    # get the code and code length of each symbol, using the encoding
+    # arrays. Symbols missing in the table use the escape symbol (if the
+    # table has it)
+    index = np.searchsorted(table_symbols, symbols)
+    index = np.minimum(index, len(table_symbols) - 1)
+    codes = table_codes[index]
+    lengths = table_lengths[index]
+    missing = table_symbols[index] != symbols
+    if missing.any():
+        escape = min(np.searchsorted(table_symbols, SYMBOL_ESCAPE),
+                     len(table_symbols) - 1)
+        assert table_symbols[escape] == SYMBOL_ESCAPE, (
+            'symbol not in encoding table')
+        run = symbols[missing] & 63
+        value = symbols[missing] >> 6
+        assert ((-1 << (ESCAPE_VALUE_BITS - 1) <= value) &
+                (value < 1 << (ESCAPE_VALUE_BITS - 1))).all(), (
+            'symbol value cannot be escaped')
+        codes[missing] = ((int(table_codes[escape]) << ESCAPE_BITS) |
+                          (run << ESCAPE_VALUE_BITS) |
+                          (value & ((1 << ESCAPE_VALUE_BITS) - 1))).astype(
+                              'uint64')
+        lengths[missing] = table_lengths[escape] + ESCAPE_BITS
+    return codes, lengths
+
+
+def encode(inp, encoding_table, encoding='basic', table_arrays=None):
+    # returns the encoded bytes and their length in bits
+    # table_arrays are the get_encoding_arrays() of the table (callers
+    # encoding many pieces with the same table can get them only once)
     numblocks, _ = inp.shape
-    zerocnt = 0
-    for i in range(0, numblocks):
+    block, run, value = get_tokens(inp)
+    # look up the code of each AC token
+    if table_arrays is None:
+        table_arrays = get_encoding_arrays(encoding_table)
+    ac_codes, ac_lengths = lookup_codes(*table_arrays,
+                                        get_token_symbols(run, value))
+    # put together the DC components and the AC codes: The DC of each
+    # block goes right before its first AC token
+    numtokens = len(block)
+    codes = np.empty(numblocks + numtokens, dtype='uint64')
+    lengths = np.empty(numblocks + numtokens, dtype='int64')
+    block_start = np.searchsorted(block, np.arange(numblocks))
+    dc_pos = block_start + np.arange(numblocks)
+    ac_pos = np.arange(numtokens) + block + 1
+    if encoding == 'basic':
         # let's encode the DC component using int16
-        bits.append('int:16=%s' % inp[i][0])
-        # let's encode the AC components using RLE
-        for j in range(1, 64):
-            if inp[i][j] == 0:
-                zerocnt += 1
-                continue
-            # new symbol
-            symbol = '%i,%i' % (zerocnt, inp[i][j])
-            bits.append(encoding_table[symbol])
-            zerocnt = 0
-        if zerocnt != 0:
-            # EOB
-            symbol = 'EOB'
-            bits.append(encoding_table[symbol])
-        zerocnt = 0
-    return bits
-
-
-def decode(inp, width, height, encoding_table):
-    zigzag = np.zeros((int((width * height) / 64), 64), dtype=np.int)
-
-    # we cannot just reverse keys and values as the values (BitArray) are
-    # not hashable, and therefore not valid dictionary keys. Instead we will
-    # use strings with 0's and 1's
-    decoding_table = {val.bin: key for (key, val) in encoding_table.items()}
-
-    bid = 0
-    i = 0
-    while i < len(inp):
-        # let's decode the DC component using int16
-        j = 0
-        zigzag[bid][j] = inp[i:i+16].int
-        i += 16
-        j += 1
+        codes[dc_pos] = inp[:, 0].astype('int64') & 0xffff
+        lengths[dc_pos] = 16
+    elif encoding == 'dcpm':
+        # let's encode the DC delta category code followed by the extra bits
+        category, extra = get_dc_tokens(inp)
+        dc_codes, dc_lengths = lookup_codes(
+            *table_arrays, get_symbol(SYMBOL_DC_RUN, category))
+        codes[dc_pos] = ((dc_codes << category.astype('uint64'))
+                         | extra.astype('uint64'))
+        lengths[dc_pos] = dc_lengths + category
+    else:
+        raise AssertionError('invalid encoding: %s' % encoding)
+    codes[ac_pos] = ac_codes
+    lengths[ac_pos] = ac_lengths
+    return pack_bits(codes, lengths)
+
+
+# number of bits peeked by each level of the decoding table
+DECODING_TABLE_BITS = 10
+
+
+class DecodingTable:
+    """Multi-level lookup table for decoding Huffman codes.
+
+    Each level is a list indexed by the next `bits` bits of the input.
+    Entries are `(symbol, length)` tuples, where `length` is the length
+    of the code (in bits) that the entry resolves. Codes longer than `bits`
+    are resolved using a second-level table: in that case the entry is
+    `(table, 0)`, and the lookup continues with the bits after the first
+    `bits` ones (recursively, for very long codes).
+    """
+
+    def __init__(self, codes, bits=DECODING_TABLE_BITS):
+        # codes is a list of (symbol, code, length) tuples, where the code
+        # is an integer containing the `length` code bits
+        self.bits = bits
+        self.table = self.build_table(codes, bits)
+
+    @classmethod
+    def build_table(cls, codes, bits):
+        table = [None] * (1 << bits)
+        long_codes = {}
+        for symbol, code, length in codes:
+            if length <= bits:
+                # code fits in the table: fill all the entries that start
+                # with it
+                shift = bits - length
+                entry = (symbol, length)
+                start = code << shift
+                for index in range(start, start + (1 << shift)):
+                    table[index] = entry
+            else:
+                # code does not fit: group it by its first `bits` bits
+                length -= bits
+                prefix = code >> length
+                code &= (1 << length) - 1
+                long_codes.setdefault(prefix, []).append(
+                    (symbol, code, length))
+        for prefix, sub_codes in long_codes.items():
+            table[prefix] = (cls.build_table(sub_codes, bits), 0)
+        return table
+
+
+def get_decoding_table(encoding_table):
+    codes = [(parse_symbol(symbol), code.uint, len(code)) for
+             (symbol, code) in encoding_table.items()]
+    return DecodingTable(codes)
+
+
+# escape symbol, as a decoding table (run, value) tuple
+ESCAPE = (SYMBOL_ESCAPE_RUN, 0)
+
+
+def parse_escape(val):
+    # convert the bits after an escape code into a (run, value) tuple
+    run = val >> ESCAPE_VALUE_BITS
+    val &= (1 << ESCAPE_VALUE_BITS) - 1
+    if val >> (ESCAPE_VALUE_BITS - 1):
+        val -= 1 << ESCAPE_VALUE_BITS
+    return run, val
+
+
+def decode(inp, bitlen, width, height, decoding_table, encoding='basic',
+           dtype='int'):
+    # inp is a bytes-like object containing (at least) `bitlen` bits
+    assert encoding in ('basic', 'dcpm'), 'invalid encoding: %s' % encoding
+    dcpm = encoding == 'dcpm'
+    numblocks = int((width * height) / 64)
+    table = decoding_table.table
+    bits = decoding_table.bits
+    mask = (1 << bits) - 1
+    escape_mask = (1 << ESCAPE_BITS) - 1
+
+    # we read the input using an integer bit reservoir (`acc`), which
+    # contains the next `nbits` bits of the input. We refill it from a
+    # list of 32-bit words, so we need to pad the input to a multiple
+    # of 4 bytes
+    inp = bytes(inp[:(bitlen + 7) >> 3])
+    inp += bytes(4 - (len(inp) % 4) + 4)
+    words = np.frombuffer(inp, dtype='>u4').tolist()
+    wid = 0
+    acc = 0
+    nbits = 0
+
+    zigzag = [0] * (numblocks * 64)
+    for bid in range(numblocks):
+        base = bid * 64
+        if dcpm:
+            # let's decode the DC delta category using the decoding table
+            level = table
+            while True:
+                if nbits < 32:
+                    acc = ((acc & ((1 << nbits) - 1)) << 32) | words[wid]
+                    wid += 1
+                    nbits += 32
+                entry = level[(acc >> (nbits - bits)) & mask]
+                assert entry is not None, (
+                    'invalid code at bit %i bid: %i' % (
+                        (wid << 5) - nbits, bid))
+                symbol, length = entry
+                if length:
+                    break
+                # long code: go to the next level
+                nbits -= bits
+                level = symbol
+            nbits -= length
+            if symbol == ESCAPE:
+                if nbits < 32:
+                    acc = ((acc & ((1 << nbits) - 1)) << 32) | words[wid]
+                    wid += 1
+                    nbits += 32
+                nbits -= ESCAPE_BITS
+                symbol = parse_escape((acc >> nbits) & escape_mask)
+            assert symbol is not None and symbol[0] == SYMBOL_DC_RUN, (
+                'invalid DC symbol at bit %i bid: %i' % (
+                    (wid << 5) - nbits, bid))
+            # and then the extra bits
+            category = symbol[1]
+            if nbits < 32:
+                acc = ((acc & ((1 << nbits) - 1)) << 32) | words[wid]
+                wid += 1
+                nbits += 32
+            nbits -= category
+            val = (acc >> nbits) & ((1 << category) - 1)
+            if category and val < (1 << (category - 1)):
+                # negative delta
+                val -= (1 << category) - 1
+            zigzag[base] = val
+        else:
+            # let's decode the DC component using int16
+            if nbits < 32:
+                acc = ((acc & ((1 << nbits) - 1)) << 32) | words[wid]
+                wid += 1
+                nbits += 32
+            nbits -= 16
+            val = (acc >> nbits) & 0xffff
+            zigzag[base] = val - 0x10000 if val & 0x8000 else val
         # let's decode the AC components using the decoding table
+        j = 1
         while j < 64:
-            encstr = ''
-            while encstr not in decoding_table:
-                # make sure the nexts bit is available
-                assert i < len(inp), (
-                    'decoder ran out of bits i: %i/%i bid: %i j:%i' % (
-                        i, len(inp), bid, j))
-                encstr += inp[i:i+1].bin
-                i += 1
-            symbol = decoding_table[encstr]
-            if symbol == 'EOB':
-                for _ in range(j, 64):
-                    zigzag[bid][j] = 0
-                    j += 1
-            else:
-                zerocnt, val = symbol.split(',')
-                zerocnt, val = int(zerocnt), int(val)
-                for _ in range(zerocnt):
-                    zigzag[bid][j] = 0
-                    j += 1
-                zigzag[bid][j] = val
-                j += 1
-        bid += 1
+            level = table
+            while True:
+                if nbits < 32:
+                    acc = ((acc & ((1 << nbits) - 1)) << 32) | words[wid]
+                    wid += 1
+                    nbits += 32
+                entry = level[(acc >> (nbits - bits)) & mask]
+                assert entry is not None, (
+                    'invalid code at bit %i bid: %i j: %i' % (
+                        (wid << 5) - nbits, bid, j))
+                symbol, length = entry
+                if length:
+                    break
+                # long code: go to the next level
+                nbits -= bits
+                level = symbol
+            nbits -= length
+            if symbol is None:
+                # EOB
+                break
+            zerocnt, val = symbol
+            if not val:
+                # escape (the only symbol with value 0)
+                if nbits < 32:
+                    acc = ((acc & ((1 << nbits) - 1)) << 32) | words[wid]
+                    wid += 1
+                    nbits += 32
+                nbits -= ESCAPE_BITS
+                zerocnt, val = parse_escape((acc >> nbits) & escape_mask)
+            j += zerocnt
+            zigzag[base + j] = val
+            j += 1
+        # make sure the nexts bits were available
+        assert (wid << 5) - nbits <= bitlen, (
+            'decoder ran out of bits i: %i/%i bid: %i' % (
+                (wid << 5) - nbits, bitlen, bid))
     # make sure we read all the data
-    assert zigzag.shape[0] == bid, (
-        'error: only read %i rows (expecting %i)' % (bid, zigzag.shape[0]))
+    assert (wid << 5) - nbits == bitlen, (
+        'error: only read %i bits (expecting %i)' % (
+            (wid << 5) - nbits, bitlen))
+    zigzag = np.array(zigzag, dtype=dtype).reshape(numblocks, 64)
+    if dcpm:
+        # convert the DC deltas back into DC values
+        zigzag[:, 0] = get_dc_from_deltas(zigzag[:, 0])
     return zigzag
 
 
+# encoding table binary format
+# * header: version (uint8), value size in bytes (uint8), and maximum code
+#   length (uint8)
+# * number of codes of each length, from 1 to the maximum code length
+#   (uint32 each)
+# * symbol runs, in canonical order (uint8 each, ENCODING_TABLE_EOB_RUN for
+#   EOB)
+# * symbol values, in canonical order (int8/int16/int32 each)
+# The codes are canonical (see huffman.HuffmanCode), so the number of
+# codes of each length and the symbol order are enough to rebuild them.
+# All values are little-endian.
+ENCODING_TABLE_VERSION = 1
+ENCODING_TABLE_HEADER = '<BBB'
+ENCODING_TABLE_EOB_RUN = 0xff
+
+
+def get_encoding_table_value_size(vals):
+    # use the smallest integer type that fits all the values
+    for value_size in (1, 2, 4):
+        info = np.iinfo('i%i' % value_size)
+        if info.min <= vals.min() and vals.max() <= info.max:
+            break
+    return value_size
+
+
+def get_encoding_table_size(symbols, lengths):
+    # returns the size (in bytes) of a serialized encoding table, from its
+    # symbols and code lengths (EOB uses value 0)
+    vals = np.asarray(symbols) >> 6
+    value_size = get_encoding_table_value_size(vals)
+    return (struct.calcsize(ENCODING_TABLE_HEADER) + 4 * int(max(lengths)) +
+            len(vals) * (1 + value_size))
+
+
 def serialize_encoding_table(encoding_table):
-    # TODO(chema): not sure this is a good idea
-    return pickle.dumps(encoding_table)
+    # sort the codes in canonical order
+    items = sorted(encoding_table.items(),
+                   key=lambda item: (len(item[1]), item[1].uint))
+    lengths = [len(code) for (_, code) in items]
+    max_length = lengths[-1]
+    counts = np.bincount(lengths, minlength=max_length + 1)[1:]
+    runs = []
+    vals = []
+    for symbol, _ in items:
+        symbol = parse_symbol(symbol)
+        if symbol is None:
+            runs.append(ENCODING_TABLE_EOB_RUN)
+            vals.append(0)
+        else:
+            runs.append(symbol[0])
+            vals.append(symbol[1])
+    vals = np.array(vals)
+    value_size = get_encoding_table_value_size(vals)
+    out = struct.pack(ENCODING_TABLE_HEADER, ENCODING_TABLE_VERSION,
+                      value_size, max_length)
+    out += counts.astype('<u4').tobytes()
+    out += np.array(runs, dtype='u1').tobytes()
+    out += vals.astype('<i%i' % value_size).tobytes()
+    return out
+
+
+def unserialize_canonical_codes(encoding_table_bin):
+    # returns a list of (symbol, code, length) tuples, where the symbol is
+    # a (run, value) tuple (or None for EOB)
+    header_size = struct.calcsize(ENCODING_TABLE_HEADER)
+    version, value_size, max_length = struct.unpack(
+        ENCODING_TABLE_HEADER, encoding_table_bin[:header_size])
+    assert version == ENCODING_TABLE_VERSION, (
+        'invalid encoding table version: %i' % version)
+    i = header_size
+    counts = np.frombuffer(encoding_table_bin, dtype='<u4',
+                           count=max_length, offset=i).astype('int64')
+    i += 4 * max_length
+    num_symbols = int(counts.sum())
+    runs = np.frombuffer(encoding_table_bin, dtype='u1', count=num_symbols,
+                         offset=i)
+    i += num_symbols
+    vals = np.frombuffer(encoding_table_bin, dtype='<i%i' % value_size,
+                         count=num_symbols, offset=i)
+    # rebuild the canonical codes: the first code of each length is
+    # `(first[length - 1] + count[length - 1]) << 1`, and the following
+    # codes of the same length are consecutive
+    first = np.zeros(max_length + 1, dtype='int64')
+    for length in range(2, max_length + 1):
+        first[length] = (first[length - 1] + counts[length - 2]) << 1
+    lengths = np.repeat(np.arange(1, max_length + 1), counts)
+    start = np.concatenate(([0], np.cumsum(counts)))[lengths - 1]
+    codes = first[lengths] + np.arange(num_symbols) - start
+    symbols = [None if run == ENCODING_TABLE_EOB_RUN else (run, val) for
+               (run, val) in zip(runs.tolist(), vals.tolist())]
+    return list(zip(symbols, codes.tolist(), lengths.tolist()))
 
 
 def unserialize_encoding_table(encoding_table_bin):
-    # TODO(chema): not sure this is a good idea
-    return pickle.loads(encoding_table_bin)
+    encoding_table = {}
+    for symbol, code, length in unserialize_canonical_codes(
+            encoding_table_bin):
+        symbol = SYMBOL_EOB if symbol is None else get_symbol(*symbol)
+        encoding_table[symbol] = bitstring.BitArray(uint=code, length=length)
+    return encoding_table
+
+
+@functools.lru_cache(maxsize=16)
+def unserialize_decoding_table(encoding_table_bin):
+    # build the decoding table directly from the serialized encoding table
+    return DecodingTable(unserialize_canonical_codes(encoding_table_bin))
+
+
+# sliced plane binary format (used with restart intervals)
+# * number of slices (uint32)
+# * length of each slice, in bits (uint32 each)
+# * the slices, each one padded to a byte boundary
+# All values are little-endian.
+def serialize_slices(slices):
+    # slices is a list of (bytes, bitlen) tuples
+    out = struct.pack('<I', len(slices))
+    out += struct.pack('<%iI' % len(slices),
+                       *[bitlen for (_, bitlen) in slices])
+    out += b''.join(slice_bin for (slice_bin, _) in slices)
+    return out
+
+
+def unserialize_slices(plane_bin, numslices):
+    # returns a list of `numslices` (bytes, bitlen) tuples
+    # A corrupt index must not stop the rest of the plane from decoding, so
+    # this never fails: all the slices are None (unusable) if the index
+    # does not match `numslices`, and slices running past the end of the
+    # plane are truncated
+    index_size = 4 + 4 * numslices
+    if (len(plane_bin) < index_size or
+            struct.unpack_from('<I', plane_bin)[0] != numslices):
+        return [None] * numslices
+    bitlens = struct.unpack_from('<%iI' % numslices, plane_bin, 4)
+    slices = []
+    i = index_size
+    for bitlen in bitlens:
+        slice_len = min((bitlen + 7) >> 3, len(plane_bin) - i)
+        slices.append((plane_bin[i:i + slice_len],
+                       min(bitlen, slice_len * 8)))
+        i += slice_len
+    return slices
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+"""jpiclib."""
+
+
+import numpy as np
+
+import jpiclib
+
+import unittest
+
+
+class MyTest(unittest.TestCase):
+
+    def testQuantizationPlan(self):
+        """A test for the cached quantization plans."""
+        plan = jpiclib.get_quantization_plan('jpeg-4', True)
+        self.assertIs(plan, jpiclib.get_quantization_plan('jpeg-4', True))
+        self.assertIsNot(plan, jpiclib.get_quantization_plan('jpeg-4',
+                                                             False))
+        rng = np.random.default_rng(0)
+        inp = rng.uniform(-1000, 1000, size=(16, 24))
+        inp_copy = np.copy(inp)
+        out = jpiclib.quantization(inp, 'jpeg-4', luma=True)
+        # quantization must not modify its input
+        self.assertTrue((inp == inp_copy).all())
+        # compare with a per-block quantization
+        for i in range(0, 16, 8):
+            for j in range(0, 24, 8):
+                expected = np.around(inp[i:i+8, j:j+8] / plan.qm)
+                self.assertTrue(
+                    (np.abs(out[i:i+8, j:j+8] - expected) <= 1).all())
+        rev = jpiclib.quantization_rev(out, 'jpeg-4', luma=True)
+        self.assertTrue((np.abs(rev - inp) <= np.tile(plan.qm, (2, 3))).all())
+        # int16 coefficients
+        out16 = jpiclib.quantization(inp.astype('float32'), 'jpeg-4',
+                                     'int16', luma=True)
+        self.assertEqual(out16.dtype, np.int16)
+        self.assertTrue((np.abs(out16 - out) <= 1).all())
+        rev16 = jpiclib.quantization_rev(out16, 'jpeg-4', 'int16', luma=True)
+        self.assertEqual(rev16.dtype, np.int16)
+
+    def testQuantizationLossless(self):
+        """A test for the lossless quantization."""
+        inp = np.array([[0.4, 1.6, -2.2, 3.5] * 2] * 8)
+        out = jpiclib.quantization(inp, 'lossless')
+        self.assertTrue((out == np.around(inp)).all())
+        self.assertTrue((jpiclib.quantization_rev(out, 'lossless') ==
+                         out).all())
+
+    def testZigzagScan(self):
+        """A test comparing the plane and per-block zig-zag scans."""
+        rng = np.random.default_rng(0)
+        width, height = 24, 16
+        inp = rng.integers(-100, 100, size=(height, width))
+        zigzag = jpiclib.zigzag_scan(inp)
+        self.assertEqual(zigzag.shape, (width * height // 64, 64))
+        bid = 0
+        for i in range(0, height, 8):
+            for j in range(0, width, 8):
+                block = inp[i:i+8, j:j+8]
+                self.assertTrue(
+                    (zigzag[bid] == jpiclib.zigzag_block(block)).all())
+                bid += 1
+        # zig-zag starts with the top-left corner, then goes right
+        self.assertEqual(zigzag[0][0], inp[0, 0])
+        self.assertEqual(zigzag[0][1], inp[0, 1])
+        self.assertEqual(zigzag[0][2], inp[1, 0])
+        unzigzag = jpiclib.zigzag_unscan(zigzag, width, height)
+        self.assertTrue((unzigzag == inp).all())
+
+    def testGetTokens(self):
+        """A test for the run-length tokenizer."""
+        inp = np.zeros((3, 64), dtype=int)
+        inp[0, 0] = 100
+        inp[0, 1] = 5
+        inp[0, 4] = -3
+        inp[1, 63] = 7
+        inp[2, 0] = -100
+        block, run, value = jpiclib.get_tokens(inp)
+        self.assertEqual(block.tolist(), [0, 0, 0, 1, 2])
+        self.assertEqual(run.tolist(), [0, 2, 0, 62, 0])
+        self.assertEqual(value.tolist(), [5, -3, 0, 7, 0])
+        symbols = jpiclib.get_token_symbols(run, value)
+        self.assertEqual(symbols[2], jpiclib.SYMBOL_EOB)
+        self.assertEqual(jpiclib.parse_symbol(symbols[1]), (2, -3))
+        self.assertEqual(jpiclib.parse_symbol(symbols[3]), (62, 7))
+        self.assertEqual(jpiclib.get_symbol_distribution(inp), [
+            (jpiclib.SYMBOL_EOB, 0.4), (jpiclib.get_symbol(2, -3), 0.2),
+            (jpiclib.get_symbol(0, 5), 0.2), (jpiclib.get_symbol(62, 7), 0.2)])
+
+    def testDecodingTable(self):
+        """A test for the multi-level decoding table."""
+        # 'a': 0, 'b': 10, 'c': 110, 'd': 1110, 'e': 1111
+        codes = [('a', 0b0, 1), ('b', 0b10, 2), ('c', 0b110, 3),
+                 ('d', 0b1110, 4), ('e', 0b1111, 4)]
+        table = jpiclib.DecodingTable(codes, bits=2).table
+        self.assertEqual(table[0b00], ('a', 1))
+        self.assertEqual(table[0b01], ('a', 1))
+        self.assertEqual(table[0b10], ('b', 2))
+        # long codes go through a second-level table
+        subtable, length = table[0b11]
+        self.assertEqual(length, 0)
+        self.assertEqual(subtable[0b00], ('c', 1))
+        self.assertEqual(subtable[0b10], ('d', 2))
+        self.assertEqual(subtable[0b11], ('e', 2))
+
+    def testEncodeDecode(self):
+        """A test for the RLE/huffman encoder and decoder."""
+        rng = np.random.default_rng(0)
+        width, height = 64, 32
+        inp = np.around(rng.laplace(0, 2, size=(height, width))).astype(int)
+        inp[::8, ::8] = rng.integers(-1000, 1000, size=(4, 8))
+        zigzag = jpiclib.zigzag_scan(inp)
+        encoding_table = jpiclib.get_encoding_table(zigzag)
+        enc_bin, enc_bitlen = jpiclib.encode(zigzag, encoding_table)
+        decoding_table = jpiclib.get_decoding_table(encoding_table)
+        out = jpiclib.decode(enc_bin, enc_bitlen, width, height,
+                             decoding_table)
+        self.assertTrue((out == zigzag).all())
+        # serialize and unserialize the encoding table
+        encoding_table_bin = jpiclib.serialize_encoding_table(encoding_table)
+        self.assertEqual(
+            jpiclib.unserialize_encoding_table(encoding_table_bin),
+            encoding_table)
+        decoding_table = jpiclib.unserialize_decoding_table(
+            encoding_table_bin)
+        out = jpiclib.decode(enc_bin, enc_bitlen, width, height,
+                             decoding_table)
+        self.assertTrue((out == zigzag).all())
+
+    def testEncodeDecodeDcpm(self):
+        """A test for the dcpm encoder and decoder."""
+        rng = np.random.default_rng(0)
+        width, height = 64, 32
+        inp = np.around(rng.laplace(0, 2, size=(height, width))).astype(int)
+        inp[::8, ::8] = rng.integers(-1000, 1000, size=(4, 8))
+        inp[0, 8] = inp[0, 0]
+        zigzag = jpiclib.zigzag_scan(inp)
+        category, extra = jpiclib.get_dc_tokens(zigzag)
+        self.assertEqual(category[1], 0)
+        self.assertEqual(category[0],
+                         int(abs(zigzag[0, 0])).bit_length())
+        encoding_table = jpiclib.get_encoding_table(zigzag, 'dcpm')
+        enc_bin, enc_bitlen = jpiclib.encode(zigzag, encoding_table, 'dcpm')
+        decoding_table = jpiclib.get_decoding_table(encoding_table)
+        out = jpiclib.decode(enc_bin, enc_bitlen, width, height,
+                             decoding_table, 'dcpm')
+        self.assertTrue((out == zigzag).all())
+
+    def testStaticTable(self):
+        """A test for the static tables (with escaped symbols)."""
+        rng = np.random.default_rng(0)
+        width, height = 64, 32
+        inp = np.around(rng.laplace(0, 2, size=(height, width))).astype(int)
+        inp[::8, ::8] = rng.integers(-1000, 1000, size=(4, 8))
+        zigzag = jpiclib.zigzag_scan(inp)
+        # train the table using (small) values of a different input
+        train = jpiclib.zigzag_scan(np.clip(
+            np.around(rng.laplace(0, 1, size=(height, width))), -2,
+            2).astype(int))
+        symbols, counts = jpiclib.get_symbol_counts(train, 'dcpm')
+        encoding_table = jpiclib.get_static_encoding_table(symbols, counts)
+        self.assertIn(jpiclib.SYMBOL_ESCAPE, encoding_table)
+        # use the serialized table (the decoder reads the escaped symbols)
+        encoding_table_bin = jpiclib.serialize_encoding_table(encoding_table)
+        decoding_table = jpiclib.unserialize_decoding_table(
+            encoding_table_bin)
+        for encoding in ('basic', 'dcpm'):
+            enc_bin, enc_bitlen = jpiclib.encode(zigzag, encoding_table,
+                                                 encoding)
+            out = jpiclib.decode(enc_bin, enc_bitlen, width, height,
+                                 decoding_table, encoding)
+            self.assertTrue((out == zigzag).all())
+        # tables without the escape symbol cannot code unseen symbols
+        with self.assertRaises(AssertionError):
+            jpiclib.encode(zigzag, jpiclib.get_encoding_table(train))
+
+    def testPackBits(self):
+        """A test for the bit packer."""
+        codes = [0b1, 0b01, 0b0, 0b111111111, 0xffff0000ffff0000]
+        lengths = [1, 2, 3, 9, 64]
+        out, bitlen = jpiclib.pack_bits(codes, lengths)
+        self.assertEqual(bitlen, 79)
+        self.assertEqual(out, bytes([0b10100011, 0xff, 0xff, 0xfe, 0x00,
+                                     0x01, 0xff, 0xfe, 0x00, 0x00]))
+
+
+if __name__ == '__main__':
+    unittest.main()
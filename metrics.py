@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""metrics: image quality metrics (PSNR and SSIM)."""
+
+import math
+import numpy as np
+
+
+PLANE_NAMES = ('y', 'u', 'v')
+
+
+def get_mse(a, b):
+    diff = a.astype('int64') - b.astype('int64')
+    return np.mean(diff * diff)
+
+
+def get_psnr_from_mse(mse, max_value=255):
+    return math.inf if mse == 0 else 10 * math.log10(max_value ** 2 / mse)
+
+
+def get_psnr(a, b):
+    return get_psnr_from_mse(get_mse(a, b))
+
+
+# SSIM constants (8-bit samples, 8x8 windows), as in ffmpeg's vf_ssim
+SSIM_C1 = int(.01 * .01 * 255 * 255 * 64 + .5)
+SSIM_C2 = int(.03 * .03 * 255 * 255 * 64 * 63 + .5)
+
+
+def get_block_sums(m):
+    # returns the sums of the 4x4 blocks of m (cropped to a multiple of 4)
+    height, width = m.shape
+    height &= ~3
+    width &= ~3
+    blocks = m[:height, :width].reshape(height // 4, 4, width // 4, 4)
+    return blocks.sum(axis=(1, 3))
+
+
+def get_ssim_map(a, b):
+    # returns the SSIM of each 8x8 window of the planes a and b. Windows
+    # overlap (they are spaced by 4 pixels), as in ffmpeg's vf_ssim.
+    a = a.astype('int64')
+    b = b.astype('int64')
+    sums = []
+    for m in (a, b, a * a + b * b, a * b):
+        block_sums = get_block_sums(m)
+        # each window is made of 2x2 4x4 blocks
+        sums.append(block_sums[:-1, :-1] + block_sums[1:, :-1] +
+                    block_sums[:-1, 1:] + block_sums[1:, 1:])
+    s1, s2, ss, s12 = sums
+    variance = ss * 64 - s1 * s1 - s2 * s2
+    covariance = s12 * 64 - s1 * s2
+    return ((2 * s1 * s2 + SSIM_C1) * (2 * covariance + SSIM_C2) /
+            ((s1 * s1 + s2 * s2 + SSIM_C1) * (variance + SSIM_C2)))
+
+
+def get_ssim(a, b):
+    ssim_map = get_ssim_map(a, b)
+    return float(ssim_map.mean()) if ssim_map.size else math.nan
+
+
+def get_ssim_db(ssim):
+    return math.inf if ssim == 1 else -10 * math.log10(1 - ssim)
+
+
+def get_metrics(ref_planes, dist_planes):
+    # returns the PSNR and SSIM of each plane, and of the full frame ("all",
+    # where planes are weighted by their size, as in ffmpeg)
+    metrics = {'psnr': {}, 'ssim': {}}
+    sizes = [ref.size for ref in ref_planes]
+    mses = []
+    ssims = []
+    for name, ref, dist in zip(PLANE_NAMES, ref_planes, dist_planes):
+        assert ref.shape == dist.shape, 'invalid plane %s shape: %r != %r' % (
+            name, ref.shape, dist.shape)
+        mses.append(get_mse(ref, dist))
+        ssims.append(get_ssim(ref, dist))
+        metrics['psnr'][name] = get_psnr_from_mse(mses[-1])
+        metrics['ssim'][name] = ssims[-1]
+    metrics['psnr']['all'] = get_psnr_from_mse(
+        np.average(mses, weights=sizes))
+    metrics['ssim']['all'] = float(np.average(ssims, weights=sizes))
+    return metrics
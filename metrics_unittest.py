@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""metrics."""
+
+
+import math
+import numpy as np
+
+import metrics
+
+import unittest
+
+
+def get_ssim_reference(a, b):
+    # straightforward SSIM (8x8 windows every 4 pixels)
+    a = a.astype('float64')
+    b = b.astype('float64')
+    c1 = (.01 * 255) ** 2
+    c2 = (.03 * 255) ** 2
+    ssims = []
+    for i in range(0, a.shape[0] - 7, 4):
+        for j in range(0, a.shape[1] - 7, 4):
+            wa = a[i:i + 8, j:j + 8]
+            wb = b[i:i + 8, j:j + 8]
+            ma, mb = wa.mean(), wb.mean()
+            # sample (co)variances, as in ffmpeg
+            va = ((wa - ma) ** 2).sum() / 63
+            vb = ((wb - mb) ** 2).sum() / 63
+            cov = ((wa - ma) * (wb - mb)).sum() / 63
+            ssims.append((2 * ma * mb + c1) * (2 * cov + c2) /
+                         ((ma * ma + mb * mb + c1) * (va + vb + c2)))
+    return np.mean(ssims)
+
+
+class MyTest(unittest.TestCase):
+
+    def testPsnr(self):
+        """A test for the PSNR."""
+        a = np.full((8, 8), 100, dtype=np.uint8)
+        self.assertEqual(metrics.get_psnr(a, a), math.inf)
+        b = a + 1
+        self.assertAlmostEqual(metrics.get_psnr(a, b),
+                               10 * math.log10(255 ** 2))
+
+    def testSsim(self):
+        """A test for the SSIM against a per-window implementation."""
+        rng = np.random.default_rng(0)
+        a = rng.integers(0, 256, size=(30, 42)).astype(np.uint8)
+        self.assertEqual(metrics.get_ssim(a, a), 1.0)
+        b = np.clip(a.astype(int) + rng.integers(-20, 21, size=a.shape),
+                    0, 255).astype(np.uint8)
+        self.assertAlmostEqual(metrics.get_ssim(a, b),
+                               get_ssim_reference(a, b), places=3)
+
+    def testMetrics(self):
+        """A test for the per-plane and combined metrics."""
+        rng = np.random.default_rng(1)
+        ref = [rng.integers(0, 256, size=shape).astype(np.uint8) for shape in
+               ((16, 16), (8, 8), (8, 8))]
+        dist = [ref[0], ref[1] ^ 1, ref[2]]
+        out = metrics.get_metrics(ref, dist)
+        self.assertEqual(out['psnr']['y'], math.inf)
+        self.assertAlmostEqual(out['psnr']['u'], 10 * math.log10(255 ** 2))
+        # the combined MSE is weighted by the plane sizes (1/6 of pixels)
+        self.assertAlmostEqual(out['psnr']['all'],
+                               10 * math.log10(255 ** 2 * 6))
+        self.assertEqual(out['ssim']['y'], 1.0)
+        self.assertLess(out['ssim']['all'], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
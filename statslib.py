@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+"""statslib: codec instrumentation."""
+
+import collections
+import contextlib
+import json
+import time
+import tracemalloc
+
+
+# counters that are merged using the maximum (instead of the sum)
+MAX_COUNTERS = ('alphabet', 'table_bits')
+
+
+class Stats:
+    """Wall time, peak memory, and counters of the codec stages.
+
+    Names are `<name>` for whole-frame stages and counters, and
+    `<plane>.<name>` for per-plane ones (see merge()).
+    """
+
+    enabled = True
+
+    def __init__(self, memory=False):
+        self.times = collections.defaultdict(float)
+        self.counters = collections.defaultdict(int)
+        # peak memory use of each stage (above the memory use at the start
+        # of the stage), and of the full run (in bytes)
+        self.memory = memory
+        self.peaks = collections.defaultdict(int)
+        self.peak = 0
+        self.open_stages = []
+
+    def update_peaks(self):
+        # fold the tracemalloc peak into all the open stages
+        _, peak = tracemalloc.get_traced_memory()
+        for stage in self.open_stages:
+            stage[1] = max(stage[1], peak - stage[0])
+        self.peak = max(self.peak, peak)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.update_peaks()
+            tracemalloc.reset_peak()
+            # [memory use at start, peak memory use above it]
+            open_stage = [tracemalloc.get_traced_memory()[0], 0]
+            self.open_stages.append(open_stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+            if self.memory:
+                self.update_peaks()
+                self.open_stages.remove(open_stage)
+                self.peaks[name] = max(self.peaks[name], open_stage[1])
+
+    def count(self, name, value):
+        if name.split('.')[-1] in MAX_COUNTERS:
+            self.counters[name] = max(self.counters[name], value)
+        else:
+            self.counters[name] += value
+
+    def new(self):
+        # returns an empty object of the same type (e.g. for a plane). Its
+        # stages are nested in the currently open ones
+        stats = Stats(self.memory)
+        stats.open_stages = self.open_stages
+        return stats
+
+    def merge(self, other, prefix=''):
+        for name, value in other.times.items():
+            self.times[prefix + name] += value
+        for name, value in other.counters.items():
+            self.count(prefix + name, value)
+        for name, value in other.peaks.items():
+            self.peaks[prefix + name] = max(self.peaks[prefix + name], value)
+        self.peak = max(self.peak, other.peak)
+
+    def get_stage_times(self):
+        # returns the time of each stage, added over all the planes
+        stage_times = collections.defaultdict(float)
+        for name, value in self.times.items():
+            stage_times[name.split('.')[-1]] += value
+        return dict(stage_times)
+
+    def get_counters(self):
+        # returns the counters, plus the average code length (in bits) of
+        # each plane
+        counters = dict(self.counters)
+        for name, value in self.counters.items():
+            if name.split('.')[-1] == 'symbols' and value:
+                prefix = name[:-len('symbols')]
+                counters[prefix + 'avg_code_length'] = (
+                    self.counters[prefix + 'code_bits'] / value)
+        return counters
+
+    def to_dict(self):
+        out = {
+            'times': dict(self.times),
+            'stage_times': self.get_stage_times(),
+            'counters': self.get_counters(),
+        }
+        if self.memory:
+            out['peak_memory'] = dict(self.peaks)
+            out['peak_memory_total'] = self.peak
+        return out
+
+    def to_json(self, **kwargs):
+        # kwargs are added to the output (e.g. a description of the run)
+        return json.dumps(dict(kwargs, **self.to_dict()), indent=2)
+
+
+class NullStats:
+    """Disabled instrumentation (all the methods are no-ops)."""
+
+    enabled = False
+    NULL_CONTEXT = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self.NULL_CONTEXT
+
+    def count(self, name, value):
+        pass
+
+    def new(self):
+        return self
+
+    def merge(self, other, prefix=''):
+        pass
+
+
+NULL_STATS = NullStats()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""statslib."""
+
+
+import json
+
+import statslib
+
+import unittest
+
+
+class MyTest(unittest.TestCase):
+
+    def testStage(self):
+        """A test for the stage timers and peak memory sampling."""
+        stats = statslib.Stats(memory=True)
+        with stats.stage('total'):
+            plane_stats = stats.new()
+            with plane_stats.stage('transform'):
+                buf = bytearray(1 << 20)
+                del buf
+            with plane_stats.stage('entropy'):
+                pass
+            stats.merge(plane_stats, 'y.')
+        self.assertGreaterEqual(stats.times['total'],
+                                stats.times['y.transform'])
+        self.assertEqual(set(stats.get_stage_times()),
+                         {'total', 'transform', 'entropy'})
+        # the peaks of the nested stages must be seen by the outer ones
+        self.assertGreaterEqual(stats.peaks['y.transform'], 1 << 20)
+        self.assertLess(stats.peaks['y.entropy'], 1 << 20)
+        self.assertGreaterEqual(stats.peaks['total'], 1 << 20)
+        self.assertGreaterEqual(stats.peak, 1 << 20)
+
+    def testCounters(self):
+        """A test for the counters."""
+        stats = statslib.Stats()
+        for _ in range(2):
+            slice_stats = stats.new()
+            slice_stats.count('symbols', 10)
+            slice_stats.count('code_bits', 25)
+            slice_stats.count('alphabet', 7)
+            stats.merge(slice_stats, 'u.')
+        counters = stats.get_counters()
+        self.assertEqual(counters['u.symbols'], 20)
+        # the alphabet is shared by all the slices
+        self.assertEqual(counters['u.alphabet'], 7)
+        self.assertEqual(counters['u.avg_code_length'], 2.5)
+        out = json.loads(stats.to_json(function='encode'))
+        self.assertEqual(out['function'], 'encode')
+        self.assertEqual(out['counters']['u.code_bits'], 50)
+
+    def testNullStats(self):
+        """A test for the disabled instrumentation."""
+        stats = statslib.NULL_STATS
+        self.assertFalse(stats.enabled)
+        with stats.stage('total'):
+            stats.count('symbols', 1)
+        self.assertIs(stats.new(), stats)
+
+
+if __name__ == '__main__':
+    unittest.main()
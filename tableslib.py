@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""tableslib: static (predefined) Huffman tables."""
+
+import functools
+import os
+
+import jpiclib
+import tlvlib
+
+
+# static tables are identified by a (positive) ID. Table 0 means no static
+# tables (i.e. each plane carries its own encoding table).
+# Built-in tables are files in the `tables` directory (`<id>.jpit`), using
+# the TLV approach (L in bits):
+# * magic word ('jpit')
+# * a 'desc' chunk, with a description of the training set
+# * a 'ltbl' chunk, with the (serialized) luma encoding table
+# * a 'ctbl' chunk, with the (serialized) chroma encoding table
+TABLES_MAGIC = b'jpit'
+TABLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'tables')
+TABLE_TAGS = (b'ltbl', b'ctbl')
+
+
+def get_tables_path(table_id):
+    return os.path.join(TABLES_DIR, '%i.jpit' % table_id)
+
+
+def write_tables(outfile, luma_table_bin, chroma_table_bin, description):
+    with open(outfile, 'wb') as fout:
+        tlvlib.write_magic(fout, TABLES_MAGIC)
+        tlvlib.write_chunk(fout, b'desc', str.encode(description))
+        for tag, table_bin in zip(TABLE_TAGS,
+                                  (luma_table_bin, chroma_table_bin)):
+            tlvlib.write_chunk(fout, tag, table_bin)
+
+
+def read_tables(infile):
+    # returns the (serialized) luma and chroma encoding tables
+    with open(infile, 'rb') as fin:
+        chunks = {tag: bytes(value) for (tag, _, value) in
+                  tlvlib.read_chunks(fin.read(), TABLES_MAGIC)}
+    for tag in TABLE_TAGS:
+        assert tag in chunks, 'invalid tables file: no %s' % tag.decode()
+    return tuple(chunks[tag] for tag in TABLE_TAGS)
+
+
+# tables are read (and their encoding/decoding tables built) once per
+# process
+@functools.lru_cache(maxsize=None)
+def get_tables(table_id):
+    # returns the (serialized) luma and chroma tables of a built-in ID
+    path = get_tables_path(table_id)
+    assert table_id > 0 and os.path.exists(path), (
+        'invalid table ID: %i' % table_id)
+    return read_tables(path)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding_tables(table_id):
+    return tuple(jpiclib.unserialize_encoding_table(table_bin) for
+                 table_bin in get_tables(table_id))
+
+
+@functools.lru_cache(maxsize=None)
+def get_decoding_tables(table_id):
+    return tuple(jpiclib.DecodingTable(
+        jpiclib.unserialize_canonical_codes(table_bin)) for
+        table_bin in get_tables(table_id))
+
+
+def get_encoding_table(table_id, luma):
+    return get_encoding_tables(table_id)[0 if luma else 1]
+
+
+def get_decoding_table(table_id, luma):
+    return get_decoding_tables(table_id)[0 if luma else 1]
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+"""tableslib."""
+
+
+import os
+import tempfile
+
+import tableslib
+
+import unittest
+
+
+class MyTest(unittest.TestCase):
+
+    def testWriteRead(self):
+        """A test for the static tables file."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = os.path.join(tmpdir, 'tables.jpit')
+            tableslib.write_tables(outfile, b'luma', b'chroma',
+                                   'frames: 1\n')
+            self.assertEqual(tableslib.read_tables(outfile),
+                             (b'luma', b'chroma'))
+
+    def testBuiltinTables(self):
+        """A test for the built-in tables."""
+        luma_table, chroma_table = tableslib.get_encoding_tables(1)
+        self.assertIs(tableslib.get_encoding_table(1, True), luma_table)
+        # decoding tables are built only once
+        self.assertIs(tableslib.get_decoding_table(1, False),
+                      tableslib.get_decoding_table(1, False))
+        with self.assertRaises(AssertionError):
+            tableslib.get_tables(0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""tlvlib: TLV chunk reader/writer."""
+
+import contextlib
+import struct
+
+
+# jpic files are a 4-byte magic word followed by a list of TLV chunks:
+# * tag: 4 bytes
+# * length: 4 bytes (int32). Length of the value *in bits* (which allows
+#   dumping generic bitstrings)
+# * value: the value, padded to a byte boundary
+TLV_TAG_SIZE = 4
+TLV_LENGTH_FORMAT = '=l'
+TLV_HEADER_SIZE = TLV_TAG_SIZE + struct.calcsize(TLV_LENGTH_FORMAT)
+# 32-bit bit lengths limit values to 256 MB. Formats that need larger
+# values use 8-byte (int64) lengths instead (all the functions accept the
+# length format)
+TLV64_LENGTH_FORMAT = '=q'
+
+
+def get_header_size(length_format=TLV_LENGTH_FORMAT):
+    return TLV_TAG_SIZE + struct.calcsize(length_format)
+
+
+def get_value_size(bitlen):
+    # size in bytes of a value of `bitlen` bits
+    return (bitlen + 7) >> 3
+
+
+# writer
+
+def write_magic(fout, magic):
+    assert len(magic) == TLV_TAG_SIZE, 'invalid magic word: %r' % magic
+    fout.write(magic)
+
+
+def write_chunk(fout, tag, value, bitlen=None,
+                length_format=TLV_LENGTH_FORMAT):
+    # write a chunk into an open file (which does not need to be seekable,
+    # e.g. a pipe)
+    # value is any bytes-like object (written with no copies). By default,
+    # bitlen is the full value size
+    assert len(tag) == TLV_TAG_SIZE, 'invalid tag: %r' % tag
+    if bitlen is None:
+        bitlen = memoryview(value).nbytes * 8
+    fout.write(tag)
+    fout.write(struct.pack(length_format, bitlen))
+    fout.write(value)
+
+
+@contextlib.contextmanager
+def write_chunk_stream(fout, tag, length_format=TLV_LENGTH_FORMAT):
+    # write a chunk whose value is written directly into fout by the caller
+    # (inside the `with` block). The length is patched when the block ends,
+    # so fout must be seekable. Yields the chunk offset
+    assert len(tag) == TLV_TAG_SIZE, 'invalid tag: %r' % tag
+    offset = fout.tell()
+    fout.write(tag)
+    fout.write(struct.pack(length_format, 0))
+    yield offset
+    end = fout.tell()
+    fout.seek(offset + TLV_TAG_SIZE)
+    fout.write(struct.pack(length_format, (
+        end - offset - get_header_size(length_format)) * 8))
+    fout.seek(end)
+
+
+# readers
+
+def peek_magic(fin):
+    # returns the magic word of an open (seekable) file, without consuming
+    # it
+    offset = fin.tell()
+    magic = fin.read(TLV_TAG_SIZE)
+    fin.seek(offset)
+    return magic
+
+
+def read_chunks(buf, magic, length_format=TLV_LENGTH_FORMAT):
+    # parse a buffer (any object supporting the buffer protocol, e.g. bytes
+    # or mmap) with a list of chunks
+    # Yields (tag, bitlen, value) tuples, where the value is a zero-copy
+    # memoryview into buf
+    view = memoryview(buf).cast('B')
+    assert bytes(view[:TLV_TAG_SIZE]) == magic, (
+        'non-%s file: no %s' % (magic.decode(), magic.decode()))
+    header_size = get_header_size(length_format)
+    i = TLV_TAG_SIZE
+    while i < len(view):
+        assert i + header_size <= len(view), (
+            'invalid file: truncated chunk header at %i' % i)
+        tag = bytes(view[i:i + TLV_TAG_SIZE])
+        bitlen, = struct.unpack_from(length_format, view, i + TLV_TAG_SIZE)
+        i += header_size
+        size = get_value_size(bitlen)
+        assert 0 <= bitlen and i + size <= len(view), (
+            'invalid file: truncated %s chunk' % tag.decode())
+        yield tag, bitlen, view[i:i + size]
+        i += size
+
+
+def read_chunk_header(fin, length_format=TLV_LENGTH_FORMAT):
+    # read the chunk header at the current position of an open file
+    # returns a (tag, bitlen) tuple
+    header_size = get_header_size(length_format)
+    header = fin.read(header_size)
+    assert len(header) == header_size, 'invalid file: truncated chunk'
+    bitlen, = struct.unpack_from(length_format, header, TLV_TAG_SIZE)
+    return header[:TLV_TAG_SIZE], bitlen
+
+
+def read_chunk_headers(fin, magic, start=0, end=None,
+                       length_format=TLV_LENGTH_FORMAT):
+    # parse the chunk headers of an open file by seeking over the values
+    # (which are not read). Chunks start at `start` (with the magic word),
+    # and end at `end` (the end of the file by default)
+    # Non-seekable files (e.g. pipes) are parsed from their current
+    # position (`start`), skipping the values by reading them. Their values
+    # cannot be read using read_chunk_value()
+    # Yields (tag, bitlen, value offset) tuples
+    seekable = fin.seekable()
+    if seekable:
+        fin.seek(start)
+    assert fin.read(TLV_TAG_SIZE) == magic, (
+        'non-%s file: no %s' % (magic.decode(), magic.decode()))
+    if seekable and end is None:
+        end = fin.seek(0, 2)
+    header_size = get_header_size(length_format)
+    i = start + TLV_TAG_SIZE
+    while end is None or i < end:
+        if seekable:
+            fin.seek(i)
+        header = fin.read(header_size)
+        if not header and end is None:
+            # end of a non-seekable file
+            return
+        assert len(header) == header_size, 'invalid file: truncated chunk'
+        tag = header[:TLV_TAG_SIZE]
+        bitlen, = struct.unpack_from(length_format, header, TLV_TAG_SIZE)
+        i += header_size
+        yield tag, bitlen, i
+        size = get_value_size(bitlen)
+        i += size
+        if not seekable:
+            skip(fin, size)
+    assert i == end, 'invalid file: truncated chunk'
+
+
+def skip(fin, size, block_size=1 << 20):
+    # skip `size` bytes of a non-seekable file (in blocks)
+    while size > 0:
+        block = fin.read(min(size, block_size))
+        assert block, 'invalid file: truncated chunk'
+        size -= len(block)
+
+
+def read_chunk_value(fin, offset, bitlen):
+    # read the value of a chunk (see read_chunk_headers())
+    fin.seek(offset)
+    value = fin.read(get_value_size(bitlen))
+    assert len(value) == get_value_size(bitlen), (
+        'invalid file: truncated chunk')
+    return value
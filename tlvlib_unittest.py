@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""tlvlib."""
+
+
+import io
+import os
+import struct
+
+import tlvlib
+
+import unittest
+
+
+class MyTest(unittest.TestCase):
+
+    def testWriteRead(self):
+        """A test for a chunk write/read round trip."""
+        fout = io.BytesIO()
+        tlvlib.write_magic(fout, b'test')
+        tlvlib.write_chunk(fout, b'abcd', b'hello')
+        # a 9-bit value is padded to 2 bytes
+        tlvlib.write_chunk(fout, b'efgh', b'\x12\x80', 9)
+        with tlvlib.write_chunk_stream(fout, b'ijkl') as offset:
+            fout.write(b'stream')
+        self.assertEqual(offset, 4 + 8 + 5 + 8 + 2)
+        tlvlib.write_chunk(fout, b'mnop', b'')
+        out = fout.getvalue()
+        expected = [(b'abcd', 40, b'hello'), (b'efgh', 9, b'\x12\x80'),
+                    (b'ijkl', 48, b'stream'), (b'mnop', 0, b'')]
+        # zero-copy reader
+        chunks = list(tlvlib.read_chunks(out, b'test'))
+        self.assertEqual([(tag, bitlen, bytes(value)) for
+                          (tag, bitlen, value) in chunks], expected)
+        self.assertIsInstance(chunks[0][2], memoryview)
+        # seeking reader
+        fin = io.BytesIO(out)
+        headers = list(tlvlib.read_chunk_headers(fin, b'test'))
+        self.assertEqual([(tag, bitlen) for (tag, bitlen, _) in headers],
+                         [(tag, bitlen) for (tag, bitlen, _) in expected])
+        _, bitlen, offset = headers[2]
+        self.assertEqual(tlvlib.read_chunk_value(fin, offset, bitlen),
+                         b'stream')
+
+    def testPipe(self):
+        """A test for writing and parsing non-seekable files."""
+        fout = io.BytesIO()
+        tlvlib.write_magic(fout, b'test')
+        tlvlib.write_chunk(fout, b'abcd', b'hello')
+        tlvlib.write_chunk(fout, b'efgh', b'\x12\x80', 9)
+        expected = fout.getvalue()
+        rfd, wfd = os.pipe()
+        with open(rfd, 'rb') as fin:
+            with open(wfd, 'wb') as fout:
+                self.assertFalse(fout.seekable())
+                tlvlib.write_magic(fout, b'test')
+                tlvlib.write_chunk(fout, b'abcd', b'hello')
+                tlvlib.write_chunk(fout, b'efgh', b'\x12\x80', 9)
+            self.assertEqual(fin.read(), expected)
+        rfd, wfd = os.pipe()
+        with open(rfd, 'rb') as fin:
+            with open(wfd, 'wb') as fout:
+                fout.write(expected)
+            self.assertEqual(
+                [(tag, bitlen) for (tag, bitlen, _) in
+                 tlvlib.read_chunk_headers(fin, b'test')],
+                [(b'abcd', 40), (b'efgh', 9)])
+
+    def testWriteRead64(self):
+        """A test for the 64-bit chunk lengths."""
+        fmt = tlvlib.TLV64_LENGTH_FORMAT
+        fout = io.BytesIO()
+        tlvlib.write_magic(fout, b'test')
+        tlvlib.write_chunk(fout, b'abcd', b'hello', length_format=fmt)
+        with tlvlib.write_chunk_stream(fout, b'ijkl', fmt):
+            fout.write(b'stream')
+        out = fout.getvalue()
+        self.assertEqual(len(out), 4 + 12 + 5 + 12 + 6)
+        self.assertEqual([(tag, bitlen, bytes(value)) for
+                          (tag, bitlen, value) in
+                          tlvlib.read_chunks(out, b'test', fmt)],
+                         [(b'abcd', 40, b'hello'), (b'ijkl', 48, b'stream')])
+        fin = io.BytesIO(out)
+        self.assertEqual(
+            [(tag, bitlen) for (tag, bitlen, _) in
+             tlvlib.read_chunk_headers(fin, b'test', length_format=fmt)],
+            [(b'abcd', 40), (b'ijkl', 48)])
+        # 32-bit lengths cannot represent large values
+        with self.assertRaises(struct.error):
+            tlvlib.write_chunk(fout, b'abcd', b'', 1 << 31)
+        tlvlib.write_chunk(fout, b'abcd', b'', 1 << 31, fmt)
+
+    def testInvalid(self):
+        """A test for invalid chunk lists."""
+        fout = io.BytesIO()
+        tlvlib.write_magic(fout, b'test')
+        tlvlib.write_chunk(fout, b'abcd', b'hello')
+        out = fout.getvalue()
+        with self.assertRaises(AssertionError):
+            list(tlvlib.read_chunks(out, b'tset'))
+        with self.assertRaises(AssertionError):
+            list(tlvlib.read_chunks(out[:-1], b'test'))
+        with self.assertRaises(AssertionError):
+            list(tlvlib.read_chunk_headers(io.BytesIO(out[:-1]), b'test'))
+        with self.assertRaises(AssertionError):
+            tlvlib.write_chunk(fout, b'abc', b'hello')
+
+
+if __name__ == '__main__':
+    unittest.main()
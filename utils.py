@@ -2,6 +2,14 @@
 
 """utils."""
 
+import contextlib
+import csv
+import io
+import mmap
+import numpy as np
+import os
+import stat
+
 
 def read_as_raw(infile, size=-1, seek_pos=0):
     with open(infile, 'rb') as fin:
@@ -13,21 +21,82 @@ def read_as_raw(infile, size=-1, seek_pos=0):
     return data
 
 
+@contextlib.contextmanager
+def open_input(infile):
+    # open a file for reading, only once (it can be a pipe). Non-seekable
+    # files are read into memory, so that the result can always seek
+    with open(infile, 'rb') as fin:
+        yield fin if fin.seekable() else io.BytesIO(fin.read())
+
+
+@contextlib.contextmanager
+def input_buffer(fin):
+    # yields the full contents of a file opened by open_input(): a
+    # (zero-copy) read-only mmap for non-empty regular files, or the bytes
+    # read otherwise (e.g. pipes). The mmap is only closed on success: on
+    # errors, the traceback can still hold views into it (and closing it
+    # would replace the original error with a BufferError)
+    if not isinstance(fin, io.BytesIO):
+        st = os.fstat(fin.fileno())
+        if stat.S_ISREG(st.st_mode) and st.st_size:
+            mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+            yield mm
+            mm.close()
+            return
+    fin.seek(0)
+    yield fin.read()
+
+
 def write_as_raw(buf, outfile):
     # write binary buffer into the outfile
     with open(outfile, 'wb') as fout:
         fout.write(buf)
 
 
+def get_uint8_buffer(array):
+    # returns a (zero-copy if possible) uint8 memoryview of an array
+    if array.dtype != np.uint8:
+        array = array.clip(0, 255).astype(np.uint8)
+    return memoryview(np.ascontiguousarray(array)).cast('B')
+
+
+def write_planes(planes, fout):
+    # write the planes into an open file, with no intermediate copies
+    fout.writelines(get_uint8_buffer(plane) for plane in planes if
+                    plane is not None)
+
+
+def write_as_yuv(planes, outfile):
+    # write planes (e.g. 4:2:0 y, u, v) into the outfile (as raw yuv)
+    with open(outfile, 'wb') as fout:
+        write_planes(planes, fout)
+
+
 def write_as_pgm(array, outfile):
-    # write frame into the outfile (as pgm format)
-    with open(outfile, 'w') as fout:
+    # write frame into the outfile (as binary pgm format)
+    with open(outfile, 'wb') as fout:
         height, width = array.shape
         # print pgm header
-        fout.write('P2\n%i %i\n255\n' % (width, height))
+        fout.write(b'P5\n%i %i\n255\n' % (width, height))
         # print pgm contents
-        for i in range(0, height):
-            for j in range(0, width):
-                fout.write('%i ' % array[i, j])
-            fout.write('\n')
-        fout.write('\n')
+        fout.write(get_uint8_buffer(array))
+
+
+def write_as_ppm(array, outfile):
+    # write a heightxwidthx3 (rgb) frame into the outfile (as binary ppm
+    # format)
+    with open(outfile, 'wb') as fout:
+        height, width, _ = array.shape
+        # print ppm header
+        fout.write(b'P6\n%i %i\n255\n' % (width, height))
+        # print ppm contents
+        fout.write(get_uint8_buffer(array))
+
+
+def write_csv(rows, columns, fout):
+    # write a list of dictionaries as a CSV file with a `#`-prefixed header
+    writer = csv.DictWriter(fout, columns, extrasaction='ignore',
+                            lineterminator='\n')
+    fout.write('#' + ','.join(columns) + '\n')
+    for row in rows:
+        writer.writerow(row)
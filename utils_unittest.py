@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+"""utils."""
+
+
+import numpy as np
+import os
+import tempfile
+
+import utils
+
+import unittest
+
+
+class MyTest(unittest.TestCase):
+
+    def testWriteAsPgm(self):
+        """A test for the binary pgm/ppm writers."""
+        rng = np.random.default_rng(0)
+        array = rng.integers(0, 256, size=(6, 10)).astype(np.uint8)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = os.path.join(tmpdir, 'out.pgm')
+            utils.write_as_pgm(array, outfile)
+            data = utils.read_as_raw(outfile)
+            self.assertEqual(data, b'P5\n10 6\n255\n' + array.tobytes())
+            # non-uint8 arrays are clipped
+            utils.write_as_pgm(array.astype(int) * 2 - 100, outfile)
+            data = utils.read_as_raw(outfile)
+            expected = (array.astype(int) * 2 - 100).clip(0, 255)
+            self.assertEqual(data, b'P5\n10 6\n255\n' +
+                             expected.astype(np.uint8).tobytes())
+            outfile = os.path.join(tmpdir, 'out.ppm')
+            rgb = np.stack((array, array, array), axis=-1)
+            utils.write_as_ppm(rgb, outfile)
+            data = utils.read_as_raw(outfile)
+            self.assertEqual(data, b'P6\n10 6\n255\n' + rgb.tobytes())
+
+    def testWriteAsYuv(self):
+        """A test for the raw yuv writer."""
+        rng = np.random.default_rng(0)
+        y = rng.integers(0, 256, size=(8, 16)).astype(np.uint8)
+        u = rng.integers(0, 256, size=(4, 8)).astype(np.uint8)
+        v = rng.integers(0, 256, size=(4, 8)).astype(np.uint8)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = os.path.join(tmpdir, 'out.yuv')
+            # non-contiguous planes must work too
+            utils.write_as_yuv((y, u, v.T.copy().T), outfile)
+            data = utils.read_as_raw(outfile)
+            self.assertEqual(data, y.tobytes() + u.tobytes() + v.tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()